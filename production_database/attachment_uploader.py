@@ -0,0 +1,124 @@
+'''
+Concurrent, deduplicated attachment uploads (e.g. VI pictures) to test runs in the PDB.
+
+Every attachment is tagged with the SHA-256 of its content in its description. Before a file is
+uploaded, the attachments of the test run are checked for this tag, so that a retried or repeated
+upload does not attach the same picture twice. The description is the only place for the tag:
+createTestRunAttachment takes only title, description, type and the file, and all of them are
+shown with the attachment in the PDB. Pictures larger than `max_bytes` are optionally
+uploaded as downscaled JPEG copy (requires Pillow).
+'''
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Directory of downscaled copies of pictures, reused by later uploads of the same file
+RESIZE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'atlas_module_qc', 'attachments')
+
+_IMAGE_SUFFIXES = ['.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp']
+
+
+def content_hash(filename, chunk_size=1 << 20):
+    ''' Returns SHA-256 of the file content, read in chunks.
+    '''
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _hash_tag(sha):
+    return 'sha256:{0}'.format(sha[:16])
+
+
+def downscale_picture(filename, max_bytes, sha=None, resize_dir=RESIZE_DIR):
+    ''' Returns JPEG copy of picture `filename` smaller than `max_bytes`, or `filename` itself if it is small enough,
+        not a picture or Pillow is not installed. Copies are cached in `resize_dir` by content hash.
+        A copy is written to a temporary file first, so that concurrent uploads never read a partly written copy.
+    '''
+    if os.path.getsize(filename) <= max_bytes or Path(filename).suffix.lower() not in _IMAGE_SUFFIXES:
+        return filename
+    if Image is None:
+        logging.getLogger('AttachmentUploader').warning('Pillow is not installed, uploading {0} in full size'.format(filename))
+        return filename
+
+    resized = os.path.join(resize_dir, '{0}_{1}.jpg'.format(sha or content_hash(filename), max_bytes))
+    if os.path.exists(resized):
+        return resized
+    os.makedirs(resize_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(suffix='.jpg', dir=resize_dir)
+    os.close(fd)
+    try:
+        with Image.open(filename) as image:
+            image = image.convert('RGB')
+            quality = 90
+            while True:
+                image.save(tmp, 'JPEG', quality=quality, optimize=True)
+                if os.path.getsize(tmp) <= max_bytes or min(image.size) < 200:
+                    break
+                if quality > 70:  # lower quality first, then resolution
+                    quality -= 10
+                else:
+                    image = image.resize((image.size[0] * 3 // 4, image.size[1] * 3 // 4), Image.LANCZOS)
+        os.replace(tmp, resized)  # atomic, a concurrent writer of the same copy just replaces it with an equal one
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return resized
+
+
+class AttachmentUploader(object):
+    '''
+    Uploads attachments to test runs concurrently, skipping files already attached to the test run.
+
+    max_bytes: upload pictures larger than this as downscaled JPEG copy (None: always upload the original)
+    max_attempts: attempts per file, failed transfers are retried without touching the test run
+    '''
+
+    def __init__(self, itk_prodDB, max_bytes=None, max_attempts=3, backoff=2.0):
+        self.itk_prodDB = itk_prodDB
+        self.max_bytes = max_bytes
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.log = logging.getLogger('AttachmentUploader')
+
+    def _attached_tags(self, test_run_id):
+        self.itk_prodDB.cache.invalidate(test_run_id)
+        test_run = self.itk_prodDB._get("getTestRun", json={"testRun": test_run_id})
+        return [a.get('description') or '' for a in test_run.get('attachments') or []]
+
+    def upload(self, filename, data):
+        ''' Uploads `filename` as attachment described by `data` (with testRun, title, description, type).
+            Returns False if the file was already attached to the test run, True otherwise.
+        '''
+        sha = content_hash(filename)
+        tag = _hash_tag(sha)
+        data = dict(data)
+        # no hidden field for the tag in the PDB attachment, see module docstring
+        data['description'] = '{0} ({1})'.format(data.get('description') or data.get('title', ''), tag)
+
+        for attempt in range(self.max_attempts):
+            # also catches attachments of attempts which failed after reaching the PDB
+            if any(tag in description for description in self._attached_tags(data['testRun'])):
+                self.log.info('{0} is already attached to test run {1}'.format(filename, data['testRun']))
+                return False
+            upload_file = downscale_picture(filename, self.max_bytes, sha=sha) if self.max_bytes is not None else filename
+            data['url'] = Path(upload_file)
+            try:
+                self.itk_prodDB.upload_attachment_to_eos(filename=upload_file, data=data)
+                return True
+            except Exception as e:
+                if attempt + 1 >= self.max_attempts:
+                    raise
+                delay = self.backoff ** (attempt + 1)
+                self.log.warning('Upload of {0} failed, retrying in {1:.0f} s: {2}'.format(filename, delay, e))
+                time.sleep(delay)
@@ -0,0 +1,236 @@
+'''
+Batch conversion and upload of the QC files of a production lot.
+
+Walks a folder tree for QC workbooks (.xls/.xlsx), VI photos (.jpg/.png) and wire bond pull
+test exports (.txt). The template of every workbook (flex, bare module, module) is identified
+by its title in the signature cell of the cell maps, and workbooks are converted in parallel
+worker processes. Photos and pull tests in the folder of a workbook are paired with it by the
+short number of its serial number (e.g. '0140 front.JPG' belongs to bare module 20UPG42200140).
+The converted tests are then queued for upload. A manifest of processed files makes reruns incremental:
+
+    python batch_ingest.py /data/assembly/2024-03 -j 8
+'''
+import argparse
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from sheet_schema import extract_payloads, identify
+
+MANIFEST_FILE = 'ingest_manifest.json'
+
+WORKBOOK_SUFFIXES = ['.xls', '.xlsx', '.xlsm']
+PICTURE_SUFFIXES = ['.jpg', '.jpeg', '.png']
+PULL_TEST_SUFFIXES = ['.txt']
+
+# Templates in the order they are tried when identifying a workbook
+TEMPLATES = ['module', 'bare_module', 'flex']
+
+_BACKSIDE = re.compile(r'back|_b$|rueck', re.IGNORECASE)
+_BONDED = re.compile(r'bond', re.IGNORECASE)
+
+
+def identify_workbook(filename):
+    ''' Returns (template, serial number) of QC workbook `filename` identified by the signature cells of the cell maps,
+        (None, None) if it matches no template or its serial number cannot be read.
+    '''
+    cell_map = identify(filename, templates=TEMPLATES)
+    if cell_map is None:
+        return None, None
+    try:
+        payloads = extract_payloads(filename, cell_map.template, version=cell_map.version)
+    except ValueError as e:
+        logging.getLogger('BatchIngest').warning('{0} is a {1} workbook but cannot be read: {2}'.format(filename, cell_map.template, e))
+        return None, None
+    return cell_map.template, next(iter(payloads.values()))['component']
+
+
+def _convert_workbook(filename):
+    ''' Identifies and converts one workbook (run in a worker process). Returns (template, serial number, .json files).
+    '''
+    template, sn = identify_workbook(filename)
+    if template == 'module':
+        from upload_module_data import convert_module_data_file
+        return template, sn, convert_module_data_file(filename)
+    if template == 'bare_module':
+        from upload_bare_module_data import convert_bare_module_data_file
+        return template, sn, convert_bare_module_data_file(filename)
+    if template == 'flex':
+        from upload_flex_data import convert_flex_data_file
+        return template, sn, convert_flex_data_file(filename)
+    return None, None, None
+
+
+def _signature(filename):
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _number_tokens(filename):
+    return [int(t) for t in re.findall(r'\d{3,}', Path(filename).stem)]
+
+
+def _belongs_to(filename, sn):
+    ''' True if the file name contains the short number (last four digits) of serial number `sn`.
+    '''
+    return int(sn[-4:]) in _number_tokens(filename)
+
+
+class BatchIngest(object):
+    '''
+    Discovers, converts and uploads the QC files below a folder, with a manifest of processed files.
+    '''
+
+    def __init__(self, folder, manifest_file=None, max_workers=None, max_picture_bytes=None):
+        self.folder = Path(folder)
+        self.manifest_file = Path(manifest_file) if manifest_file is not None else self.folder / MANIFEST_FILE
+        self.max_workers = max_workers
+        self.max_picture_bytes = max_picture_bytes
+        self.log = logging.getLogger('BatchIngest')
+        self.manifest = {}
+        self.deferred = []
+        if self.manifest_file.exists():
+            with open(self.manifest_file) as f:
+                self.manifest = json.load(f)
+
+    def _save_manifest(self):
+        tmp = self.manifest_file.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(tmp, self.manifest_file)
+
+    def discover(self):
+        ''' Returns {folder: {'workbooks': [...], 'pictures': [...], 'pull_tests': [...]}} of the files below the folder.
+        '''
+        found = {}
+        for root, _, files in os.walk(self.folder):
+            for name in sorted(files):
+                suffix = Path(name).suffix.lower()
+                kind = ('workbooks' if suffix in WORKBOOK_SUFFIXES else 'pictures' if suffix in PICTURE_SUFFIXES
+                        else 'pull_tests' if suffix in PULL_TEST_SUFFIXES else None)
+                if kind is None or name.startswith(('.', '~$')):
+                    continue
+                found.setdefault(root, {'workbooks': [], 'pictures': [], 'pull_tests': []})[kind].append(os.path.join(root, name))
+        return found
+
+    def _pair(self, template, sn, folder_files):
+        ''' Returns (pictures, pull tests) in the folder of a workbook that belong to component `sn`.
+        '''
+        pictures = [p for p in folder_files['pictures'] if _belongs_to(p, sn)]
+        pull_tests = [p for p in folder_files['pull_tests'] if _belongs_to(p, sn)] if template == 'module' else []
+        return pictures, pull_tests
+
+    def _is_pending(self, workbook, folder_files, upload):
+        ''' True if workbook is new or changed, its photos or pull tests changed, or it still has to be uploaded.
+        '''
+        entry = self.manifest.get(workbook)
+        if entry is None or entry['signature'] != _signature(workbook):
+            return True
+        if entry['status'] == 'unknown' or (entry['status'] == 'failed' and entry.get('component') is None):
+            return False  # retried once the workbook changes
+        if upload and entry['status'] == 'converted':
+            return True
+        pictures, pull_tests = self._pair(entry['template'], entry['component'], folder_files)
+        return entry['inputs'] != {f: _signature(f) for f in pictures + pull_tests}
+
+    def _upload(self, template, jsons, pictures):
+        if template == 'module':
+            from upload_module_data import upload_module_data
+            assembly = [p for p in pictures if not _BONDED.search(Path(p).stem)]
+            bonded = [p for p in pictures if _BONDED.search(Path(p).stem)]
+            upload_module_data(module_picture_after_assembly=assembly[0] if assembly else None,
+                               module_picture_after_wirebonding=bonded[0] if bonded else None,
+                               max_picture_bytes=self.max_picture_bytes, **jsons)
+        else:
+            sides = sorted(pictures, key=lambda p: bool(_BACKSIDE.search(Path(p).stem)))[:2]  # frontside, backside
+            if template == 'bare_module':
+                from upload_bare_module_data import upload_bare_module_data
+                upload_bare_module_data(bare_module_vi_pictures=sides or None, max_picture_bytes=self.max_picture_bytes, **jsons)
+            else:
+                from upload_flex_data import upload_flex_data
+                upload_flex_data(flex_vi_pictures=sides or None, max_picture_bytes=self.max_picture_bytes, **jsons)
+
+    def run(self, upload=True, min_age=0.0):
+        ''' Converts all new or changed workbooks in parallel and uploads them (unless `upload` is False).
+            Folders with files modified less than `min_age` seconds ago (possibly still being written) are
+            left for a later run and listed in `deferred`. Returns {workbook: manifest entry} of the processed workbooks.
+        '''
+        found = self.discover()
+        if min_age > 0:
+            now = time.time()
+            young = [folder for folder, files in found.items()
+                     if any(now - os.stat(f).st_mtime < min_age for f in sum(files.values(), []))]
+            self.deferred = sorted(f for folder in young for f in found.pop(folder)['workbooks'])
+        else:
+            self.deferred = []
+        folder_of = {f: folder for folder, files in found.items() for f in files['workbooks']}
+        workbooks = [f for f in sorted(folder_of) if self._is_pending(f, found[folder_of[f]], upload)]
+        if workbooks or self.deferred:
+            self.log.info('{0} workbooks found, {1} new or changed, {2} deferred'.format(
+                len(folder_of) + len(self.deferred), len(workbooks), len(self.deferred)))
+
+        processed = {}
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(_convert_workbook, workbook) for workbook in workbooks]
+            for workbook, future in zip(workbooks, futures):
+                try:
+                    template, sn, jsons = future.result()
+                except Exception as e:
+                    self.log.error('Conversion of {0} failed: {1}'.format(workbook, e))
+                    self.manifest[workbook] = processed[workbook] = {'signature': _signature(workbook), 'status': 'failed', 'error': str(e)}
+                    continue
+                entry = {'signature': _signature(workbook), 'template': template, 'component': sn}
+                if template is None:
+                    self.log.warning('{0}: no matching spreadsheet template, skipped'.format(workbook))
+                    entry['status'] = 'unknown'
+                    self.manifest[workbook] = processed[workbook] = entry
+                    continue
+                pictures, pull_tests = self._pair(template, sn, found[folder_of[workbook]])
+                entry['inputs'] = {f: _signature(f) for f in pictures + pull_tests}
+                if pull_tests:
+                    from upload_module_data import convert_module_pull_data
+                    try:
+                        jsons['module_pull_data_json'] = convert_module_pull_data(pull_tests[0], jsons['module_vi_assembly_data_json'])
+                    except Exception as e:
+                        self.log.error('Conversion of {0} failed: {1}'.format(pull_tests[0], e))
+                        self.manifest[workbook] = processed[workbook] = dict(entry, status='failed', error=str(e))
+                        continue
+                entry.update(jsons=jsons, pictures=pictures, pull_tests=pull_tests, status='converted')
+                self.manifest[workbook] = processed[workbook] = entry
+                self._save_manifest()
+                self.log.info('{0}: {1} {2}, {3} tests, {4} pictures, {5} pull tests'.format(
+                    Path(workbook).name, template, sn, len(jsons), len(pictures), len(pull_tests)))
+
+        if upload:
+            for workbook, entry in processed.items():
+                if entry['status'] != 'converted':
+                    continue
+                try:
+                    self._upload(entry['template'], entry['jsons'], entry['pictures'])
+                except Exception as e:
+                    self.log.error('Upload of {0} ({1}) failed: {2}'.format(entry['component'], workbook, e))
+                    continue
+                entry['status'] = 'done'
+                self._save_manifest()
+        self._save_manifest()
+        return processed
+
+
+if __name__ == '__main__':
+    from pdb_logging import setup_logging
+
+    parser = argparse.ArgumentParser(description='Convert and upload all QC workbooks, VI photos and pull tests below a folder')
+    parser.add_argument('folder', help='Folder with the QC files of a production lot')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--manifest', default=None, help='Manifest file (default: {0} in the folder)'.format(MANIFEST_FILE))
+    parser.add_argument('--no-upload', action='store_true', help='Only convert, do not upload')
+    parser.add_argument('--max-picture-bytes', type=int, default=None, help='Upload larger pictures as downscaled copy')
+    args = parser.parse_args()
+
+    setup_logging('BatchIngest')
+    BatchIngest(args.folder, manifest_file=args.manifest, max_workers=args.jobs,
+                max_picture_bytes=args.max_picture_bytes).run(upload=not args.no_upload)
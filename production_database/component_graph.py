@@ -0,0 +1,123 @@
+'''
+In-memory index of a component hierarchy (module -> bare module / PCB -> sensor tile / FE chips).
+'''
+
+
+def _related_sns(relations, component_type=None):
+    ''' Returns S/Ns of `children` or `parents` entries of a component, optionally only of given type.
+    '''
+    return [r['component']['serialNumber'] for r in relations
+            if r.get('component') and (component_type is None or r['componentType']['code'] == component_type)]
+
+
+class ComponentGraph(object):
+    '''
+    Component hierarchy of a module, fetched once level by level and indexed by S/N and component type.
+    '''
+
+    def __init__(self, itk_prodDB, from_mirror=False):
+        self.itk_prodDB = itk_prodDB
+        self.from_mirror = from_mirror  # take mirrored components from the local mirror of an ITkProdDB
+        self.nodes = {}  # S/N -> getComponent response
+        self.top_sn = None  # S/N of the top-most assembly (module, or bare module if not assembled)
+
+    def _missing(self, sns):
+        return [sn for sn in dict.fromkeys(sns) if sn not in self.nodes]
+
+    def _fetch(self, sns):
+        sns = self._missing(sns)
+        self.nodes.update(self.itk_prodDB.get_components(sns, from_mirror=self.from_mirror))
+        return sns
+
+    async def _fetch_async(self, sns):
+        sns = self._missing(sns)
+        self.nodes.update(await self.itk_prodDB.get_components(sns))
+        return sns
+
+    def _levels(self, component_sn, depth, component_types):
+        ''' Yields the S/Ns to fetch next: the parents of `component_sn` up to its module one by one,
+            then the children level by level. Every level has to be fetched before the next one is yielded.
+        '''
+        yield [component_sn]
+        sn = component_sn
+        while self.component_type(sn) != 'MODULE':
+            parent_sns = self.parents(sn, 'MODULE') or self.parents(sn, 'BARE_MODULE')
+            if not parent_sns:
+                break
+            sn = parent_sns[0]
+            yield [sn]
+        self.top_sn = sn
+
+        level = [self.top_sn]
+        for _ in range(depth):
+            level = [child for parent in level for child in self.children(parent)
+                     if component_types is None or self._child_type(parent, child) in component_types]
+            if not level:
+                break
+            yield level
+
+    def prefetch(self, component_sn, depth=2, component_types=None):
+        ''' Fetches the module `component_sn` belongs to and its children down to `depth` levels.
+            All components of one level are fetched concurrently. If `component_types` is given,
+            only children of these types are fetched.
+        '''
+        for sns in self._levels(component_sn, depth, component_types):
+            self._fetch(sns)
+        return self
+
+    async def prefetch_async(self, component_sn, depth=2, component_types=None):
+        ''' Same as prefetch for an AsyncITkProdDB.
+        '''
+        for sns in self._levels(component_sn, depth, component_types):
+            await self._fetch_async(sns)
+        return self
+
+    def _child_type(self, parent_sn, child_sn):
+        for c in self.nodes[parent_sn]['children']:
+            if c.get('component') and c['component']['serialNumber'] == child_sn:
+                return c['componentType']['code']
+
+    def get(self, sn):
+        return self.nodes[sn]
+
+    def component_type(self, sn):
+        return self.nodes[sn]['componentType']['code']
+
+    def of_type(self, component_type):
+        ''' Returns S/Ns of all fetched components of given type.
+        '''
+        return [sn for sn, c in self.nodes.items() if c['componentType']['code'] == component_type]
+
+    def children(self, sn, component_type=None):
+        return _related_sns(self.nodes[sn]['children'], component_type)
+
+    def parents(self, sn, component_type=None):
+        return _related_sns(self.nodes[sn]['parents'], component_type)
+
+    def child(self, sn, component_type):
+        ''' Returns S/N of first child of given type, None if there is none.
+        '''
+        children = self.children(sn, component_type)
+        return children[0] if children else None
+
+    @property
+    def module_sn(self):
+        return self.top_sn if self.component_type(self.top_sn) == 'MODULE' else None
+
+    @property
+    def bare_module_sn(self):
+        if self.component_type(self.top_sn) == 'BARE_MODULE':
+            return self.top_sn
+        return self.child(self.top_sn, 'BARE_MODULE')
+
+    @property
+    def sensor_sn(self):
+        bare_module_sn = self.bare_module_sn
+        return self.child(bare_module_sn, 'SENSOR_TILE') if bare_module_sn is not None else None
+
+    @property
+    def chip_sns(self):
+        ''' ATLAS S/Ns of the FE chips of the bare module.
+        '''
+        bare_module_sn = self.bare_module_sn
+        return self.children(bare_module_sn, 'FE_CHIP') if bare_module_sn is not None else []
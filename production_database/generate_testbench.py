@@ -32,7 +32,7 @@ chip_testbench_dict = [
 {'chip_id': 15, 'receiver': 'rx0', 'send_data': "tcp://127.0.0.1:5500"}
 ]
 
-def generate_testbench(module_name, ATLAS_SN, module_slot=1, outdir=None, outdir_subfolder=True, outdir_suffix='_QC', powersupply={}):
+def generate_testbench(module_name, ATLAS_SN, module_slot=1, outdir=None, outdir_subfolder=True, outdir_suffix='_QC', powersupply={}, mirror_file=None):
     logging.info(f'Opening testbench at: {TESTBENCH_TEMPLATE}')
     with open(os.path.expanduser(TESTBENCH_TEMPLATE)) as f:
         testbench = yaml.full_load(f)
@@ -43,9 +43,9 @@ def generate_testbench(module_name, ATLAS_SN, module_slot=1, outdir=None, outdir
         if not outdir in [None, '', 'None']:
             testbench['general']['output_directory'] = os.path.join(outdir, module_name + outdir_suffix)
 
-    with ITkProdDB() as itk_prodDB:
-        # Example 1: Get Iref trim bits for different modules from PDB
-        module_id, chips = itk_prodDB.get_chip_sns_of_module(ATLAS_SN)
+    with ITkProdDB(mirror_file=mirror_file) as itk_prodDB:
+        # Example 1: Get Iref trim bits for different modules from PDB (mirrored components from mirror_file, see pdb_mirror.py)
+        module_id, chips = itk_prodDB.get_chip_sns_of_module(ATLAS_SN, from_mirror=mirror_file is not None)
     if not testbench['modules']:
         testbench['modules'] = {}
     testbench['modules'][module_name] = module_testbench
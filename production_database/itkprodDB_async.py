@@ -0,0 +1,367 @@
+'''
+asyncio variant of the ITk production database interface.
+
+AsyncITkProdDB has the lookup and upload methods of ITkProdDB as coroutines and sends the
+requests with httpx (optional dependency: pip install httpx), so that hundreds of lookups can
+run concurrently in one event loop without threads:
+
+    async with AsyncITkProdDB() as itk_prodDB:
+        modules = await asyncio.gather(*[itk_prodDB.get_module(sn) for sn in sns])
+
+Authentication is taken over from the synchronous itkdb client of the process (see pdb_session.py),
+so the token is shared and refreshed in one place.
+'''
+import asyncio
+import json
+import logging
+import time
+from pathlib import Path
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+import itkdb
+
+from component_graph import ComponentGraph
+from itkprodDB_interface import BULK_CHUNK_SIZE, chunked, sensor_iv_link
+from pdb_cache import ResponseCache
+from pdb_logging import setup_logging, log_payload
+from pdb_metrics import CallMetrics, status_of_exception
+from pdb_rate_limit import get_rate_limiter, retry_after_of_exception, THROTTLE_STATUS
+from pdb_session import get_client
+from run_fingerprint import duplicate_candidates, find_duplicate, with_run_number
+from qc_criteria import log_missing_tests, missing_tests_status
+from stage_graph import check_stage_changed, plan_stage_change, poll_delays, stage_of_response, UPLOAD_STAGES
+from test_run_index import TestRunIndex
+
+
+class AsyncITkProdDB(object):
+    '''
+    ITk production database interface for asyncio applications.
+    '''
+
+    def __init__(self, debug=False, max_concurrency=32, cache_ttls=None, client=None, trace_file=None, timeout=30.0,
+                 rate_limiter=None, max_retries=3):
+        '''
+            max_concurrency: maximum number of PDB requests in flight (further limited by the rate limiter)
+            cache_ttls: optional dict of per-endpoint time-to-live (in s) overriding the defaults
+            client: synchronous client providing URL and token, defaults to the process-wide session
+            trace_file: optional JSONL file to which every PDB request is written
+            timeout: timeout of a single request in s
+            rate_limiter: RateLimiter of the requests, defaults to the process-wide one shared with ITkProdDB
+            max_retries: maximum number of retries of throttled requests (429, 5xx)
+        '''
+        if httpx is None:
+            raise ImportError('AsyncITkProdDB requires httpx: pip install httpx')
+        loglevel = logging.DEBUG if debug else logging.INFO
+        self.log = setup_logging('ITkProdDB', loglevel)
+
+        self.client = client if client is not None else get_client()
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_rate_limiter()
+        self.max_retries = max_retries
+        self.bulk_chunk_size = BULK_CHUNK_SIZE
+        self._bulk_supported = True
+        self.metrics = CallMetrics(trace_file=trace_file)
+        self.cache = ResponseCache(ttls=cache_ttls)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._upload_locks = {}  # per component, serialises duplicate check and upload
+        self._http = None
+
+    async def __aenter__(self):
+        self._http = httpx.AsyncClient(base_url=self.client.prefix_url, timeout=self.timeout,
+                                       limits=httpx.Limits(max_connections=self.max_concurrency))
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._http.aclose()
+        self._http = None
+        self.cache.close()
+        self.log.info('PDB requests of this session:\n' + self.metrics.summary())
+        self.metrics.close()
+
+    async def _headers(self):
+        user = self.client.user
+        if user.is_expired():  # (re-)authenticate with the synchronous client, token is shared
+            await asyncio.to_thread(user.authenticate)
+        return {'Authorization': 'Bearer {0}'.format(user.bearer)}
+
+    async def _request(self, method, endpoint, component, json_data):
+        ''' Sends request and records its latency, size and status. Returns the JSON response,
+            list responses are unwrapped (and all pages collected) like by itkdb.
+        '''
+        request_bytes = len(json.dumps(json_data, default=str))
+        retry_status = THROTTLE_STATUS if method == 'GET' else [429, 503]
+        retries = 0
+        async with self._semaphore:
+            wait = 0.0  # time spent in the rate limiter, not part of the request latency
+            while True:
+                t_wait = self.metrics.timer()
+                await self.rate_limiter.acquire_async()
+                start = self.metrics.timer()
+                wait += start - t_wait
+                t_request = time.perf_counter()
+                try:
+                    response = await self._http.request(method, endpoint, json=json_data, headers=await self._headers())
+                    response.raise_for_status()
+                    ret = response.json() if response.content else {}
+                except Exception as e:
+                    status = status_of_exception(e)
+                    self.rate_limiter.release(endpoint, status)
+                    if status in retry_status and retries < self.max_retries:
+                        retries += 1
+                        delay = self.rate_limiter.retry_delay(retries, retry_after_of_exception(e))
+                        self.log.warning('{0} of {1} failed with {2}, retry {3} in {4:.1f} s'.format(endpoint, component, status, retries, delay))
+                        await asyncio.sleep(delay)
+                        continue
+                    self.metrics.record(endpoint, component=component, start=start, request_bytes=request_bytes, status=status, retries=retries, wait=wait)
+                    raise
+                self.rate_limiter.release(endpoint, response.status_code, time.perf_counter() - t_request)
+                break
+            self.metrics.record(endpoint, component=component, start=start, request_bytes=request_bytes,
+                                response_bytes=len(response.content), status=response.status_code, retries=retries, wait=wait)
+        ret.pop('uuAppErrorMap', None)
+        if 'itemList' not in ret:
+            return ret
+
+        items = ret['itemList']
+        page_info = ret.get('pageInfo')
+        if page_info and (page_info['pageIndex'] + 1) * page_info['pageSize'] < page_info['total']:
+            next_page = dict(json_data, pageInfo={'pageIndex': page_info['pageIndex'] + 1, 'pageSize': page_info['pageSize']})
+            items.extend(await self._request(method, endpoint, component, next_page))
+        return items
+
+    async def _get(self, endpoint, json):
+        ''' Read-through cached GET request to the PDB.
+        '''
+        component = json.get('component', json.get('testRun'))
+        ret = self.cache.get(endpoint, json)
+        if ret is not None:
+            self.metrics.record(endpoint, component=component, cached=True)
+            return ret
+        ret = await self._request('GET', endpoint, component, json)
+        self.cache.put(endpoint, json, ret, component=component)
+        return ret
+
+    async def _post(self, endpoint, json):
+        ''' POST request to the PDB. Cached responses of the modified component are invalidated.
+        '''
+        ret = await self._request('POST', endpoint, json.get('component'), json)
+        if endpoint in ['setComponentStage', 'uploadTestRunResults']:
+            self.cache.invalidate(json['component'])
+        return ret
+
+    async def get_user(self):
+        return await self._get("getUser", json={"userIdentity": self.client.user.identity})
+
+    async def get_components(self, component_sns):
+        ''' Returns {S/N: getComponent response} of many components, see ITkProdDB.get_components.
+        '''
+        component_sns = list(dict.fromkeys(component_sns))
+        components = self.cache.get_components(component_sns)
+        for sn in components:
+            self.metrics.record("getComponent", component=sn, cached=True)
+        missing = [sn for sn in component_sns if sn not in components]
+
+        if missing and self._bulk_supported:
+            chunks = chunked(missing, self.bulk_chunk_size)
+            try:
+                for chunk in await asyncio.gather(*[self._request('GET', "getComponentBulk", None, {"component": c}) for c in chunks]):
+                    components.update(self.cache.put_components(chunk))
+            except Exception as e:
+                self.log.warning('Bulk component request failed ({0}), fetching components one by one'.format(e))
+                self._bulk_supported = False
+            missing = [sn for sn in component_sns if sn not in components]
+
+        fetched = await asyncio.gather(*[self._get("getComponent", json={"component": sn}) for sn in missing])
+        components.update(zip(missing, fetched))
+        return {sn: components[sn] for sn in component_sns}
+
+    async def _get_test_runs(self, test_run_ids):
+        return await asyncio.gather(*[self._get("getTestRun", json={"testRun": test_run_id}) for test_run_id in test_run_ids])
+
+    async def get_irefs_of_module(self, bare_module_sns):
+        ''' Returns IREF Trim bits of all FE chips of given bare modules as {bare_module_sn: {chip_sn_atlas: iref_trim}}.
+        '''
+        self.log.info('Getting Iref trims of bare modules: {0}...'.format(', '.join(bare_module_sns)))
+        bare_modules = await self.get_components(bare_module_sns)
+        chips = [(bare_module_sn, c['component']['serialNumber']) for bare_module_sn in bare_module_sns
+                 for c in bare_modules[bare_module_sn]['children'] if c['componentType']['code'] == 'FE_CHIP']
+        chip_components = await self.get_components([chip_sn for _, chip_sn in chips])
+        test_runs = await self._get_test_runs([chip_components[chip_sn]['tests'][0]['testRuns'][0]['id'] for _, chip_sn in chips])
+
+        irefs = {bare_module_sn: {} for bare_module_sn in bare_module_sns}
+        for (bare_module_sn, chip_sn_atlas), test_run in zip(chips, test_runs):
+            iref_trim = next((r.get('value', -1) for r in test_run['results'] if r['code'] == 'IREF_TRIM'), None)
+            self.log.info('{0}: {1}, {2}, IREF TRIM bit: {3}'.format(bare_module_sn, chip_sn_atlas, hex(int(chip_sn_atlas[-7:])), iref_trim))
+            irefs[bare_module_sn][chip_sn_atlas] = iref_trim
+        return irefs
+
+    async def get_component_graph(self, component_sn, depth=2, component_types=None):
+        ''' Returns ComponentGraph of the module `component_sn` belongs to, fetched level by level.
+        '''
+        return await ComponentGraph(self).prefetch_async(component_sn, depth=depth, component_types=component_types)
+
+    async def get_module(self, component_sn):
+        graph = await self.get_component_graph(component_sn, depth=0)
+        if graph.component_type(component_sn) == 'MODULE':
+            return component_sn
+
+        self.log.warning(f"Component {graph.component_type(component_sn)} with SN {component_sn} is not a module! Searching for parents...")
+        if graph.module_sn is None:
+            self.log.warning(f"Found no parent module for {graph.component_type(graph.top_sn)} with SN {graph.top_sn}")
+        else:
+            self.log.info(f"Parent module found: MODULE with SN {graph.module_sn}")
+        return graph.top_sn
+
+    async def get_chip_sns_of_module(self, module_sn):
+        graph = await self.get_component_graph(module_sn, depth=1, component_types=['BARE_MODULE'])
+        module_sn = graph.top_sn
+        self.log.info(f"Getting FE chips associated to {graph.component_type(module_sn)} with SN {module_sn}...")
+        if graph.module_sn is None:
+            self.log.warning(f'Component {module_sn} does not have an assembled module parent! Using bare module...')
+        return module_sn, [hex(int(chip_sn_atlas[-7:])) for chip_sn_atlas in graph.chip_sns]
+
+    async def get_missing_tests(self, module_sn):
+        ''' Returns stages and required but missing tests of module and its bare module, see qc_criteria.missing_tests_status.
+        '''
+        graph = await self.get_component_graph(module_sn, depth=1, component_types=['BARE_MODULE'])
+        if graph.bare_module_sn is None:
+            self.log.warning(f'Module {module_sn} has no bare module child! Checking module tests only...')
+            return missing_tests_status(module_sn, graph.get(module_sn), None, None)
+        return missing_tests_status(module_sn, graph.get(module_sn), graph.bare_module_sn, graph.get(graph.bare_module_sn))
+
+    async def check_uploaded_tests(self, module_sn):
+        status = await self.get_missing_tests(module_sn)
+        log_missing_tests(self.log, status)
+        return status
+
+    async def _get_component_stage(self, component_code):
+        ret = await self._get("getComponent", json={"component": component_code})
+        return ret['currentStage']['code']
+
+    async def _wait_for_stage(self, component_code, component_stage, response=None, timeout=30.0):
+        ''' Waits until stage change of component is applied, see ITkProdDB._wait_for_stage.
+        '''
+        if stage_of_response(response) == component_stage:
+            return component_stage
+
+        current_stage = await self._get_component_stage(component_code=component_code)
+        for delay in poll_delays(timeout):
+            if current_stage == component_stage:
+                break
+            await asyncio.sleep(delay)
+            self.cache.invalidate(component_code)  # force fresh stage on next poll
+            current_stage = await self._get_component_stage(component_code=component_code)
+        return current_stage
+
+    async def _change_component_stage(self, component_code, component_type, target_stage):
+        ''' Moves component along the shortest path of its stage graph to `target_stage`. Raises RuntimeError if the
+            target stage cannot be reached, so that no data is uploaded at a wrong stage.
+        '''
+        current_stage = await self._get_component_stage(component_code=component_code)
+        if current_stage == target_stage:
+            return current_stage
+
+        for stage in plan_stage_change(component_type, component_code, current_stage, target_stage):
+            stage_old = current_stage
+            ret = await self._post("setComponentStage", json={'component': component_code, 'stage': stage})
+            current_stage = await self._wait_for_stage(component_code=component_code, component_stage=stage, response=ret)
+            self.log.debug('Changed stage of {0} from {1} to {2}.'.format(component_type, stage_old, current_stage))
+            check_stage_changed(component_type, component_code, stage, current_stage)
+        return current_stage
+
+    async def upload_iv_curve(self, module_sn=None, iv_data=None):
+        ''' Upload IV curve data to the sensor tile and link it to the bare module, see ITkProdDB.upload_iv_curve.
+        '''
+        sensor_sn = iv_data['component']
+        await self._change_component_stage(component_code=sensor_sn, component_type='SENSOR_TILE', target_stage=UPLOAD_STAGES['SENSOR_TILE'])
+        ret = await self.upload_test_run(iv_data)
+        await self._change_component_stage(component_code=module_sn, component_type='BARE_MODULE', target_stage=UPLOAD_STAGES['BARE_MODULE'])
+
+        self.cache.invalidate(sensor_sn)  # a cached sensor tile can miss the test run just uploaded
+        test_run = TestRunIndex(await self._get("getComponent", json={"component": sensor_sn})).get(ret['testRun']['id'])
+        if test_run is None:
+            raise RuntimeError('Test run {0} of sensor tile {1} not found'.format(ret['testRun']['id'], sensor_sn))
+        link_to_bare_module_json = sensor_iv_link(module_sn, test_run)
+        log_payload(self.log, 'Uploading', link_to_bare_module_json)
+        return await self.upload_test_run(link_to_bare_module_json)
+
+    async def find_duplicate_test_run(self, data):
+        ''' Returns ID of an existing test run identical to payload `data`, see ITkProdDB.find_duplicate_test_run.
+        '''
+        component = await self._get("getComponent", json={"component": data['component']})
+        return find_duplicate(data, await self._get_test_runs(duplicate_candidates(component, data)))
+
+    async def upload_test_run(self, data):
+        ''' Uploads test run `data` unless an identical test run is already in the PDB, assigning the next free
+            run number if it has none, see ITkProdDB.upload_test_run.
+        '''
+        async with self._upload_locks.setdefault(data['component'], asyncio.Lock()):
+            duplicate_id = await self.find_duplicate_test_run(data)
+            if duplicate_id is not None:
+                self.log.info('{0} of {1} is already uploaded as test run {2}, skipping'.format(data['testType'], data['component'], duplicate_id))
+                return {'testRun': {'id': duplicate_id}}
+            data = with_run_number(await self._get("getComponent", json={"component": data['component']}), data)
+            return await self._post('uploadTestRunResults', json=data)
+
+    async def _upload_test_run(self, data, filename=None, filename_data=None):
+        log_payload(self.log, 'Uploading', data)
+        ret = await self.upload_test_run(data)
+        if filename is not None:
+            filename_data['testRun'] = str(ret['testRun']['id'])
+            await self.upload_attachment_to_eos(filename=filename, data=filename_data)
+        return ret
+
+    async def upload_flex_data(self, flex_data, filename=None, filename_data=None):
+        await self._change_component_stage(component_code=flex_data['component'], component_type='PCB', target_stage=UPLOAD_STAGES['PCB'])
+        return await self._upload_test_run(flex_data, filename, filename_data)
+
+    async def upload_bare_module_data(self, bare_module_data, filename=None, filename_data=None):
+        await self._change_component_stage(component_code=bare_module_data['component'], component_type='BARE_MODULE',
+                                           target_stage=UPLOAD_STAGES['BARE_MODULE'])
+        return await self._upload_test_run(bare_module_data, filename, filename_data)
+
+    async def upload_module_data(self, module_data, filename=None, filename_data=None):
+        if module_data['testType'] == 'WIREBOND_PULL_TEST':
+            # FIXME: also change bare module stage
+            await self._change_component_stage(component_code=module_data['component'], component_type='MODULE', target_stage='MODULE/WIREBONDING')
+        return await self._upload_test_run(module_data, filename, filename_data)
+
+    async def upload_attachment_to_eos(self, filename=None, data=None):
+        ''' Uploads attachment with the synchronous client in a worker thread, since the
+            EOS upload (token request, upload, registration) is implemented by itkdb.
+        '''
+        def upload():
+            with Path(filename).open("rb") as fpointer:
+                files = {"data": itkdb.utils.get_file_components({"data": fpointer})}
+                return self.client.post("createTestRunAttachment", data=data, files=files)
+
+        async with self._semaphore:
+            t_wait = self.metrics.timer()
+            await self.rate_limiter.acquire_async()
+            start = self.metrics.timer()
+            try:
+                ret = await asyncio.to_thread(upload)
+            except Exception as e:
+                self.rate_limiter.release("createTestRunAttachment", status_of_exception(e))
+                self.metrics.record("createTestRunAttachment", component=data['testRun'], start=start, status=status_of_exception(e), wait=start - t_wait)
+                raise
+            self.rate_limiter.release("createTestRunAttachment", 200)
+            self.metrics.record("createTestRunAttachment", component=data['testRun'], start=start,
+                                request_bytes=Path(filename).stat().st_size, wait=start - t_wait)
+        self.cache.invalidate(data['testRun'])
+        return ret
+
+
+if __name__ == '__main__':
+    async def main():
+        async with AsyncITkProdDB() as itk_prodDB:
+            # Get modules and FE chips of many components concurrently
+            sns = ['20UPGB42000111', '20UPGB42000112', '20UPGB42000113', '20UPGB42000114', '20UPGB42000115']
+            print(await asyncio.gather(*[itk_prodDB.get_chip_sns_of_module(sn) for sn in sns]))
+
+    asyncio.run(main())
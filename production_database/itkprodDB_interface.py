@@ -1,12 +1,47 @@
 import json
 import logging
-import os
 import time
-import coloredlogs
-import sys
 from pathlib import Path
 
 import itkdb
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from attachment_uploader import AttachmentUploader
+from component_graph import ComponentGraph
+from pdb_cache import ResponseCache
+from pdb_logging import setup_logging, log_payload
+from pdb_metrics import CallMetrics, status_of_exception
+from pdb_mirror import ComponentMirror
+from pdb_rate_limit import get_rate_limiter, retry_after_of_exception, THROTTLE_STATUS
+from pdb_session import get_client
+from run_fingerprint import duplicate_candidates, find_duplicate, with_run_number
+from qc_criteria import CRITERIA, UNVALIDATED, evaluate_criteria, failed_checks, log_missing_tests, missing_tests_status
+from stage_graph import check_stage_changed, plan_stage_change, poll_delays, stage_of_response, UPLOAD_STAGES
+from test_run_index import TestRunIndex
+
+# Maximum number of components requested with one getComponentBulk request
+BULK_CHUNK_SIZE = 100
+
+
+def chunked(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def sensor_iv_link(bare_module_sn, test_run):
+    ''' Returns BARE_MODULE_SENSOR_IV payload of `bare_module_sn` linking sensor IV test run `test_run`
+        (getTestRun response or test run summary).
+    '''
+    return {
+        "component": bare_module_sn,
+        "testType": "BARE_MODULE_SENSOR_IV",
+        "institution": test_run['institution']['code'],
+        "date": test_run['stateTs'],
+        "runNumber": test_run['runNumber'],
+        "passed": test_run['passed'],
+        "problems": test_run['problems'],
+        "results": {"LINK_TO_SENSOR_IV_TEST": test_run['id']}
+    }
 
 
 class ITkProdDB(object):
@@ -14,32 +49,205 @@ class ITkProdDB(object):
     Main class defininf the ITk Production data base interface.
     '''
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, cache_file=None, cache_ttls=None, max_workers=8, client=None, trace_file=None, rate_limiter=None, max_retries=3,
+                 mirror_file=None):
         '''
             Init ITk production database
+
+            cache_file: optional SQLite file to persist cached PDB responses between runs
+            cache_ttls: optional dict of per-endpoint time-to-live (in s) overriding the defaults
+            max_workers: maximum number of concurrent PDB requests for fan-out queries
+            client: client used for PDB requests, defaults to the process-wide authenticated session
+            trace_file: optional JSONL file to which every PDB request is written
+            rate_limiter: RateLimiter of the requests, defaults to the process-wide one
+            max_retries: maximum number of retries of throttled requests (429, 5xx)
+            mirror_file: optional local SQLite mirror of institute components (see pdb_mirror.py) for the get_mirrored_* queries
+                         and the read-only queries called with from_mirror=True
         '''
         # Logger
-        loglevel = logging.DEBUG if debug else logging.DEBUG
-        fmt = '%(asctime)s - [%(name)-15s] - %(levelname)-7s %(message)s'
-        self.log = logging.getLogger('ITkProdDB')
-        self.log.setLevel(loglevel)
-        coloredlogs.install(fmt=fmt, milliseconds=False, loglevel=loglevel)
-        self.fh = logging.FileHandler('ITkProdDB.log')
-        self.fh.setLevel(loglevel)
-        self.fh.setFormatter(logging.Formatter(fmt))
-        self.log.addHandler(self.fh)
-
-        self.client = itkdb.Client(use_eos=True)
-        self.client.user._jwt_options["leeway"] = 50 # add more leeway
-        self.client.user.authenticate()
-        user = self.client.get("getUser", json={"userIdentity": self.client.user.identity})
-        self.log.info('ITk production DB initialised. User {0}'.format(user))
+        loglevel = logging.DEBUG if debug else logging.INFO
+        self.log = setup_logging('ITkProdDB', loglevel)
+
+        self.max_workers = max_workers
+        self.bulk_chunk_size = BULK_CHUNK_SIZE
+        self._bulk_supported = True  # set to False once the PDB refuses bulk requests
+        self.metrics = CallMetrics(trace_file=trace_file)
+        self.cache = ResponseCache(ttls=cache_ttls, filename=cache_file)
+        self.client = client if client is not None else get_client()  # authenticates lazily with first request
+        self.rate_limiter = rate_limiter if rate_limiter is not None else get_rate_limiter()
+        self.max_retries = max_retries
+        self.mirror = ComponentMirror(mirror_file) if mirror_file is not None else None
+        self._upload_locks = {}  # per component, serialises duplicate check and upload
+        self._upload_locks_lock = threading.Lock()
+        self.log.info('ITk production DB initialised.')
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.log.removeHandler(self.fh)
+        self.cache.close()
+        if self.mirror is not None:
+            self.mirror.close()
+        self.log.info('PDB requests of this session:\n' + self.metrics.summary())
+        self.metrics.close()
+
+    def get_user(self):
+        ''' Returns PDB user of the current session.
+        '''
+        return self._get("getUser", json={"userIdentity": self.client.user.identity})
+
+    def _get(self, endpoint, json):
+        ''' Read-through cached GET request to the PDB.
+        '''
+        component = json.get('component', json.get('testRun'))
+        ret = self.cache.get(endpoint, json)
+        if ret is not None:
+            self.metrics.record(endpoint, component=component, cached=True)
+            return ret
+        ret = self._request(self.client.get, endpoint, component, json=json)
+        self.cache.put(endpoint, json, ret, component=component)
+        return ret
+
+    def _post(self, endpoint, **kwargs):
+        ''' POST request to the PDB. Cached responses of the modified component (or test run) are invalidated.
+        '''
+        payload = kwargs.get('json', kwargs.get('data'))
+        ret = self._request(self.client.post, endpoint, payload.get('component', payload.get('testRun')), **kwargs)
+        if endpoint in ['setComponentStage', 'uploadTestRunResults']:
+            self.cache.invalidate(kwargs['json']['component'])
+        elif endpoint == 'createTestRunAttachment':
+            self.cache.invalidate(kwargs['data']['testRun'])
+        return ret
+
+    def _request(self, method, endpoint, component, **kwargs):
+        ''' Sends request with `method` of the client through the rate limiter and records its latency, size and status.
+            Throttled requests (429, 5xx) are retried with backoff. POST requests are only retried if the server
+            did not process them (429, 503).
+        '''
+        request_bytes = len(json.dumps(kwargs.get('json', kwargs.get('data')), default=str))
+        retry_status = THROTTLE_STATUS if method == self.client.get else [429, 503]
+        retries = 0
+        wait = 0.0  # time spent in the rate limiter, not part of the request latency
+        while True:
+            t_wait = self.metrics.timer()
+            self.rate_limiter.acquire()
+            start = self.metrics.timer()
+            wait += start - t_wait
+            t_request = time.perf_counter()
+            try:
+                ret = method(endpoint, **kwargs)
+            except Exception as e:
+                status = status_of_exception(e)
+                self.rate_limiter.release(endpoint, status)
+                if status in retry_status and retries < self.max_retries:
+                    retries += 1
+                    delay = self.rate_limiter.retry_delay(retries, retry_after_of_exception(e))
+                    self.log.warning('{0} of {1} failed with {2}, retry {3} in {4:.1f} s'.format(endpoint, component, status, retries, delay))
+                    time.sleep(delay)
+                    continue
+                self.metrics.record(endpoint, component=component, start=start, request_bytes=request_bytes, status=status, retries=retries, wait=wait)
+                raise
+            self.rate_limiter.release(endpoint, 200, time.perf_counter() - t_request)
+            break
+        self.metrics.record(endpoint, component=component, start=start, request_bytes=request_bytes,
+                            response_bytes=len(json.dumps(ret, default=str)), retries=retries, wait=wait)
+        return ret
+
+    def _map(self, func, items):
+        ''' Calls `func` for every item on a bounded thread pool. Results are returned in order of `items`.
+        '''
+        items = list(items)
+        if len(items) <= 1 or self.max_workers <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+            return list(executor.map(func, items))
+
+    def get_components(self, component_sns, from_mirror=False):
+        ''' Returns {S/N: getComponent response} of many components. Cached components are not requested again,
+            the others are requested with getComponentBulk in chunks of `bulk_chunk_size` (concurrently).
+            If bulk requests are not supported, the components are fetched one by one concurrently.
+            With `from_mirror`, mirrored components are taken from the local mirror (as of its last sync).
+        '''
+        component_sns = list(dict.fromkeys(component_sns))
+        components = self.cache.get_components(component_sns)
+        if from_mirror:
+            mirrored = {sn: self._get_mirror().component(sn) for sn in component_sns if sn not in components}
+            components.update({sn: component for sn, component in mirrored.items() if component is not None})
+        for sn in components:
+            self.metrics.record("getComponent", component=sn, cached=True)
+        missing = [sn for sn in component_sns if sn not in components]
+
+        if missing and self._bulk_supported:
+            try:
+                for chunk in self._map(self._get_component_bulk, chunked(missing, self.bulk_chunk_size)):
+                    components.update(self.cache.put_components(chunk))
+            except Exception as e:
+                self.log.warning('Bulk component request failed ({0}), fetching components one by one'.format(e))
+                self._bulk_supported = False
+            missing = [sn for sn in component_sns if sn not in components]
+
+        # not supported in bulk or not found by S/N (e.g. alternative identifiers)
+        for sn, component in zip(missing, self._map(lambda sn: self._get("getComponent", json={"component": sn}), missing)):
+            components[sn] = component
+        return {sn: components[sn] for sn in component_sns}
+
+    def _get_component_bulk(self, component_sns):
+        return list(self._request(self.client.get, "getComponentBulk", None, json={"component": component_sns}))
+
+    def list_component_summaries(self, component_type=None, institution=None):
+        ''' Returns listComponents entries (S/N, type, stage, stateTs, ...) of all components of given type
+            (default: all types) at `institution` (default: all institutions) with one paged request.
+        '''
+        data = {"project": "P"}
+        if component_type is not None:
+            data["componentType"] = [component_type]
+        if institution is not None:
+            data["currentLocation"] = [institution]
+        return [c for c in self._request(self.client.get, "listComponents", None, json=data) if c.get('serialNumber')]
+
+    def list_components(self, component_type, institution=None):
+        ''' Returns S/Ns of all components of given type (at `institution`, if given) with one paged listComponents request.
+            Use get_components for the full component information.
+        '''
+        return [c['serialNumber'] for c in self.list_component_summaries(component_type, institution)]
+
+    def get_institute_components(self, component_types=('MODULE', 'BARE_MODULE'), institution=None):
+        ''' Returns {S/N: getComponent response} of all components of the given types at `institution`
+            (default: all institutions) with one listComponents request per type and bulk component requests.
+        '''
+        sns = [sn for component_type in component_types for sn in self.list_components(component_type, institution)]
+        return self.get_components(sns)
+
+    def sync_mirror(self, institution, component_types=None, full=False):
+        ''' Updates the local mirror with the components at `institution` that changed since the last sync.
+        '''
+        return self._get_mirror().sync(self, institution, component_types=component_types, full=full)
+
+    def _get_mirror(self):
+        if self.mirror is None:
+            raise RuntimeError('No component mirror configured, initialise ITkProdDB with mirror_file')
+        return self.mirror
+
+    def get_mirrored_component(self, component_sn):
+        ''' Returns getComponent response of `component_sn` from the local mirror (None if not mirrored).
+        '''
+        return self._get_mirror().component(component_sn)
+
+    def find_mirrored_components(self, component_type=None, stage=None):
+        ''' Returns [{sn, type, stage, state_ts}] of mirrored components, optionally of given type and stage.
+        '''
+        return self._get_mirror().components(component_type=component_type, stage=stage)
+
+    def get_mirrored_children(self, component_sn, component_type=None):
+        return self._get_mirror().children(component_sn, component_type)
+
+    def get_mirrored_parents(self, component_sn, component_type=None):
+        return self._get_mirror().parents(component_sn, component_type)
+
+    def get_mirrored_test_runs(self, component_sn, test_type=None):
+        ''' Returns test run summaries of `component_sn` from the local mirror, oldest first.
+        '''
+        return self._get_mirror().test_runs(component_sn, test_type)
 
     def _convert_chip_sn(self, chip_sn):
         ''' Converts chip S/N (0x....) to ATLAS S/N (20PGFC).
@@ -59,285 +267,248 @@ class ITkProdDB(object):
         ''' Returns IREF Trim bit for given chip S/N (ATLAS format)
         '''
 
-        ret = self.client.get("getComponent", json={"component": chip_sn})
+        ret = self._get("getComponent", json={"component": chip_sn})
         test_run_id = ret['tests'][0]['testRuns'][0]["id"]
-        test_ret = self.client.get("getTestRun", json={"testRun": test_run_id})
+        test_ret = self._get("getTestRun", json={"testRun": test_run_id})
 
         return self._get_result_value(results=test_ret['results'], test_item='IREF_TRIM')
 
     def get_irefs_of_module(self, bare_module_sns):
-        for bare_module_sn in bare_module_sns:
-            self.log.info('Getting Iref trims of bare module: {0}...'.format(bare_module_sn))
-            ret = self.client.get("getComponent", json={"component": bare_module_sn})
+        ''' Returns IREF Trim bits of all FE chips of given bare modules as {bare_module_sn: {chip_sn_atlas: iref_trim}}.
+            Bare modules and FE chips are fetched concurrently.
+        '''
+        self.log.info('Getting Iref trims of bare modules: {0}...'.format(', '.join(bare_module_sns)))
+        bare_modules = self._map(lambda sn: self._get("getComponent", json={"component": sn}), bare_module_sns)
+        chips = []
+        for bare_module_sn, ret in zip(bare_module_sns, bare_modules):
             for c in ret['children']:
                 if c['componentType']['code'] == 'FE_CHIP':
-                    chip_sn_atlas = c['component']['serialNumber']
-                    chip_sn = hex(int(chip_sn_atlas[-7:]))
-                    self.log.info('{0}, {1}, IREF TRIM bit: {2}'.format(chip_sn_atlas, chip_sn, self._get_iref_trims_chip(chip_sn=chip_sn_atlas)))
+                    chips.append((bare_module_sn, c['component']['serialNumber']))
+        iref_trims = self._map(lambda chip: self._get_iref_trims_chip(chip_sn=chip[1]), chips)
+
+        irefs = {bare_module_sn: {} for bare_module_sn in bare_module_sns}
+        for (bare_module_sn, chip_sn_atlas), iref_trim in zip(chips, iref_trims):
+            chip_sn = hex(int(chip_sn_atlas[-7:]))
+            self.log.info('{0}: {1}, {2}, IREF TRIM bit: {3}'.format(bare_module_sn, chip_sn_atlas, chip_sn, iref_trim))
+            irefs[bare_module_sn][chip_sn_atlas] = iref_trim
+        return irefs
+
+    def get_component_graph(self, component_sn, depth=2, component_types=None, from_mirror=False):
+        ''' Returns ComponentGraph of the module `component_sn` belongs to, fetched level by level.
+            With `from_mirror`, mirrored components are taken from the local mirror.
+        '''
+        return ComponentGraph(self, from_mirror=from_mirror).prefetch(component_sn, depth=depth, component_types=component_types)
 
     def get_module(self, component_sn):
-        def get_parent_module(component):
-            for p in component['parents']:
-                if p['componentType']['code'] == 'MODULE':
-                    module_sn = p['component']['serialNumber']
-                    self.log.info(f"Parent module found: {p['componentType']['code']} with SN {module_sn}")
-                    return module_sn
-                elif p['componentType']['code'] in ['BARE_MODULE']:
-                    module_sn = p['component']['serialNumber']
-                    self.log.info(f"Parent found: {p['componentType']['code']} with SN {module_sn}")
-                    bm = self.client.get("getComponent", json={"component": module_sn})
-                    return get_parent_module(bm)
-            else:
-                self.log.warning(f"Found no parent module for {component['componentType']['code']} with SN {component['component']['serialNumber']}")
-                return component['component']['serialNumber']
-
-        component = self.client.get("getComponent", json={"component": component_sn})
-
-        if component['componentType']['code'] not in ['MODULE']:
-            self.log.warning(f"Component {component['componentType']['code']} with SN {component_sn} is not a module! Searching for parents...")
-            return get_parent_module(component)
-        else:
+        graph = self.get_component_graph(component_sn, depth=0)
+        if graph.component_type(component_sn) == 'MODULE':
             return component_sn
 
-    def get_chip_sns_of_module(self, module_sn):
-        module_sn = self.get_module(module_sn)
-        module = self.client.get("getComponent", json={"component": module_sn})
-        self.log.info(f"Getting FE chips associated to {module['componentType']['code']} with SN {module_sn}...")
-
-        if not module['componentType']['code'] == 'BARE_MODULE':
-            for bm in module['children']:
-                if bm['componentType']['code'] == 'BARE_MODULE':
-                    ret = self.client.get("getComponent", json={"component": bm['component']['serialNumber']})
-                    break
-            else:
-                ret = module
+        self.log.warning(f"Component {graph.component_type(component_sn)} with SN {component_sn} is not a module! Searching for parents...")
+        if graph.module_sn is None:
+            self.log.warning(f"Found no parent module for {graph.component_type(graph.top_sn)} with SN {graph.top_sn}")
         else:
-            ret = module
-            for p in module['parents']:
-                if p['componentType']['code'] == ['MODULE']:
-                    module_sn = p['component']['serialNumber']
-                    break
-            else:
-                self.log.warning(f'Component {module_sn} does not have an assembled module parent! Using bare module...')
+            self.log.info(f"Parent module found: MODULE with SN {graph.module_sn}")
+        return graph.top_sn
+
+    def get_chip_sns_of_module(self, module_sn, from_mirror=False):
+        graph = self.get_component_graph(module_sn, depth=1, component_types=['BARE_MODULE'], from_mirror=from_mirror)
+        module_sn = graph.top_sn
+        self.log.info(f"Getting FE chips associated to {graph.component_type(module_sn)} with SN {module_sn}...")
+        if graph.module_sn is None:
+            self.log.warning(f'Component {module_sn} does not have an assembled module parent! Using bare module...')
 
         chip_sns = []
-        for c in ret['children']:
-            if c['componentType']['code'] == 'FE_CHIP':
-                chip_sn_atlas = c['component']['serialNumber']
-                chip_sn = hex(int(chip_sn_atlas[-7:]))
-                chip_sns.append(chip_sn)
+        for chip_sn_atlas in graph.chip_sns:
+            chip_sn = hex(int(chip_sn_atlas[-7:]))
+            chip_sns.append(chip_sn)
         return module_sn, chip_sns
 
-
-    def check_uploaded_tests(self, module_sn):
-        # Check module tests
-        ret = self.client.get("getComponent", json={"component": module_sn})
-        current_stage = ret['currentStage']['code']
-        self.log.info('Checking tests for module: {0} (at stage {1})...'.format(module_sn, current_stage))
-        current_stage = ret['currentStage']['code']
-        required = _required_tests_module[current_stage]
-        # FIXME: VI is special. Needs to be uploaded for MODULE/ASSEMBLY and MODULE/WIREBONDING
-        found_tests = []
-        for r in ret['tests']:
-            if r['code'] in ['VISUAL_INSPECTION']:
-                for run in r['testRuns']:
-                    test_run = self.client.get("getTestRun", json={"testRun": run['id']})
-                    if (test_run['components'][0]['testedAtStage']['code']) == current_stage:
-                        self.log.info('Found module test: {0} for module {1}'.format(r['code'], module_sn))
-                        found_tests.append(r['code'])
-                        break
-            else:
-                self.log.info('Found module test: {0} for module {1}'.format(r['code'], module_sn))
-            found_tests.append(r['code'])
-
-        diff = set(required) - set(found_tests)
-        if len(diff) == 0:
-            self.log.success('No missing module tests found')
-        else:
-            self.log.warning('Missing module tests for module {0}: {1}'.format(module_sn, diff))
-
-        # check bare module
-        ret = self.client.get("getComponent", json={"component": module_sn})
-        # get bare module
-        for c in ret['children']:
-            if c['componentType']['code'] == 'BARE_MODULE': 
-                # bare_module_sn = c['componentType']
-                bare_module_sn = c['component']['serialNumber']
-                break
-        ret = self.client.get("getComponent", json={"component": bare_module_sn})
-        current_stage = ret['currentStage']['code']
-        required = _required_tests_bare_module[current_stage]
-        found_tests = []
-        for r in ret['tests']:
-            self.log.info('Found bare module test: {0} for bare module {1}'.format(r['code'], bare_module_sn))
-            found_tests.append(r['code'])
-
-        diff = set(required) - set(found_tests)
-
-        if len(diff) == 0:
-            self.log.success('No missing bare module tests found')
-        else:
-            self.log.warning('Missing bare module tests for bare module {0}: {1}'.format(bare_module_sn, diff))
+    def get_missing_tests(self, module_sn, from_mirror=False):
+        ''' Returns stages and required but missing tests of module and its bare module, see qc_criteria.missing_tests_status.
+            With `from_mirror`, mirrored components are taken from the local mirror.
+        '''
+        graph = self.get_component_graph(module_sn, depth=1, component_types=['BARE_MODULE'], from_mirror=from_mirror)
+        if graph.bare_module_sn is None:
+            self.log.warning(f'Module {module_sn} has no bare module child! Checking module tests only...')
+            return missing_tests_status(module_sn, graph.get(module_sn), None, None)
+        return missing_tests_status(module_sn, graph.get(module_sn), graph.bare_module_sn, graph.get(graph.bare_module_sn))
+
+    def check_uploaded_tests(self, module_sn, from_mirror=False):
+        status = self.get_missing_tests(module_sn, from_mirror=from_mirror)
+        log_missing_tests(self.log, status)
+        return status
+
+    def _get_test_runs(self, test_run_ids):
+        return self._map(lambda test_run_id: self._get("getTestRun", json={"testRun": test_run_id}), test_run_ids)
+
+    def evaluate_test_runs(self, test_type, test_runs, criteria_type=None):
+        ''' Evaluates test runs (IDs or getTestRun responses) against the QC criteria of `criteria_type`
+            (default `test_type`). Test runs given by ID are fetched concurrently. Returns one verdict per test run,
+            see qc_criteria.evaluate_criteria. For criteria not validated against the QC specification (see qc_criteria.yaml)
+            the checks are only reported, 'passed' is the verdict stored in the PDB and 'validated' is False.
+        '''
+        test_run_ids = [t for t in test_runs if not isinstance(t, dict)]
+        fetched = dict(zip(test_run_ids, self._get_test_runs(test_run_ids)))
+        test_runs = [t if isinstance(t, dict) else fetched[t] for t in test_runs]
+        validated = (criteria_type or test_type) not in UNVALIDATED
+        verdicts = evaluate_criteria(test_type, test_runs, CRITERIA[criteria_type or test_type])
+        for test_run, verdict in zip(test_runs, verdicts):
+            verdict['validated'] = validated
+            if not validated:
+                verdict['passed'] = test_run.get('passed')
+            for code in failed_checks(verdict):
+                check = verdict['checks'][code]
+                self.log.log(logging.WARNING if validated else logging.INFO, '{0} of {1} test run {2} out of {3}: {4} {5}'.format(
+                    code, test_type, verdict['testRun'], 'specs' if validated else 'unvalidated site default range', check['value'], check['range']))
+        return verdicts
+
+    def regrade_test_runs(self, component_sns, test_type, criteria=None):
+        ''' Re-evaluates all test runs of `test_type` of many components in one go, e.g. after the tolerances changed.
+            `criteria` overrides the ranges of qc_criteria.yaml. Returns the verdicts (see qc_criteria.evaluate_criteria)
+            with 'component', the stored 'storedPassed' and 'changed' if the new verdict differs from it. Runs are not
+            flagged as changed by unvalidated criteria of qc_criteria.yaml.
+        '''
+        components = self.get_components(component_sns)
+        runs = [(sn, run['id']) for sn, component in components.items() for run in TestRunIndex(component).runs(test_type)]
+        test_runs = self._get_test_runs([test_run_id for _, test_run_id in runs])
+        verdicts = evaluate_criteria(test_type, test_runs, criteria if criteria is not None else CRITERIA[test_type])
+        validated = criteria is not None or test_type not in UNVALIDATED
+        for (sn, _), test_run, verdict in zip(runs, test_runs, verdicts):
+            verdict.update(component=sn, storedPassed=test_run.get('passed'), validated=validated,
+                           changed=validated and test_run.get('passed') != verdict['passed'])
+            if verdict['changed']:
+                self.log.warning('{0} test run {1} of {2}: passed {3} -> {4}'.format(test_type, verdict['testRun'], sn, verdict['storedPassed'], verdict['passed']))
+        self.log.info('Regraded {0} {1} test runs of {2} components, {3} changed'.format(
+            len(verdicts), test_type, len(components), sum(v['changed'] for v in verdicts)))
+        return verdicts
+
+    def _evaluate_latest_test_runs(self, component, wanted_tests, result, criteria_type=None):
+        ''' Evaluates the latest test run of every wanted test of `component` and stores pass/fail per test in `result`.
+        '''
+        index = TestRunIndex(component)
+        tests = [(code, index.latest(code)['id']) for code in index.test_types() if code in wanted_tests]
+        test_runs = self._get_test_runs([test_run_id for _, test_run_id in tests])
+        for (code, _), test_run in zip(tests, test_runs):
+            result[code] = self.evaluate_test_runs(code, [test_run], criteria_type)[0]['passed']
+        return result
 
     def get_bare_iv_data(self, module_sn, wanted_tests, result):
-        # Check module tests
-        ret = self.client.get("getComponent", json={"component": module_sn})
-        current_stage = ret['currentStage']['code']
+        # Check sensor IV measured at bare module reception
+        graph = self.get_component_graph(module_sn, depth=2, component_types=['BARE_MODULE', 'SENSOR_TILE'])
+        current_stage = graph.get(module_sn)['currentStage']['code']
         self.log.info('Checking {0} for module: {1} (at stage {2})...'.format(wanted_tests, module_sn, current_stage))
+        test_runs = TestRunIndex(graph.get(graph.sensor_sn))
 
-        for c in ret['children']:
-            if c['componentType']['code'] == 'BARE_MODULE': 
-                # bare_module_sn = c['componentType']
-                bare_module_sn = c['component']['serialNumber']
-                break
-        ret = self.client.get("getComponent", json={"component": bare_module_sn})
-        for c in ret['children']:
-            if c['componentType']['code'] == 'SENSOR_TILE': 
-                # bare_module_sn = c['componentType']
-                sensor_sn = c['component']['serialNumber']
-                break
-        ret = self.client.get("getComponent", json={"component": sensor_sn})
-
-
-        for r in ret['tests']:
-            passed = True
-            if r['code'] in wanted_tests:
-                for rr in range(len(r['testRuns'])):
-                    test_run_id = r['testRuns'][rr]["id"]
-                    test_ret = self.client.get("getTestRun", json={"testRun": test_run_id})
-                    if test_ret['components'][rr]['testedAtStage']['code'] == 'BAREMODULERECEPTION':
-                        break
-
-                for c in criterias['BARE_MODULE_SENSOR_IV']:
-                    for res in test_ret['results']:
-                        if res['code'] == c:
-                            # current_check = ((test_ret['passed']) & (res['value'] > criterias['BARE_MODULE_SENSOR_IV'][c][0]) and (res['value'] < criterias['BARE_MODULE_SENSOR_IV'][c][1]))
-                            current_check = (res['value'] > criterias['BARE_MODULE_SENSOR_IV'][c][0]) and (res['value'] < criterias['BARE_MODULE_SENSOR_IV'][c][1])
-                            if not current_check:
-                                print('{0} out of specs: {1} [{2}] '.format(c, res['value'], criterias['BARE_MODULE_SENSOR_IV'][c]))
-                            passed &= current_check
-                result['BARE_MODULE_SENSOR_IV'] = passed
+        for code in test_runs.test_types():
+            if code in wanted_tests:
+                # use the run tested at bare module reception, the latest one if there is none
+                test_run = test_runs.latest(code, 'BAREMODULERECEPTION') or test_runs.latest(code)
+                result['BARE_MODULE_SENSOR_IV'] = self.evaluate_test_runs(code, [test_run['id']], 'BARE_MODULE_SENSOR_IV')[0]['passed']
                 result['module_sn'] = module_sn
-    #         else:
-    # try:
-    #     print('asasas')
-    #     result[r['code']] = 2
-    #     result['module_sn'] = module_sn
-    # except ValueError:  # other tests which are not of interest
-    #     pass
-
-
         return result
 
     def get_bare_assembly_data(self, module_sn, wanted_tests, result):
-        # Check module tests
-        ret = self.client.get("getComponent", json={"component": module_sn})
-        current_stage = ret['currentStage']['code']
+        # Check bare module tests
+        graph = self.get_component_graph(module_sn, depth=1, component_types=['BARE_MODULE'])
+        current_stage = graph.get(module_sn)['currentStage']['code']
         self.log.info('Checking {0} for module: {1} (at stage {2})...'.format(wanted_tests, module_sn, current_stage))
-
-        for c in ret['children']:
-            if c['componentType']['code'] == 'BARE_MODULE': 
-                # bare_module_sn = c['componentType']
-                bare_module_sn = c['component']['serialNumber']
-                break
-        ret = self.client.get("getComponent", json={"component": bare_module_sn})
-
-        for r in ret['tests']:
-            if r['code'] in wanted_tests:
-                test_run_id = r['testRuns'][0]["id"]
-                test_ret = self.client.get("getTestRun", json={"testRun": test_run_id})
-                passed = True
-                for c in criterias['QUAD_BARE_MODULE_METROLOGY']:
-                    for res in test_ret['results']:
-                        if res['code'] == c:
-                            # if res['code'] == 'DISTANCE_PCB_BARE_MODULE_TOP_LEFT':
-                            #     print('ajajaajajaj', res['value'])
-                            #     current_check  =  True
-                            #     for i in range(2):
-                            #         current_check &= (res['value'][i] > criterias['QUAD_MODULE_METROLOGY'][c][i][0]) and (res['value'][i] < criterias['QUAD_MODULE_METROLOGY'][c][i][1])
-                            # else:
-                            current_check = (res['value'] > criterias['QUAD_BARE_MODULE_METROLOGY'][c][0]) and (res['value'] < criterias['QUAD_BARE_MODULE_METROLOGY'][c][1])
-                            if not current_check:
-                                print('{0} out of specs: {1} [{2}] '.format(c, res['value'], criterias['QUAD_BARE_MODULE_METROLOGY'][c]))
-                            passed &= current_check
-                result[r['code']] = passed
-                result['module_sn'] = module_sn
+        self._evaluate_latest_test_runs(graph.get(graph.bare_module_sn), wanted_tests, result, 'QUAD_BARE_MODULE_METROLOGY')
+        result['module_sn'] = module_sn
         return result
 
-    
     def get_assembly_data(self, module_sn, wanted_tests, result):
         # Check module tests
-        ret = self.client.get("getComponent", json={"component": module_sn})
+        ret = self._get("getComponent", json={"component": module_sn})
         current_stage = ret['currentStage']['code']
         self.log.info('Checking {0} for module: {1} (at stage {2})...'.format(wanted_tests, module_sn, current_stage))
-
-        for r in ret['tests']:
-            passed = True
-            if r['code'] in wanted_tests:
-                test_run_id = r['testRuns'][0]["id"]
-                test_ret = self.client.get("getTestRun", json={"testRun": test_run_id})
-                for c in criterias['QUAD_MODULE_METROLOGY']:
-                    for res in test_ret['results']:
-                        if res['code'] == c:
-                            current_check = True
-                            if res['code'] == 'DISTANCE_PCB_BARE_MODULE_TOP_LEFT':
-                                for i in range(2):
-                                    try:
-                                        current_check &= (res['value'][i] > criterias['QUAD_MODULE_METROLOGY'][c][i][0]) and (res['value'][i] < criterias['QUAD_MODULE_METROLOGY'][c][i][1])
-                                    except Exception:
-                                        print('could not calculate pass/fail')
-                                        current_check = False
-                            else:
-                                current_check = (res['value'] > criterias['QUAD_MODULE_METROLOGY'][c][0]) and (res['value'] < criterias['QUAD_MODULE_METROLOGY'][c][1])
-                            if not current_check:
-                                print('{0} out of specs: {1} [{2}] '.format(c, res['value'], criterias['QUAD_MODULE_METROLOGY'][c]))
-                            passed &= current_check
-                result[r['code']] = passed
-                result['module_sn'] = module_sn
-            # else:
-            #     result[r['code']] = 2
-            #     result['module_sn'] = module_sn
-
+        self._evaluate_latest_test_runs(ret, wanted_tests, result, 'QUAD_MODULE_METROLOGY')
+        result['module_sn'] = module_sn
         return result
 
     def get_iv_data(self, module_sn, wanted_tests, result):
         # Check module tests
-        ret = self.client.get("getComponent", json={"component": module_sn})
+        ret = self._get("getComponent", json={"component": module_sn})
         current_stage = ret['currentStage']['code']
         self.log.info('Checking {0} for module: {1} (at stage {2})...'.format(wanted_tests, module_sn, current_stage))
-        for r in ret['tests']:
-            passed = True
-            if r['code'] in wanted_tests:
-                test_run_id = r['testRuns'][0]["id"]
-                test_ret = self.client.get("getTestRun", json={"testRun": test_run_id})
-                # print(test_ret['results'], test_ret['passed'])
-                for c in criterias['IV_MEASURE']:
-                    for res in test_ret['results']:
-                        if res['code'] == c:
-                            #current_check = ((test_ret['passed']) & (res['value'] > criterias['IV_MEASURE'][c][0]) and (res['value'] < criterias['IV_MEASURE'][c][1]))
-                            current_check = (res['value'] > criterias['IV_MEASURE'][c][0]) and (res['value'] < criterias['IV_MEASURE'][c][1])
-                            if not current_check:
-                                print('{0} out of specs: {1} [{2}] '.format(c, res['value'], criterias['IV_MEASURE'][c]))
-                            passed &= current_check
-                result[r['code']] = passed
-                result['module_sn'] = module_sn
+        self._evaluate_latest_test_runs(ret, wanted_tests, result, 'IV_MEASURE')
+        result['module_sn'] = module_sn
         return result
 
     def _set_component_stage(self, component_code, component_stage):
-        self.client.post("setComponentStage", json={'component': component_code,
-                                                   'stage': component_stage})
+        return self._post("setComponentStage", json={'component': component_code,
+                                                     'stage': component_stage})
 
     def _get_component_stage(self, component_code):
         ''' Get current stage of component
         '''
-        ret = self.client.get("getComponent", json={"component": component_code})
+        ret = self._get("getComponent", json={"component": component_code})
         current_stage = ret['currentStage']['code']
         return current_stage
 
-    def _get_component_test_runs(self, component_code):
-        ret = self.client.get("getComponent", json={"component": component_code})
-        return ret['tests'][0]['testRuns']
+    def get_test_run_index(self, component_code):
+        ''' Returns TestRunIndex of the test runs of a component (one getComponent request).
+        '''
+        return TestRunIndex(self._get("getComponent", json={"component": component_code}))
+
+    def _wait_for_stage(self, component_code, component_stage, response=None, timeout=30.0):
+        ''' Waits until stage change of component is applied. The POST response is trusted if it
+            already reports the new stage, otherwise the stage is polled with exponential backoff.
+        '''
+        if stage_of_response(response) == component_stage:
+            return component_stage
+
+        current_stage = self._get_component_stage(component_code=component_code)
+        for delay in poll_delays(timeout):
+            if current_stage == component_stage:
+                break
+            time.sleep(delay)
+            self.cache.invalidate(component_code)  # force fresh stage on next poll
+            current_stage = self._get_component_stage(component_code=component_code)
+        return current_stage
+
+    def _change_component_stage(self, component_code, component_type, target_stage):
+        ''' Moves component along the shortest path of its stage graph to `target_stage`. Raises RuntimeError if the
+            target stage cannot be reached, so that no data is uploaded at a wrong stage.
+        '''
+        current_stage = self._get_component_stage(component_code=component_code)
+        if current_stage == target_stage:
+            self.log.debug('Current stage of {0} {1} ({2}) is ok'.format(component_type, component_code, current_stage))
+            return current_stage
+
+        self.log.debug('Current stage of {0} {1} ({2}) is not ok'.format(component_type, component_code, current_stage))
+        for stage in plan_stage_change(component_type, component_code, current_stage, target_stage):
+            stage_old = current_stage
+            ret = self._set_component_stage(component_code=component_code, component_stage=stage)  # change stage
+            current_stage = self._wait_for_stage(component_code=component_code, component_stage=stage, response=ret)
+            self.log.debug('Changed stage of {0} from {1} to {2}.'.format(component_type, stage_old, current_stage))
+            check_stage_changed(component_type, component_code, stage, current_stage)
+        return current_stage
+
+    def find_duplicate_test_run(self, data):
+        ''' Returns ID of an existing test run of the component with the same fingerprint (test type, date
+            and results) as the payload `data`, None if there is none. Only runs of the same test type and
+            date are fetched for comparison.
+        '''
+        component = self._get("getComponent", json={"component": data['component']})
+        return find_duplicate(data, self._get_test_runs(duplicate_candidates(component, data)))
 
+    def _upload_lock(self, component_code):
+        with self._upload_locks_lock:
+            return self._upload_locks.setdefault(component_code, threading.Lock())
+
+    def upload_test_run(self, data):
+        ''' Uploads test run `data` unless an identical test run is already in the PDB. Payloads without
+            run number get the next free run number of the component and test type assigned.
+            Returns the uploadTestRunResults response (with the ID of the existing test run for duplicates).
+        '''
+        with self._upload_lock(data['component']):
+            duplicate_id = self.find_duplicate_test_run(data)
+            if duplicate_id is not None:
+                self.log.info('{0} of {1} is already uploaded as test run {2}, skipping'.format(data['testType'], data['component'], duplicate_id))
+                return {'testRun': {'id': duplicate_id}}
+            data = with_run_number(self._get("getComponent", json={"component": data['component']}), data)
+            return self._post('uploadTestRunResults', json=data)
 
     def upload_iv_curve(self, module_sn=None, iv_data=None):
         ''' Upload IV curve data. Uploading IV curve data consists of several steps:
@@ -351,217 +522,70 @@ class ITkProdDB(object):
         institution = iv_data['institution']
 
         # Check current stage of SENSOR TILE and change stage if needed.
-        current_stage = self._get_component_stage(component_code=sensor_sn) # current stage of sensor tile
-        if current_stage == 'BAREMODULERECEPTION': # needs to be at stage: BAREMODULERECEPTION (Bare module reception at ITK institute), otherwise no IV curve data upload possible
-            self.log.debug('Current stage of SENSOR TILE ({0}) is ok'.format(current_stage))
-        else:
-            self.log.debug('Current stage of SENSOR TILE ({0}) is not ok'.format(current_stage))
-            if current_stage == "sensor_manufacturer":
-                set_stages = ['WAFER_PROCESSING', 'BAREMODULEASSEMBLY', 'BAREMODULERECEPTION']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=sensor_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=sensor_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            elif current_stage == 'WAFER_PROCESSING':
-                set_stages = ['BAREMODULEASSEMBLY', 'BAREMODULERECEPTION']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=sensor_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=sensor_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            elif current_stage == 'BAREMODULEASSEMBLY':
-                set_stages = ['BAREMODULERECEPTION']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=sensor_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=sensor_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            else:
-                self.log.error('Unkown stage ({0})'.format(current_stage))
+        # Needs to be at stage: BAREMODULERECEPTION (Bare module reception at ITK institute), otherwise no IV curve data upload possible
+        self._change_component_stage(component_code=sensor_sn, component_type='SENSOR_TILE', target_stage=UPLOAD_STAGES['SENSOR_TILE'])
 
         # upload IV data to SENSOR TILE
-        self.client.post('uploadTestRunResults', json=iv_data)
+        test_run_id = self.upload_test_run(iv_data)['testRun']['id']
 
         # Check current stage of BARE MODULE and change stage if needed.
-        current_stage = self._get_component_stage(component_code=module_sn) # current stage of sensor tile
-        if current_stage == 'BAREMODULERECEPTION': # needs to be at stage: BAREMODULERECEPTION (Bare module reception at ITK institute), otherwise no IV curve data upload possible
-            print('Stage ok:', current_stage)
-        else:
-            print('stage not okay, current_stage is: %s' %current_stage)
-            if current_stage == "sensor_manufacturer":
-                set_stages = ['WAFER_PROCESSING', 'BAREMODULEASSEMBLY', 'BAREMODULERECEPTION']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=module_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=module_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            elif current_stage == 'WAFER_PROCESSING':
-                set_stages = ['BAREMODULEASSEMBLY', 'BAREMODULERECEPTION']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=module_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=module_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            elif current_stage == 'BAREMODULEASSEMBLY':
-                set_stages = ['BAREMODULERECEPTION']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=module_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=module_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            else:
-                self.log.error('Unkown stage ({0})'.format(current_stage))
-
-        # Get ID of latest test run and link to bare module
-        test_runs = self._get_component_test_runs(sensor_sn)
-        test_runs = sorted(test_runs, key=lambda d: d['stateTs'])  # sort test runs by stateTs (upload date)
-        test_run = test_runs[-1]  # get latest test run
-        test_run_id = test_run['id']
-
-        link_to_bare_module_json = {
-            "component": module_sn,
-            "testType": "BARE_MODULE_SENSOR_IV",
-            "institution": test_run['institution']['code'],
-            "date": test_run['stateTs'],
-            "runNumber": test_run['runNumber'],
-            "passed": test_run['passed'],
-            "problems": test_run['problems'],
-            "results": {"LINK_TO_SENSOR_IV_TEST": test_run_id}
-        }
-        self.log.info("Test: would send data:\n")
-        self.log.info(json.dumps(link_to_bare_module_json, indent=4))
-        self.client.post('uploadTestRunResults', json=link_to_bare_module_json)
+        self._change_component_stage(component_code=module_sn, component_type='BARE_MODULE', target_stage=UPLOAD_STAGES['BARE_MODULE'])
+
+        # Link uploaded test run to bare module. A cached sensor tile can miss the test run just uploaded.
+        self.cache.invalidate(sensor_sn)
+        test_run = self.get_test_run_index(sensor_sn).get(test_run_id)
+        if test_run is None:
+            raise RuntimeError('Test run {0} of sensor tile {1} not found'.format(test_run_id, sensor_sn))
+
+        link_to_bare_module_json = sensor_iv_link(module_sn, test_run)
+        log_payload(self.log, 'Uploading', link_to_bare_module_json)
+        self.upload_test_run(link_to_bare_module_json)
 
     def upload_flex_data(self, flex_data, filename=None, filename_data=None):
         # FIXME: fix run number
-        # Check current stage of BARE MODULE and change stage if needed.
+        # Check current stage of PCB and change stage if needed.
         flex_sn = flex_data['component']
-        current_stage = self._get_component_stage(component_code=flex_sn) # current stage of sensor tile
-        if current_stage == 'PCB_RECEPTION_MODULE_SITE': # needs to be at stage: PCB_RECEPTION_MODULE_SITE
-            print('Stage ok:', current_stage)
-        else:
-            print('stage not okay, current_stage is: %s' %current_stage)
-            if current_stage == "QA_PRE_THERMAL_CYCLE":
-                set_stages = ['QA_POST_THERMAL_CYCLE', 'PCB_QC', 'PCB_READY_FOR_MODULE', 'PCB_RECEPTION_MODULE_SITE']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=flex_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=flex_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            elif current_stage == 'QA_POST_THERMAL_CYCLE':
-                set_stages = ['PCB_QC', 'PCB_READY_FOR_MODULE', 'PCB_RECEPTION_MODULE_SITE']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=flex_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=flex_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            elif current_stage == 'PCB_QC':
-                set_stages = ['PCB_READY_FOR_MODULE', 'PCB_RECEPTION_MODULE_SITE']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=flex_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=flex_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            elif current_stage == 'PCB_READY_FOR_MODULE':
-                set_stages = ['PCB_RECEPTION_MODULE_SITE']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=flex_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=flex_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            else:
-                self.log.error('Unkown stage ({0})'.format(current_stage))
-
-        self.log.info("Test: would send data:\n")
-        self.log.info(json.dumps(bare_module_data, indent=4))
-        ret = self.client.post('uploadTestRunResults', json=flex_data)
+        self._change_component_stage(component_code=flex_sn, component_type='PCB', target_stage=UPLOAD_STAGES['PCB'])
+
+        log_payload(self.log, 'Uploading', flex_data)
+        ret = self.upload_test_run(flex_data)
 
         if filename is not None:
             filename_data['testRun'] = str(ret['testRun']['id'])
-            self.upload_attachment_to_eos(filename=filename, data=filename_data)
+            AttachmentUploader(self).upload(filename, filename_data)
 
     def upload_bare_module_data(self, bare_module_data, filename=None, filename_data=None):
         bare_module_sn = bare_module_data['component']
         # Check current stage of BARE MODULE and change stage if needed.
-        current_stage = self._get_component_stage(component_code=bare_module_sn) # current stage of sensor tile
-        if current_stage == 'BAREMODULERECEPTION': # needs to be at stage: BAREMODULERECEPTION (Bare module reception at ITK institute)
-            print('Stage ok:', current_stage)
-        else:
-            print('stage not okay, current_stage is: %s' %current_stage)
-            if current_stage == "sensor_manufacturer":
-                set_stages = ['WAFER_PROCESSING', 'BAREMODULEASSEMBLY', 'BAREMODULERECEPTION']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=bare_module_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=bare_module_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            elif current_stage == 'WAFER_PROCESSING':
-                set_stages = ['BAREMODULEASSEMBLY', 'BAREMODULERECEPTION']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=bare_module_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=bare_module_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            elif current_stage == 'BAREMODULEASSEMBLY':
-                set_stages = ['BAREMODULERECEPTION']
-                for stage in set_stages:
-                    stage_old = current_stage
-                    self._set_component_stage(component_code=bare_module_sn, component_stage=stage)  # change stage
-                    time.sleep(2.0)
-                    current_stage = self._get_component_stage(component_code=bare_module_sn)
-                    self.log.debug('Changed stage of SENSOR TILE from {0} to {1}.'.format(stage_old, current_stage))
-            else:
-                self.log.error('Unkown stage ({0})'.format(current_stage))
-
-        self.log.info("Test: would send data:\n")
-        self.log.info(json.dumps(bare_module_data, indent=4))
-        ret = self.client.post('uploadTestRunResults', json=bare_module_data)
+        # Needs to be at stage: BAREMODULERECEPTION (Bare module reception at ITK institute)
+        self._change_component_stage(component_code=bare_module_sn, component_type='BARE_MODULE', target_stage=UPLOAD_STAGES['BARE_MODULE'])
+
+        log_payload(self.log, 'Uploading', bare_module_data)
+        ret = self.upload_test_run(bare_module_data)
 
         if filename is not None:
             filename_data['testRun'] = str(ret['testRun']['id'])
-            self.upload_attachment_to_eos(filename=filename, data=filename_data)
+            AttachmentUploader(self).upload(filename, filename_data)
 
 
     def upload_module_data(self, module_data, filename=None, filename_data=None):
         module_sn = module_data['component']
         # Check current stage of MODULE and change stage if needed.
-        current_stage = self._get_component_stage(component_code=module_sn) # current stage of sensor tile
-
         if module_data['testType'] == 'WIREBOND_PULL_TEST':
             # FIXME: also change bare module stage
-            self._get_component_stage(component_code=module_sn)
-            if current_stage != 'MODULE/WIREBONDING':
-                print('need to change stage to Wirebonding')
-                self._set_component_stage(component_code=module_sn, component_stage='MODULE/WIREBONDING')  # change stage
-                time.sleep(2.0)
-                new_stage = self._get_component_stage(component_code=module_sn)
-                self.log.debug('Changed stage of MODULE from {0} to {1}.'.format(current_stage, new_stage))
-
-        self.log.info("Test: would send data:\n")
-        self.log.info(json.dumps(module_data, indent=4))
-        ret = self.client.post('uploadTestRunResults', json=module_data)
+            self._change_component_stage(component_code=module_sn, component_type='MODULE', target_stage='MODULE/WIREBONDING')
+
+        log_payload(self.log, 'Uploading', module_data)
+        ret = self.upload_test_run(module_data)
 
         if filename is not None:
             filename_data['testRun'] = str(ret['testRun']['id'])
-            self.upload_attachment_to_eos(filename=filename, data=filename_data)
+            AttachmentUploader(self).upload(filename, filename_data)
 
     def upload_attachment_to_eos(self, filename=None, data=None):
         with Path(filename).open("rb") as fpointer:
             files = {"data": itkdb.utils.get_file_components({"data": fpointer})}
-            response = self.client.post("createTestRunAttachment", data=data, files=files)
+            response = self._post("createTestRunAttachment", data=data, files=files)
 
 
 if __name__ == '__main__':
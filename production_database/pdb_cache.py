@@ -0,0 +1,133 @@
+'''
+Read-through cache for ITk production database (PDB) responses.
+
+Responses are kept in an in-memory LRU and optionally persisted to a SQLite file,
+so that repeated lookups of the same component (also across script runs) do not
+hit the PDB again until their time-to-live is over.
+'''
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Time-to-live in seconds per PDB endpoint. Endpoints not listed here are not cached.
+DEFAULT_TTLS = {
+    'getUser': 3600.0,
+    'getComponent': 300.0,
+    'getTestRun': 3600.0,  # test runs are immutable once uploaded
+}
+
+
+def _make_key(endpoint, json_data):
+    return endpoint + ':' + json.dumps(json_data, sort_keys=True, default=str)
+
+
+class ResponseCache(object):
+    '''
+    In-memory LRU cache with optional on-disk SQLite backend and per-endpoint TTLs.
+    '''
+
+    def __init__(self, maxsize=1024, ttls=None, filename=None):
+        self.maxsize = maxsize
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self._lock = threading.RLock()
+        self._memory = OrderedDict()  # key -> (expires, component, value)
+        self._db = None
+        if filename is not None:
+            self._db = sqlite3.connect(str(filename), check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses '
+                             '(key TEXT PRIMARY KEY, endpoint TEXT, component TEXT, expires REAL, value TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_component ON responses (component)')
+            self._db.commit()
+
+    def is_cacheable(self, endpoint):
+        return self.ttls.get(endpoint, 0) > 0
+
+    def get(self, endpoint, json_data):
+        ''' Returns cached response or None if not cached or expired.
+        '''
+        key = _make_key(endpoint, json_data)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    return entry[2]
+                del self._memory[key]
+            if self._db is not None:
+                row = self._db.execute('SELECT expires, component, value FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    if row[0] > now:
+                        value = json.loads(row[2])
+                        self._store_memory(key, row[0], row[1], value)
+                        return value
+                    self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self._db.commit()
+        return None
+
+    def put(self, endpoint, json_data, value, component=None):
+        ''' Stores response. `component` is the serial number the response belongs to (used for invalidation).
+        '''
+        if not self.is_cacheable(endpoint):
+            return
+        key = _make_key(endpoint, json_data)
+        expires = time.time() + self.ttls[endpoint]
+        with self._lock:
+            self._store_memory(key, expires, component, value)
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                                 (key, endpoint, component, expires, json.dumps(value, default=str)))
+                self._db.commit()
+
+    def get_components(self, component_sns):
+        ''' Returns {S/N: getComponent response} of the cached ones of `component_sns`.
+        '''
+        components = {}
+        for sn in component_sns:
+            ret = self.get("getComponent", {"component": sn})
+            if ret is not None:
+                components[sn] = ret
+        return components
+
+    def put_components(self, components):
+        ''' Stores getComponent responses (e.g. of a getComponentBulk request). Returns them as {S/N: response}.
+        '''
+        stored = {}
+        for component in components:
+            sn = component['serialNumber']
+            self.put("getComponent", {"component": sn}, component, component=sn)
+            stored[sn] = component
+        return stored
+
+    def invalidate(self, component):
+        ''' Drops all cached responses belonging to component with serial number `component`.
+        '''
+        with self._lock:
+            for key in [k for k, v in self._memory.items() if v[1] == component]:
+                del self._memory[key]
+            if self._db is not None:
+                self._db.execute('DELETE FROM responses WHERE component = ?', (component,))
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM responses')
+                self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _store_memory(self, key, expires, component, value):
+        self._memory[key] = (expires, component, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
@@ -0,0 +1,102 @@
+'''
+Logging setup and payload logging of the PDB interface.
+
+Handlers (coloured console output and a size-limited, rotating ITkProdDB.log) are installed once
+per process; the per-request INFO lines of httpx and urllib3 are suppressed. Upload payloads are logged as short summaries (keys, array lengths and hashes);
+full bodies are only logged at DEBUG level if enabled with ITKPRODDB_LOG_PAYLOADS=1 or
+set_full_payload_logging(True). Both are formatted only if the record is actually emitted.
+'''
+import hashlib
+import json
+import logging
+import os
+import threading
+from logging.handlers import RotatingFileHandler
+
+import coloredlogs
+
+LOG_FILE = 'ITkProdDB.log'
+LOG_FORMAT = '%(asctime)s - [%(name)-15s] - %(levelname)-7s %(message)s'
+
+# HTTP client libraries logging every request at INFO, only their warnings are shown
+QUIET_LOGGERS = ['httpx', 'httpcore', 'urllib3']
+
+_full_payloads = os.environ.get('ITKPRODDB_LOG_PAYLOADS', '0') not in ['', '0']
+_handlers_installed = False
+_lock = threading.Lock()
+
+
+def setup_logging(name, loglevel=logging.INFO, filename=LOG_FILE, max_bytes=10 * 1024 * 1024, backup_count=5):
+    ''' Returns logger `name` with level `loglevel`. Console and rotating file handler are installed once per process,
+        at the lowest level any logger was set up with. The request logs of the HTTP libraries (QUIET_LOGGERS) are
+        limited to warnings unless their level was set explicitly.
+    '''
+    global _handlers_installed
+    log = logging.getLogger(name)
+    log.setLevel(loglevel)
+    with _lock:
+        if not _handlers_installed:
+            coloredlogs.install(fmt=LOG_FORMAT, milliseconds=False, level=loglevel)
+            fh = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count)
+            fh.setFormatter(logging.Formatter(LOG_FORMAT))
+            logging.getLogger().addHandler(fh)
+            for quiet in QUIET_LOGGERS:
+                if logging.getLogger(quiet).level == logging.NOTSET:
+                    logging.getLogger(quiet).setLevel(logging.WARNING)
+            _handlers_installed = True
+        elif loglevel < coloredlogs.get_level():
+            coloredlogs.set_level(loglevel)
+    return log
+
+
+def set_full_payload_logging(enabled=True):
+    global _full_payloads
+    _full_payloads = enabled
+
+
+def _summarize(value):
+    if isinstance(value, dict):
+        return '{' + ', '.join('{0}: {1}'.format(k, _summarize(v)) for k, v in value.items()) + '}'
+    if isinstance(value, (list, tuple)):
+        if len(value) <= 4 and all(not isinstance(v, (list, dict)) for v in value):
+            return repr(list(value))
+        digest = hashlib.sha1(json.dumps(value, default=str).encode('utf-8')).hexdigest()[:8]
+        return 'list[{0}] ({1})'.format(len(value), digest)
+    if isinstance(value, str) and len(value) > 40:
+        return repr(value[:37] + '...')
+    return repr(value)
+
+
+class PayloadSummary(object):
+    ''' Summary of an upload payload, formatted when logged.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        data = self.data
+        if not isinstance(data, dict):
+            return _summarize(data)
+        head = ' '.join(str(data[k]) for k in ['testType', 'component', 'testRun'] if data.get(k) is not None)
+        rest = {k: v for k, v in data.items() if k not in ['testType', 'component', 'testRun']}
+        return (head + ' ' + _summarize(rest)).lstrip()
+
+
+class PayloadBody(object):
+    ''' Full upload payload as indented JSON, formatted when logged.
+    '''
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data, indent=4, default=str)
+
+
+def log_payload(log, message, data):
+    ''' Logs summary of payload `data` at INFO and, if full payload logging is enabled, the full body at DEBUG.
+    '''
+    log.info('%s %s', message, PayloadSummary(data))
+    if _full_payloads:
+        log.debug('%s', PayloadBody(data))
@@ -0,0 +1,118 @@
+'''
+Latency and call-count instrumentation of PDB requests.
+'''
+import json
+import threading
+import time
+from collections import defaultdict
+
+# Upper edges of the latency histogram bins in s
+LATENCY_BINS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+
+def status_of_exception(e):
+    ''' Returns HTTP status of a failed request (None if the request did not get a response).
+    '''
+    response = getattr(e, 'response', None)
+    if response is not None:
+        return getattr(response, 'status_code', None)
+    return getattr(e, 'code', None)
+
+
+class _EndpointStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.wait_time = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.histogram = [0] * len(LATENCY_BINS)
+        self.status = defaultdict(int)
+
+    def quantile(self, q):
+        ''' Returns upper bin edge of latency quantile `q` estimated from the histogram.
+        '''
+        n = q * sum(self.histogram)
+        count = 0
+        for edge, entries in zip(LATENCY_BINS, self.histogram):
+            count += entries
+            if count >= n:
+                return min(edge, self.max_time)
+        return self.max_time
+
+
+class CallMetrics(object):
+    '''
+    Collects per-endpoint statistics of PDB requests and optionally writes every request to a JSONL trace file.
+    '''
+
+    def __init__(self, trace_file=None):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(_EndpointStats)
+        self._trace = open(trace_file, 'a') if trace_file is not None else None
+
+    def timer(self):
+        return time.perf_counter()
+
+    def record(self, endpoint, component=None, start=None, request_bytes=0, response_bytes=0, status=200, retries=0, cached=False, wait=0.0):
+        ''' Records one request. `start` is the value of timer() when the request was sent (after the rate limiter),
+            `wait` the time the request waited in the client side rate limiter.
+        '''
+        latency = time.perf_counter() - start if start is not None else 0.0
+        with self._lock:
+            stats = self._stats[endpoint]
+            if cached:
+                stats.cache_hits += 1
+            else:
+                stats.calls += 1
+                stats.retries += retries
+                stats.total_time += latency
+                stats.max_time = max(stats.max_time, latency)
+                stats.wait_time += wait
+                stats.request_bytes += request_bytes
+                stats.response_bytes += response_bytes
+                stats.status[status] += 1
+                if status is None or status >= 400:
+                    stats.errors += 1
+                for i, edge in enumerate(LATENCY_BINS):
+                    if latency <= edge:
+                        stats.histogram[i] += 1
+                        break
+            if self._trace is not None:
+                self._trace.write(json.dumps({'ts': time.time(), 'endpoint': endpoint, 'component': component, 'latency': round(latency, 6),
+                                              'wait': round(wait, 6),
+                                              'request_bytes': request_bytes, 'response_bytes': response_bytes,
+                                              'status': status, 'retries': retries, 'cached': cached}) + '\n')
+
+    def stats(self):
+        ''' Returns statistics per endpoint as dict.
+        '''
+        with self._lock:
+            return {endpoint: {'calls': s.calls, 'cache_hits': s.cache_hits, 'errors': s.errors, 'retries': s.retries,
+                               'total_time': s.total_time, 'mean_time': s.total_time / s.calls if s.calls else 0.0,
+                               'p50_time': s.quantile(0.5), 'p95_time': s.quantile(0.95), 'max_time': s.max_time, 'wait_time': s.wait_time,
+                               'request_bytes': s.request_bytes, 'response_bytes': s.response_bytes,
+                               'status': dict(s.status), 'histogram': list(s.histogram)}
+                    for endpoint, s in self._stats.items()}
+
+    def summary(self):
+        ''' Returns table of request statistics per endpoint.
+        '''
+        lines = ['{0:<25} {1:>6} {2:>6} {3:>6} {4:>7} {5:>9} {6:>8} {7:>8} {8:>8} {9:>8} {10:>10}'.format(
+            'endpoint', 'calls', 'cached', 'errors', 'retries', 'total/s', 'mean/s', 'p95/s', 'max/s', 'wait/s', 'kB recv')]
+        for endpoint, s in sorted(self.stats().items(), key=lambda item: -item[1]['total_time']):
+            lines.append('{0:<25} {1:>6} {2:>6} {3:>6} {4:>7} {5:>9.2f} {6:>8.3f} {7:>8.3f} {8:>8.3f} {9:>8.2f} {10:>10.1f}'.format(
+                endpoint, s['calls'], s['cache_hits'], s['errors'], s['retries'], s['total_time'], s['mean_time'],
+                s['p95_time'], s['max_time'], s['wait_time'], s['response_bytes'] / 1000.0))
+        return '\n'.join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+                self._trace = None
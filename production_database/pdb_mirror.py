@@ -0,0 +1,201 @@
+'''
+Local SQLite mirror of the components of an institution in the PDB.
+
+The mirror holds type, stage, children/parents and test run summaries of all components
+located at the institution (currentLocation, which can differ from the owning institution,
+e.g. for bare modules of a vendor). It is updated incrementally: one listComponents request returns the
+modification timestamp (stateTs) of every component, and only components changed since the
+last sync are fetched again (in bulk). Status checks can then be answered from the mirror
+within milliseconds, also while the PDB is down:
+
+    python pdb_mirror.py --institution BONN
+'''
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+MIRROR_FILE = 'pdb_mirror.sqlite'
+
+
+def _location(component):
+    ''' Returns code of the current location of a getComponent response (listComponents filters on it).
+    '''
+    location = component.get('currentLocation') or component.get('institution') or {}
+    return location.get('code') if isinstance(location, dict) else location
+
+
+class ComponentMirror(object):
+    '''
+    SQLite mirror of PDB components with read-only query methods.
+    '''
+
+    def __init__(self, filename=MIRROR_FILE):
+        self.log = logging.getLogger('ComponentMirror')
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(filename), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS components (
+                sn TEXT PRIMARY KEY,
+                id TEXT,
+                type TEXT,
+                stage TEXT,
+                institution TEXT,
+                location TEXT,
+                state_ts TEXT,
+                data TEXT);
+            CREATE INDEX IF NOT EXISTS components_type_stage ON components (type, stage);
+            CREATE TABLE IF NOT EXISTS relations (
+                parent TEXT NOT NULL,
+                child TEXT NOT NULL,
+                parent_type TEXT,
+                child_type TEXT,
+                PRIMARY KEY (parent, child));
+            CREATE INDEX IF NOT EXISTS relations_child ON relations (child);
+            CREATE TABLE IF NOT EXISTS test_runs (
+                id TEXT PRIMARY KEY,
+                component TEXT NOT NULL,
+                test_type TEXT,
+                run_number TEXT,
+                date TEXT,
+                state_ts TEXT,
+                passed INTEGER,
+                problems INTEGER,
+                state TEXT);
+            CREATE INDEX IF NOT EXISTS test_runs_component ON test_runs (component, test_type);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            ''')
+        if 'location' not in [row['name'] for row in self._db.execute('PRAGMA table_info(components)')]:  # mirror of an older version
+            self._db.execute('ALTER TABLE components ADD COLUMN location TEXT')
+            for sn, data in self._db.execute('SELECT sn, data FROM components').fetchall():
+                self._db.execute('UPDATE components SET location = ? WHERE sn = ?', (_location(json.loads(data)), sn))
+        self._db.execute('CREATE INDEX IF NOT EXISTS components_location ON components (location)')
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def _store(self, component):
+        sn = component['serialNumber']
+        self._db.execute('DELETE FROM relations WHERE parent = ? OR child = ?', (sn, sn))
+        self._db.execute('DELETE FROM test_runs WHERE component = ?', (sn,))
+        self._db.execute('INSERT OR REPLACE INTO components (sn, id, type, stage, institution, location, state_ts, data) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (sn, component.get('id'), component['componentType']['code'],
+                          (component.get('currentStage') or {}).get('code'), (component.get('institution') or {}).get('code'),
+                          _location(component), component.get('stateTs'), json.dumps(component)))
+        component_type = component['componentType']['code']
+        for r in component.get('children') or []:
+            if r.get('component'):
+                self._db.execute('INSERT OR REPLACE INTO relations VALUES (?, ?, ?, ?)',
+                                 (sn, r['component']['serialNumber'], component_type, r['componentType']['code']))
+        for r in component.get('parents') or []:
+            if r.get('component'):
+                self._db.execute('INSERT OR REPLACE INTO relations VALUES (?, ?, ?, ?)',
+                                 (r['component']['serialNumber'], sn, r['componentType']['code'], component_type))
+        for test in component.get('tests') or []:
+            for run in test['testRuns']:
+                self._db.execute('INSERT OR REPLACE INTO test_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (run['id'], sn, test['code'], run.get('runNumber'), run.get('date'), run.get('stateTs'),
+                                  run.get('passed'), run.get('problems'), run.get('state')))
+
+    def sync(self, itk_prodDB, institution, component_types=None, full=False):
+        ''' Updates the mirror with all components of `component_types` (default: all types) located at `institution`.
+            Only components with changed stateTs are fetched, unless `full` is set. Components which left
+            the institution (currentLocation) are removed. Returns number of updated and removed components.
+        '''
+        t_start = time.time()
+        summaries = []
+        for component_type in component_types or [None]:
+            summaries.extend(itk_prodDB.list_component_summaries(component_type, institution))
+        listed = {c['serialNumber']: c.get('stateTs') for c in summaries}
+
+        with self._lock:
+            query = 'SELECT sn, state_ts FROM components WHERE location = ?'
+            args = [institution]
+            if component_types:
+                query += ' AND type IN ({0})'.format(', '.join('?' * len(component_types)))
+                args += list(component_types)
+            mirrored = dict(self._db.execute(query, args).fetchall())
+
+        changed = [sn for sn, state_ts in listed.items() if full or state_ts is None or mirrored.get(sn) != state_ts]
+        removed = [sn for sn in mirrored if sn not in listed]
+        for sn in changed:
+            itk_prodDB.cache.invalidate(sn)  # mirror the current state, not a cached one
+        components = itk_prodDB.get_components(changed)
+
+        with self._lock:
+            for component in components.values():
+                self._store(component)
+            for sn in removed:
+                self._db.execute('DELETE FROM components WHERE sn = ?', (sn,))
+                self._db.execute('DELETE FROM relations WHERE parent = ? OR child = ?', (sn, sn))
+                self._db.execute('DELETE FROM test_runs WHERE component = ?', (sn,))
+            self._db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('last_sync', str(t_start)))
+            self._db.commit()
+        self.log.info('Mirror of {0}: {1} components listed, {2} updated, {3} removed ({4:.1f} s)'.format(
+            institution, len(listed), len(changed), len(removed), time.time() - t_start))
+        return len(changed), len(removed)
+
+    def _query(self, query, args=()):
+        with self._lock:
+            return self._db.execute(query, args).fetchall()
+
+    def last_sync(self):
+        ''' Returns time of the last sync (Unix time), None if never synced.
+        '''
+        rows = self._query("SELECT value FROM meta WHERE key = 'last_sync'")
+        return float(rows[0][0]) if rows else None
+
+    def component(self, sn):
+        ''' Returns mirrored getComponent response of `sn`, None if not mirrored.
+        '''
+        rows = self._query('SELECT data FROM components WHERE sn = ?', (sn,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def components(self, component_type=None, stage=None):
+        ''' Returns [{sn, type, stage, state_ts}] of mirrored components, optionally of given type and stage.
+        '''
+        query = 'SELECT sn, type, stage, state_ts FROM components WHERE 1'
+        args = []
+        if component_type is not None:
+            query += ' AND type = ?'
+            args.append(component_type)
+        if stage is not None:
+            query += ' AND stage = ?'
+            args.append(stage)
+        return [dict(row) for row in self._query(query + ' ORDER BY sn', args)]
+
+    def children(self, sn, component_type=None):
+        query = 'SELECT child FROM relations WHERE parent = ?' + (' AND child_type = ?' if component_type else '')
+        return [row[0] for row in self._query(query, (sn, component_type) if component_type else (sn,))]
+
+    def parents(self, sn, component_type=None):
+        query = 'SELECT parent FROM relations WHERE child = ?' + (' AND parent_type = ?' if component_type else '')
+        return [row[0] for row in self._query(query, (sn, component_type) if component_type else (sn,))]
+
+    def test_runs(self, sn, test_type=None):
+        ''' Returns test run summaries of component `sn` (optionally of given type), oldest first.
+        '''
+        query = 'SELECT * FROM test_runs WHERE component = ?' + (' AND test_type = ?' if test_type else '')
+        rows = self._query(query + ' ORDER BY state_ts', (sn, test_type) if test_type else (sn,))
+        return [dict(row) for row in rows]
+
+
+if __name__ == '__main__':
+    from itkprodDB_interface import ITkProdDB
+
+    parser = argparse.ArgumentParser(description='Mirror components of an institution from the ITk production database')
+    parser.add_argument('--institution', required=True, help='Institution code, e.g. BONN')
+    parser.add_argument('--types', nargs='*', default=None, help='Component types to mirror (default: all)')
+    parser.add_argument('-f', '--file', default=MIRROR_FILE, help='Mirror SQLite file')
+    parser.add_argument('--full', action='store_true', help='Fetch all components again, not only changed ones')
+    args = parser.parse_args()
+
+    mirror = ComponentMirror(args.file)
+    with ITkProdDB() as itk_prodDB:
+        mirror.sync(itk_prodDB, args.institution, component_types=args.types, full=args.full)
+    mirror.close()
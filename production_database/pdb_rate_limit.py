@@ -0,0 +1,127 @@
+'''
+Client-side rate limiting and adaptive concurrency of PDB requests.
+
+All requests of a process (threads of ITkProdDB and coroutines of AsyncITkProdDB) pass one
+RateLimiter: a token bucket caps the request rate, and the rate and the number of requests in
+flight are adapted with AIMD (additive increase, multiplicative decrease). Throttling (429) halves
+rate and concurrency, failing servers (502/503/504) and latency rising well above the observed
+baseline reduce the concurrency, and every successful request increases both again slowly.
+Bulk jobs thereby settle at the highest rate the PDB sustains without manual tuning.
+'''
+import asyncio
+import threading
+import time
+
+# HTTP status of responses which indicate an overloaded server
+THROTTLE_STATUS = [429, 502, 503, 504]
+
+
+def retry_after_of_exception(e):
+    ''' Returns Retry-After (in s) of a failed request, None if not given.
+    '''
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None) if response is not None else getattr(e, 'headers', None)
+    try:
+        return float(headers.get('Retry-After'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    '''
+    Token bucket with AIMD adapted rate and concurrency limit, shared by threads and coroutines.
+
+    rate: initial requests per second, adapted between min_rate and max_rate
+    concurrency: initial number of requests in flight, adapted between 1 and max_concurrency
+    latency_factor: smoothed latency above latency_factor x baseline latency reduces the concurrency
+    '''
+
+    def __init__(self, rate=20.0, max_rate=100.0, min_rate=0.5, concurrency=8, max_concurrency=32, latency_factor=3.0):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.concurrency = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self.recent_latency = {}  # smoothed latency per endpoint
+        self.baseline_latency = {}  # lowest smoothed latency per endpoint
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self):
+        ''' Takes a token and a concurrency slot. Returns 0 on success, otherwise the time to wait in s.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self.in_flight >= int(self.concurrency):
+                return 0.01
+            if self._tokens < 1.0:
+                return (1.0 - self._tokens) / self.rate
+            self._tokens -= 1.0
+            self.in_flight += 1
+            return 0.0
+
+    def acquire(self):
+        while True:
+            wait = self._try_acquire()
+            if wait == 0.0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            wait = self._try_acquire()
+            if wait == 0.0:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, endpoint, status=200, latency=None):
+        ''' Returns the slot of a finished request and adapts rate and concurrency to its outcome.
+        '''
+        with self._lock:
+            self.in_flight -= 1
+            if status == 429:  # explicit throttling: lower the rate
+                self._decrease(rate_factor=0.5, concurrency_factor=0.5)
+            elif status in THROTTLE_STATUS:  # overloaded or failing server: fewer requests in flight
+                self._decrease(rate_factor=1.0, concurrency_factor=0.8)
+            elif latency is not None and status is not None and status < 400:
+                recent = self.recent_latency[endpoint] = 0.8 * self.recent_latency.get(endpoint, latency) + 0.2 * latency
+                # lowest smoothed latency seen, slowly forgotten to follow changes of the server
+                baseline = self.baseline_latency[endpoint] = min(recent, 1.001 * self.baseline_latency.get(endpoint, recent))
+                if recent > self.latency_factor * baseline:  # requests queue up at the server: fewer in flight
+                    self._decrease(rate_factor=1.0, concurrency_factor=0.8)
+                else:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+                    self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)  # about +1 request/s per second
+
+    def _decrease(self, rate_factor, concurrency_factor):
+        now = time.monotonic()
+        if now - self._last_decrease < 1.0:  # one decrease per burst of failures
+            return
+        self._last_decrease = now
+        self.concurrency = max(1.0, self.concurrency * concurrency_factor)
+        self.rate = max(self.min_rate, self.rate * rate_factor)
+
+    def retry_delay(self, attempt, retry_after=None):
+        ''' Returns delay in s before retry `attempt` (1, 2, ...) of a throttled request.
+        '''
+        return retry_after if retry_after is not None else min(0.5 * 2 ** (attempt - 1), 10.0)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    ''' Returns the process-wide rate limiter.
+    '''
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
@@ -0,0 +1,33 @@
+'''
+Process-wide session to the ITk production database (PDB).
+
+All ITkProdDB instances of a process share one itkdb client. Authentication happens lazily
+with the first request and the token is stored on disk, so that following processes reuse it
+until it expires instead of doing a new OAuth handshake.
+
+If PDB_STANDIN_URL is set, the session talks to a local PDB stand-in (see pdb_standin.py) instead.
+'''
+import os
+import threading
+
+import itkdb
+
+# On-disk token cache shared between processes
+TOKEN_CACHE = os.environ.get('ITKDB_TOKEN_CACHE', os.path.join(os.path.expanduser('~'), '.itkdb_token'))
+
+_client = None
+_lock = threading.Lock()
+
+
+def get_client():
+    ''' Returns the process-wide itkdb client.
+    '''
+    global _client
+    with _lock:
+        if _client is None and os.environ.get('PDB_STANDIN_URL'):
+            from pdb_standin import StandInClient
+            _client = StandInClient(os.environ['PDB_STANDIN_URL'])
+        elif _client is None:
+            _client = itkdb.Client(use_eos=True, save_auth=TOKEN_CACHE)
+            _client.user._jwt_options["leeway"] = 50 # add more leeway
+        return _client
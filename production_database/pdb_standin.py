@@ -0,0 +1,331 @@
+'''
+Local stand-in for the ITk production database (PDB).
+
+Serves the PDB endpoints used by ITkProdDB on a generated component tree (modules with
+bare module, sensor tile, PCB and FE chips), with configurable per-endpoint latency,
+rate limit and failure rate. Used to benchmark and test caching, concurrency and retries
+of the interface without access to the real PDB:
+
+    python pdb_standin.py --port 5050 --modules 100 --latency 0.2
+    PDB_STANDIN_URL=http://127.0.0.1:5050 python get_iref_trims.py
+'''
+import argparse
+import base64
+import copy
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+import urllib.request
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ENDPOINTS = ['getUser', 'getComponent', 'getComponentBulk', 'listComponents', 'getTestRun', 'setComponentStage', 'uploadTestRunResults', 'createTestRunAttachment']
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+class StandInDatabase(object):
+    '''
+    In-memory component tree and test runs of the stand-in PDB.
+    '''
+
+    def __init__(self, n_modules=10, institution='BONN', seed=0, vendor='IZM'):
+        self.institution = institution
+        self.vendor = vendor  # owner of the bare modules, which are located at `institution`
+        self.components = {}
+        self.test_runs = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        for i in range(n_modules):
+            self._add_module(i)
+
+    def _add_component(self, sn, component_type, stage, owner=None):
+        self.components[sn] = {
+            'id': hashlib.md5(sn.encode()).hexdigest()[:24],
+            'serialNumber': sn,
+            'componentType': {'code': component_type},
+            'institution': {'code': owner or self.institution},
+            'currentLocation': {'code': self.institution},
+            'currentStage': {'code': stage},
+            'stages': [{'code': stage, 'dateTime': _now()}],
+            'children': [],
+            'parents': [],
+            'tests': [],
+            'stateTs': _now(),
+        }
+        return self.components[sn]
+
+    def _link(self, parent_sn, child_sn):
+        parent, child = self.components[parent_sn], self.components[child_sn]
+        parent['children'].append({'componentType': child['componentType'], 'component': {'serialNumber': child_sn}})
+        child['parents'].append({'componentType': parent['componentType'], 'component': {'serialNumber': parent_sn}})
+
+    def _add_module(self, i):
+        module_sn = '20UPGM2211{0:04d}'.format(i)
+        bare_module_sn = '20UPGB4220{0:04d}'.format(i)
+        sensor_sn = '20UPGS3330{0:04d}'.format(i)
+        pcb_sn = '20UPGPQ211{0:04d}'.format(i)
+        self._add_component(module_sn, 'MODULE', 'MODULE/ASSEMBLY')
+        self._add_component(bare_module_sn, 'BARE_MODULE', 'BAREMODULEASSEMBLY', owner=self.vendor)
+        self._add_component(sensor_sn, 'SENSOR_TILE', 'WAFER_PROCESSING')
+        self._add_component(pcb_sn, 'PCB', 'QA_PRE_THERMAL_CYCLE')
+        self._link(module_sn, bare_module_sn)
+        self._link(module_sn, pcb_sn)
+        self._link(bare_module_sn, sensor_sn)
+        for k in range(4):
+            chip_sn = '20UPGFC{0:07d}'.format(0x10000 + i * 4 + k)
+            self._add_component(chip_sn, 'FE_CHIP', 'WAFER_PROBING')
+            self._link(bare_module_sn, chip_sn)
+            self.upload_test_run({'component': chip_sn, 'testType': 'FECHIP_TEST', 'institution': 'CERN', 'runNumber': '1',
+                                  'date': _now(), 'passed': True, 'problems': False,
+                                  'results': {'IREF_TRIM': self._rng.randint(0, 15)}})
+
+    def get_component(self, sn):
+        with self._lock:
+            return copy.deepcopy(self.components[sn])
+
+    def get_components(self, sns):
+        with self._lock:
+            return [copy.deepcopy(self.components[sn]) for sn in sns if sn in self.components]
+
+    def list_components(self, component_types=None, institutions=None):
+        with self._lock:
+            return [{'serialNumber': c['serialNumber'], 'componentType': c['componentType'], 'currentStage': c['currentStage'],
+                     'stateTs': c['stateTs']} for c in self.components.values()
+                    if (not component_types or c['componentType']['code'] in component_types)
+                    and (not institutions or c['currentLocation']['code'] in institutions)]
+
+    def get_test_run(self, test_run_id):
+        with self._lock:
+            return copy.deepcopy(self.test_runs[test_run_id])
+
+    def set_stage(self, sn, stage):
+        with self._lock:
+            component = self.components[sn]
+            component['currentStage'] = {'code': stage}
+            component['stages'].append({'code': stage, 'dateTime': _now()})
+            component['stateTs'] = _now()
+
+    def ship(self, sn, location):
+        ''' Moves component `sn` to institution `location`.
+        '''
+        with self._lock:
+            component = self.components[sn]
+            component['currentLocation'] = {'code': location}
+            component['stateTs'] = _now()
+
+    def upload_test_run(self, data):
+        with self._lock:
+            component = self.components[data['component']]
+            test_run_id = hashlib.md5('{0}{1}'.format(len(self.test_runs), data['component']).encode()).hexdigest()[:24]
+            summary = {'id': test_run_id, 'runNumber': data.get('runNumber'), 'date': data.get('date'), 'stateTs': _now(),
+                       'passed': data.get('passed'), 'problems': data.get('problems'), 'state': 'ready',
+                       'institution': {'code': data.get('institution')}}
+            for test in component['tests']:
+                if test['code'] == data['testType']:
+                    test['testRuns'].append(summary)
+                    break
+            else:
+                component['tests'].append({'code': data['testType'], 'testRuns': [summary]})
+            component['stateTs'] = summary['stateTs']
+            self.test_runs[test_run_id] = dict(summary, testType={'code': data['testType']},
+                                               properties=[{'code': k, 'value': v} for k, v in (data.get('properties') or {}).items()],
+                                               results=[{'code': k, 'value': v} for k, v in (data.get('results') or {}).items()],
+                                               components=[{'serialNumber': data['component'], 'testedAtStage': component['currentStage']}],
+                                               attachments=[])
+        return {'testRun': {'id': test_run_id}}
+
+    def add_attachment(self, data):
+        with self._lock:
+            test_run = self.test_runs[data['testRun']]
+            content = base64.b64decode(data.pop('content', ''))
+            attachment = dict(data, code=hashlib.md5(content).hexdigest(), size=len(content))
+            test_run['attachments'].append(attachment)
+        return attachment
+
+
+class StandInServer(ThreadingHTTPServer):
+    '''
+    HTTP server of the stand-in PDB.
+
+    latency: {endpoint: seconds} mean response time per endpoint ('*' for all others), jittered by +-50%
+    failure_rate: {endpoint: probability} of answering with 503 ('*' for all others)
+    rate_limit: maximum requests per second over all endpoints, excess requests are answered with 429
+    stage_delay: seconds until a stage change becomes visible in getComponent
+    bulk_limit: maximum number of components per getComponentBulk request
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, database, latency=None, failure_rate=None, rate_limit=None, stage_delay=0.0, bulk_limit=100):
+        ThreadingHTTPServer.__init__(self, address, StandInRequestHandler)
+        self.database = database
+        self.latency = latency or {}
+        self.failure_rate = failure_rate or {}
+        self.rate_limit = rate_limit
+        self.stage_delay = stage_delay
+        self.bulk_limit = bulk_limit
+        self.calls = {}
+        self._tokens = rate_limit or 0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+        self._rng = random.Random(1)
+
+    def _per_endpoint(self, setting, endpoint):
+        return setting.get(endpoint, setting.get('*', 0.0))
+
+    def admit(self, endpoint):
+        ''' Returns HTTP status to simulate for a request (200 if it is served normally).
+        '''
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            if self.rate_limit:
+                now = time.monotonic()
+                self._tokens = min(self.rate_limit, self._tokens + (now - self._last_refill) * self.rate_limit)
+                self._last_refill = now
+                if self._tokens < 1.0:
+                    return 429
+                self._tokens -= 1.0
+            if self._rng.random() < self._per_endpoint(self.failure_rate, endpoint):
+                return 503
+            delay = self._per_endpoint(self.latency, endpoint) * self._rng.uniform(0.5, 1.5)
+        time.sleep(delay)
+        return 200
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logging.getLogger('PDBStandIn').debug(format % args)
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        endpoint = self.path.strip('/').split('?')[0].split('/')[-1]
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if endpoint not in ENDPOINTS:
+            return self._reply(404, {'uuAppErrorMap': {'unknownEndpoint': endpoint}})
+        status = self.server.admit(endpoint)
+        if status != 200:
+            return self._reply(status, {'uuAppErrorMap': {'standIn': 'simulated error {0}'.format(status)}})
+
+        db = self.server.database
+        try:
+            if endpoint == 'getUser':
+                ret = {'userIdentity': body.get('userIdentity'), 'firstName': 'Stand', 'lastName': 'In'}
+            elif endpoint == 'getComponent':
+                ret = db.get_component(body['component'])
+            elif endpoint == 'getComponentBulk':
+                if len(body['component']) > self.server.bulk_limit:
+                    return self._reply(400, {'uuAppErrorMap': {'tooManyComponents': len(body['component'])}})
+                ret = {'itemList': db.get_components(body['component'])}
+            elif endpoint == 'listComponents':
+                ret = {'itemList': db.list_components(body.get('componentType'), body.get('currentLocation'))}
+            elif endpoint == 'getTestRun':
+                ret = db.get_test_run(body['testRun'])
+            elif endpoint == 'setComponentStage':
+                if self.server.stage_delay > 0:
+                    timer = threading.Timer(self.server.stage_delay, db.set_stage, (body['component'], body['stage']))
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    db.set_stage(body['component'], body['stage'])
+                ret = {}
+            elif endpoint == 'uploadTestRunResults':
+                ret = db.upload_test_run(body)
+            elif endpoint == 'createTestRunAttachment':
+                ret = db.add_attachment(body)
+        except KeyError as e:
+            return self._reply(400, {'uuAppErrorMap': {'notFound': str(e)}})
+        self._reply(200, dict(ret, uuAppErrorMap={}))
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class StandInClient(object):
+    '''
+    Minimal client with the get/post interface of itkdb.Client talking to a stand-in server.
+    '''
+
+    class User(object):
+        identity = 'standin'
+        bearer = 'standin'
+
+        def authenticate(self):
+            return True
+
+        def is_expired(self):
+            return False
+
+    def __init__(self, url, timeout=30.0):
+        self.url = url.rstrip('/')
+        self.prefix_url = self.url + '/'
+        self.timeout = timeout
+        self.user = StandInClient.User()
+
+    def _request(self, method, endpoint, body):
+        request = urllib.request.Request('{0}/{1}'.format(self.url, endpoint), method=method,
+                                         data=json.dumps(body, default=str).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            ret = json.loads(response.read())
+        ret.pop('uuAppErrorMap', None)
+        return ret.get('itemList', ret)  # list responses are unwrapped like by itkdb
+
+    def get(self, endpoint, json=None):
+        return self._request('GET', endpoint, json or {})
+
+    def post(self, endpoint, json=None, data=None, files=None):
+        body = dict(json or data or {})
+        if files is not None:
+            fileobj = files['data'][1]
+            fileobj.seek(0)
+            body['content'] = base64.b64encode(fileobj.read()).decode('ascii')
+        return self._request('POST', endpoint, body)
+
+
+def _parse_setting(values):
+    ''' Parses settings of the form `0.1` (all endpoints) or `getComponent=0.1`.
+    '''
+    setting = {}
+    for value in values or []:
+        endpoint, _, v = value.rpartition('=')
+        setting[endpoint or '*'] = float(v)
+    return setting
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in of the ITk production database')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--modules', type=int, default=10, help='Number of generated modules')
+    parser.add_argument('--latency', action='append', help='Response time in s, e.g. 0.2 or getComponent=0.3')
+    parser.add_argument('--failure-rate', action='append', help='Probability of 503 errors, e.g. 0.01 or uploadTestRunResults=0.1')
+    parser.add_argument('--rate-limit', type=float, default=None, help='Maximum requests per second')
+    parser.add_argument('--stage-delay', type=float, default=0.0, help='Delay in s until stage changes are applied')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = StandInServer((args.host, args.port), StandInDatabase(n_modules=args.modules),
+                           latency=_parse_setting(args.latency), failure_rate=_parse_setting(args.failure_rate),
+                           rate_limit=args.rate_limit, stage_delay=args.stage_delay)
+    logging.getLogger('PDBStandIn').info('Serving stand-in PDB on http://{0}:{1}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.calls, indent=4))
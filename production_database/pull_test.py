@@ -0,0 +1,128 @@
+'''
+Parser of wire bond pull test exports of the bonder (F&K Delvotec 5600).
+
+Header fields are located by regular expression instead of line numbers and character
+offsets, and the pull table is read into NumPy arrays while the file is streamed line by
+line. A file can contain several runs (e.g. several modules): a header field following pull
+rows starts a new run.
+
+    runs = parse_pull_tests('Pull Werte F131 0142.txt')
+    results = pull_statistics(runs[-1])
+'''
+import logging
+import re
+from datetime import datetime
+
+import numpy as np
+
+# Break codes of the pull table
+PCB_HEEL_BREAK = 1
+FE_HEEL_BREAK = 2
+
+_HEADER = {
+    'date': re.compile(r'Sample date\D*(\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(?::\d{2})?)'),
+    'sample': re.compile(r'Sample (?:name|id)\s*:?\s*(.*\S)', re.IGNORECASE),
+    'tests': re.compile(r'\bTests\s*:?\s*(\d+)'),
+    'failures': re.compile(r'\bFailures\s*:?\s*(\d+)'),
+}
+
+log = logging.getLogger('PullTest')
+
+
+def _parse_row(line):
+    ''' Returns (strength, passed, break type) of a row of the pull table ('<no> ... <strength> Pass ... Break <code>'), None for other lines.
+        Plain string search, as bonder logs can have millions of rows.
+    '''
+    i = line.find(' Pass')
+    passed = i >= 0
+    if not passed:
+        i = line.find(' Fail')
+        if i < 0:
+            return None
+    j = line.find('Break', i)
+    if j < 0:
+        return None
+    try:
+        return float(line[:i].rsplit(None, 1)[-1]), passed, int(line[j + 5:].lstrip(' :').split(None, 1)[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def _new_run():
+    return {'date': None, 'sample': None, 'tests': None, 'failures': None, 'strength': [], 'passed': [], 'break_type': []}
+
+
+def _finish(run):
+    run['strength'] = np.array(run['strength'], dtype=float)
+    run['passed'] = np.array(run['passed'], dtype=bool)
+    run['break_type'] = np.array(run['break_type'], dtype=int)
+    if run['tests'] is not None and run['tests'] != len(run['strength']):
+        log.warning('Pull test run of {0}: {1} tests in header, {2} pulls in table'.format(run['date'], run['tests'], len(run['strength'])))
+    return run
+
+
+def parse_pull_tests(filename, encoding='ISO-8859-1'):
+    ''' Returns list of runs in pull test export `filename`. A run is a dict with header fields
+        (date as datetime, sample, tests, failures; None if missing) and the pull table as arrays
+        'strength' (in g), 'passed' and 'break_type'.
+    '''
+    runs = []
+    run = _new_run()
+    with open(filename, encoding=encoding) as f:
+        for line in f:
+            row = _parse_row(line)
+            if row is not None:
+                run['strength'].append(row[0])
+                run['passed'].append(row[1])
+                run['break_type'].append(row[2])
+                continue
+            for field, pattern in _HEADER.items():
+                match = pattern.search(line)
+                if match is None:
+                    continue
+                if run['strength'] or run[field] is not None:  # header of the next run
+                    runs.append(_finish(run))
+                    run = _new_run()
+                value = match.group(1)
+                if field == 'date':
+                    value = datetime.strptime(value.replace('T', ' ')[:16], '%Y-%m-%d %H:%M')
+                elif field in ['tests', 'failures']:
+                    value = int(value)
+                run[field] = value
+                break
+    if run['strength'] or any(run[field] is not None for field in _HEADER):
+        runs.append(_finish(run))
+    return [run for run in runs if len(run['strength'])]
+
+
+def pull_statistics(run):
+    ''' Returns results of WIREBOND_PULL_TEST of one run (see parse_pull_tests).
+    '''
+    strength, break_type = run['strength'], run['break_type']
+    n_pulls = len(strength)
+    unknown = ~np.isin(break_type, [PCB_HEEL_BREAK, FE_HEEL_BREAK])
+    if unknown.any():
+        log.warning('Unknown break types {0} in pull test of {1}'.format(sorted(set(break_type[unknown].tolist())), run['date']))
+    return {
+        "WIRE_PULLS": n_pulls,
+        "PULL_STRENGTH": round(float(np.mean(strength)), 3),
+        "PULL_STRENGTH_ERROR": round(float(np.std(strength, ddof=1)), 3) if n_pulls > 1 else 0.0,
+        "PULL_STRENGTH_MIN": float(np.min(strength)),
+        "PULL_STRENGTH_MAX": float(np.max(strength)),
+        "WIRE_BREAKS_5G": int(np.count_nonzero(strength < 5.0)),
+        "HEEL_BREAKS_ON_FE_CHIP": round(float(np.count_nonzero(break_type == FE_HEEL_BREAK)) * 100.0 / n_pulls, 1),
+        "HEEL_BREAKS_ON_PCB": round(float(np.count_nonzero(break_type == PCB_HEEL_BREAK)) * 100.0 / n_pulls, 1),
+        "BOND_PEEL": run['failures'] if run['failures'] is not None else int(np.count_nonzero(~run['passed'])),
+        "PULL_STRENGTH_GRADING": strength.tolist()}
+
+
+def select_run(runs, sn, filename=None):
+    ''' Returns the run whose sample name contains the short number (last four digits) of `sn`.
+        A file with a single run is taken as the run of `sn`, otherwise a ValueError is raised if no sample name matches.
+    '''
+    for run in reversed(runs):
+        if run['sample'] and int(sn[-4:]) in [int(t) for t in re.findall(r'\d{3,}', run['sample'])]:
+            return run
+    if len(runs) == 1:
+        return runs[0]
+    raise ValueError('None of the {0} pull tests in {1} belongs to {2}'.format(len(runs), filename, sn))
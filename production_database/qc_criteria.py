@@ -0,0 +1,174 @@
+'''
+QC requirements (required tests per stage and accepted result ranges) loaded from qc_criteria.yaml,
+and evaluation of the result ranges over many test runs at once.
+'''
+import os
+
+import numpy as np
+import yaml
+
+from test_run_index import TestRunIndex
+
+CRITERIA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qc_criteria.yaml')
+
+
+def load_criteria(filename=CRITERIA_FILE):
+    ''' Returns (required tests per component type and stage, result ranges per test type,
+        test types whose ranges are not validated against the QC specification).
+    '''
+    with open(filename) as f:
+        config = yaml.safe_load(f)
+    return config['required_tests'], config['criteria'], set(config.get('unvalidated') or [])
+
+
+REQUIRED_TESTS, CRITERIA, UNVALIDATED = load_criteria()
+REQUIRED_TESTS_MODULE = REQUIRED_TESTS['MODULE']
+REQUIRED_TESTS_BARE_MODULE = REQUIRED_TESTS['BARE_MODULE']
+
+
+def _to_array(value):
+    try:
+        return np.atleast_1d(np.asarray(value, dtype=float))
+    except (TypeError, ValueError):
+        return np.array([np.nan])
+
+
+def results_table(test_runs, codes=None):
+    ''' Flattens results of test runs (getTestRun responses or upload payloads) into {code: array of shape (runs, elements)}.
+        Missing and non-numeric values are NaN. Only `codes` are extracted if given.
+    '''
+    values = {}
+    for i, test_run in enumerate(test_runs):
+        results = test_run['results']
+        items = results.items() if isinstance(results, dict) else ((res['code'], res['value']) for res in results)
+        for code, value in items:
+            if codes is None or code in codes:
+                values.setdefault(code, {})[i] = _to_array(value)
+
+    table = {}
+    for code, run_values in values.items():
+        n_elements = max(len(v) for v in run_values.values())
+        table[code] = np.full((len(test_runs), n_elements), np.nan)
+        for i, v in run_values.items():
+            table[code][i, :len(v)] = v
+    return table
+
+
+def check_envelopes(test_type, test_runs, criteria=None):
+    ''' Checks all result ranges of `test_type` for all `test_runs` (getTestRun responses or upload payloads) at once.
+        Returns (passed per run, {code: (values, passed, margin, present)}) with arrays of shape (runs, elements) for
+        values, passed and margin (distance to the nearer limit, negative outside), and present per run.
+    '''
+    if criteria is None:
+        criteria = CRITERIA[test_type]
+    table = results_table(test_runs, codes=criteria)
+    n_runs = len(test_runs)
+    run_passed = np.ones(n_runs, dtype=bool)
+    checks = {}
+    for code, limits in criteria.items():
+        limits = np.asarray(limits, dtype=float).reshape(-1, 2)  # one (lower, upper) row per element
+        values = table.get(code, np.full((n_runs, 0), np.nan))
+        present = ~np.all(np.isnan(values), axis=1) if values.shape[1] else np.zeros(n_runs, dtype=bool)
+        padded = np.full((n_runs, max(len(limits), values.shape[1])), np.nan)
+        padded[:, :values.shape[1]] = values
+        if len(limits) == 1:
+            limits = np.repeat(limits, padded.shape[1], axis=0)
+        padded = padded[:, :len(limits)]
+        passed = (padded > limits[:, 0]) & (padded < limits[:, 1])  # NaN (missing element) fails
+        margin = np.minimum(padded - limits[:, 0], limits[:, 1] - padded)
+        run_passed &= np.all(passed, axis=1) | ~present
+        checks[code] = (values, passed, margin, present)
+    return run_passed, checks
+
+
+def evaluate_criteria(test_type, test_runs, criteria=None):
+    ''' Evaluates all result ranges of `test_type` for all `test_runs` at once.
+        Returns one verdict per test run: {'testRun': ID, 'passed': bool, 'checks': {code: check}}, with
+        check = {'value': list, 'range': criteria range, 'passed': bool per element, 'margin': distance to the
+        nearer limit per element}. Results without criteria are not checked, criteria without result in the test
+        run are reported with passed None.
+    '''
+    if criteria is None:
+        criteria = CRITERIA[test_type]
+    run_passed, checks = check_envelopes(test_type, test_runs, criteria)
+
+    verdicts = []
+    for i, test_run in enumerate(test_runs):
+        verdict = {'testRun': test_run.get('id'), 'passed': bool(run_passed[i]), 'checks': {}}
+        for code, (values, passed, margin, present) in checks.items():
+            verdict['checks'][code] = {'value': [v for v in values[i].tolist() if not np.isnan(v)] if values.shape[1] else None,
+                                       'range': criteria[code],
+                                       'passed': passed[i].tolist() if present[i] else None,
+                                       'margin': margin[i].tolist() if present[i] else None}
+        verdicts.append(verdict)
+    return verdicts
+
+
+def grade_payload(data):
+    ''' Sets 'passed' of upload payload `data` from the criteria of its test type and returns the verdict.
+        Test types without criteria or with unvalidated criteria are not graded (passed is kept, returns None).
+    '''
+    if data['testType'] not in CRITERIA or data['testType'] in UNVALIDATED:
+        return None
+    verdict = evaluate_criteria(data['testType'], [data])[0]
+    data['passed'] = verdict['passed']
+    return verdict
+
+
+def failed_checks(verdict):
+    ''' Returns codes of the failed checks of a verdict.
+    '''
+    return [code for code, check in verdict['checks'].items() if check['passed'] is not None and not all(check['passed'])]
+
+
+def missing_tests_status(module_sn, module, bare_module_sn, bare_module):
+    ''' Returns stages, present and required but missing tests of a module and its bare module (getComponent responses).
+        `bare_module_sn` and `bare_module` are None for a module without bare module child.
+    '''
+    current_stage = module['currentStage']['code']
+    required = REQUIRED_TESTS_MODULE.get(current_stage, [])
+    # FIXME: VI is special. Needs to be uploaded for MODULE/ASSEMBLY and MODULE/WIREBONDING
+    test_runs = TestRunIndex(module)
+    found_tests = [t for t in test_runs.test_types() if t not in ['VISUAL_INSPECTION'] or test_runs.has(t, current_stage)]
+    status = {'module_sn': module_sn,
+              'stage': current_stage,
+              'module_tests': found_tests,
+              'missing_module_tests': sorted(set(required) - set(found_tests))}
+
+    if bare_module is None:  # module without bare module child
+        status.update({'bare_module_sn': None,
+                       'bare_module_stage': None,
+                       'bare_module_tests': [],
+                       'missing_bare_module_tests': []})
+        return status
+
+    current_stage = bare_module['currentStage']['code']
+    required = REQUIRED_TESTS_BARE_MODULE.get(current_stage, [])
+    found_tests = [r['code'] for r in bare_module['tests']]
+    status.update({'bare_module_sn': bare_module_sn,
+                   'bare_module_stage': current_stage,
+                   'bare_module_tests': found_tests,
+                   'missing_bare_module_tests': sorted(set(required) - set(found_tests))})
+    return status
+
+
+def log_missing_tests(log, status):
+    ''' Logs present and missing tests of a status returned by missing_tests_status.
+    '''
+    module_sn = status['module_sn']
+    log.info('Checking tests for module: {0} (at stage {1})...'.format(module_sn, status['stage']))
+    for test in status['module_tests']:
+        log.info('Found module test: {0} for module {1}'.format(test, module_sn))
+    if len(status['missing_module_tests']) == 0:
+        log.info('No missing module tests found')
+    else:
+        log.warning('Missing module tests for module {0}: {1}'.format(module_sn, status['missing_module_tests']))
+
+    if status['bare_module_sn'] is None:
+        return
+    for test in status['bare_module_tests']:
+        log.info('Found bare module test: {0} for bare module {1}'.format(test, status['bare_module_sn']))
+    if len(status['missing_bare_module_tests']) == 0:
+        log.info('No missing bare module tests found')
+    else:
+        log.warning('Missing bare module tests for bare module {0}: {1}'.format(status['bare_module_sn'], status['missing_bare_module_tests']))
@@ -0,0 +1,101 @@
+'''
+QC status report of many modules: stage, missing tests and pass/fail of the test criteria
+of every module in one table (CSV or HTML).
+
+    python qc_status_report.py 20UPGM22110131 20UPGM22110168 ... -o status.html
+    python qc_status_report.py --institution BONN -o status.html
+    python qc_status_report.py --institution BONN --mirror pdb_mirror.sqlite -o status.html
+'''
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from tqdm import tqdm
+
+from itkprodDB_interface import ITkProdDB
+
+# (getter of ITkProdDB, tests) evaluated against the QC criteria for every module
+CRITERIA_CHECKS = [
+    ('get_assembly_data', ['QUAD_MODULE_METROLOGY']),
+    ('get_iv_data', ['IV_MEASURE']),
+    ('get_bare_assembly_data', ['QUAD_BARE_MODULE_METROLOGY']),
+    ('get_bare_iv_data', ['IV_MEASURE']),
+]
+
+
+class QCStatusReport(object):
+    '''
+    Collects the QC status of many modules concurrently.
+    '''
+
+    def __init__(self, itk_prodDB, max_workers=8, from_mirror=False):
+        self.itk_prodDB = itk_prodDB
+        self.max_workers = max_workers
+        self.from_mirror = from_mirror  # stages and tests of mirrored components from the mirror of `itk_prodDB`
+        self.log = logging.getLogger('QCStatusReport')
+
+    def module_status(self, module_sn):
+        ''' Returns QC status of one module as dict (one row of the report).
+        '''
+        row = {'module_sn': module_sn}
+        try:
+            row.update(self.itk_prodDB.get_missing_tests(module_sn, from_mirror=self.from_mirror))
+            for getter, tests in CRITERIA_CHECKS:
+                row.update(getattr(self.itk_prodDB, getter)(module_sn, tests, {}))
+        except Exception as e:  # one broken module must not stop the report
+            self.log.error('Could not get QC status of {0}: {1}'.format(module_sn, e))
+            row['error'] = str(e)
+        return row
+
+    def run(self, module_sns, progress=True):
+        ''' Returns QC status of all modules as DataFrame with one row per module (in order of `module_sns`).
+        '''
+        self.itk_prodDB.get_components(module_sns, from_mirror=self.from_mirror)  # warm the cache with bulk requests
+        rows = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.module_status, sn): sn for sn in module_sns}
+            for future in tqdm(as_completed(futures), total=len(futures), disable=not progress, desc='Modules'):
+                rows[futures[future]] = future.result()
+
+        report = pd.DataFrame([rows[sn] for sn in module_sns])
+        for column in ['module_tests', 'missing_module_tests', 'bare_module_tests', 'missing_bare_module_tests']:
+            if column in report:
+                report[column] = report[column].apply(lambda v: ', '.join(v) if isinstance(v, list) else v)
+        return report
+
+
+def write_report(report, filename):
+    ''' Writes report as .csv or .html depending on the file extension.
+    '''
+    if filename.endswith('.html'):
+        report.to_html(filename, index=False, na_rep='')
+    else:
+        report.to_csv(filename, index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='QC status report of modules in the ITk production database')
+    parser.add_argument('module_sns', nargs='*', help='Module S/Ns, or a text file with one S/N per line')
+    parser.add_argument('--institution', default=None, help='Report all modules at this institution (e.g. BONN)')
+    parser.add_argument('-o', '--output', default='qc_status.csv', help='Output file (.csv or .html)')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='Number of modules processed concurrently')
+    parser.add_argument('--mirror', default=None, help='Take stages and tests of mirrored components from this mirror file (see pdb_mirror.py)')
+    args = parser.parse_args()
+
+    module_sns = []
+    for sn in args.module_sns:
+        if sn.endswith('.txt'):
+            with open(sn) as f:
+                module_sns.extend(line.strip() for line in f if line.strip())
+        else:
+            module_sns.append(sn)
+
+    if not module_sns and args.institution is None:
+        parser.error('give module S/Ns or --institution')
+
+    with ITkProdDB(mirror_file=args.mirror) as itk_prodDB:
+        if args.institution is not None:
+            module_sns.extend(sn for sn in itk_prodDB.list_components('MODULE', args.institution) if sn not in module_sns)
+        report = QCStatusReport(itk_prodDB, max_workers=args.jobs, from_mirror=args.mirror is not None).run(module_sns)
+    write_report(report, args.output)
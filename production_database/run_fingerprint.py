@@ -0,0 +1,79 @@
+'''
+Fingerprints of test runs to detect duplicate uploads, and automatic run numbers.
+
+A fingerprint covers component, test type, date (to the minute) and results of a test run,
+but not its run number, so an upload payload and the test run it created in the PDB have
+the same fingerprint.
+'''
+import hashlib
+import json
+
+# Run number of payloads which get the next free run number of the component assigned at upload
+AUTO_RUN_NUMBER = None
+
+
+def _normalize(value):
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)  # 1 and 1.0 are the same result
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items() if v is not None}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return str(value)
+
+
+def fingerprint(component, test_type, date, results):
+    ''' Returns fingerprint of a test run. `results` is a dict {code: value}, unset (None) results are ignored.
+    '''
+    content = [component, test_type, (date or '')[:16], _normalize(results)]
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def fingerprint_of_payload(data):
+    ''' Returns fingerprint of an uploadTestRunResults payload.
+    '''
+    return fingerprint(data['component'], data['testType'], data.get('date'), data.get('results') or {})
+
+
+def fingerprint_of_test_run(component, test_run):
+    ''' Returns fingerprint of a getTestRun response of `component`.
+    '''
+    results = {r['code']: r.get('value') for r in test_run.get('results') or []}
+    return fingerprint(component, test_run['testType']['code'], test_run.get('date'), results)
+
+
+def next_run_number(test_runs):
+    ''' Returns next free run number (as string) after the numeric run numbers of `test_runs`.
+    '''
+    numbers = [int(run['runNumber']) for run in test_runs if str(run.get('runNumber')).isdigit()]
+    return str(max(numbers, default=0) + 1)
+
+
+def duplicate_candidates(component, data):
+    ''' Returns IDs of the test runs of `component` (getComponent response) which could be duplicates of payload
+        `data`: runs of the same test type and date.
+    '''
+    return [run['id'] for test in component['tests'] if test['code'] == data['testType']
+            for run in test['testRuns'] if (run.get('date') or '')[:16] == (data.get('date') or '')[:16]]
+
+
+def find_duplicate(data, test_runs):
+    ''' Returns ID of the test run (getTestRun responses of the candidates) identical to payload `data`, None if there is none.
+    '''
+    fingerprint = fingerprint_of_payload(data)
+    for test_run in test_runs:
+        if fingerprint_of_test_run(data['component'], test_run) == fingerprint:
+            return test_run['id']
+    return None
+
+
+def with_run_number(component, data):
+    ''' Returns payload `data`, with the next free run number of its test type in `component` (getComponent response)
+        if it has none.
+    '''
+    if data.get('runNumber') is not None:
+        return data
+    test_runs = [run for test in component['tests'] if test['code'] == data['testType'] for run in test['testRuns']]
+    return dict(data, runNumber=next_run_number(test_runs))
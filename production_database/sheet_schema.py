@@ -0,0 +1,297 @@
+'''
+Extraction of test run payloads from QC spreadsheets with the cell maps of sheet_schemas.yaml.
+
+A cell map is compiled once into row/column slices. The template version of a workbook is identified
+by its signature cell (the template title). Extraction takes only the referenced cells
+of the sheet matrix, reduces ranges with NumPy, validates types and plausibility ranges and
+returns uploadTestRunResults payloads, e.g.
+
+    payloads = extract_payloads('ITk Flex 78.xls', 'flex')
+    payloads['metrology']['results']['X_DIMENSION']
+'''
+import os
+import re
+from datetime import datetime
+
+import numpy as np
+import yaml
+
+from run_fingerprint import AUTO_RUN_NUMBER
+from workbook import read_sheet
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sheet_schemas.yaml')
+
+_CELL = re.compile(r'^([A-Z]+)(\d+)$')
+_TRUE = ['1', 'yes', 'true', 'pass', 'ok']
+_FALSE = ['0', 'no', 'false', 'fail']
+
+
+def parse_cell(ref):
+    ''' Returns 0-based (row, column) of spreadsheet cell reference `ref`, e.g. 'G6' -> (5, 6).
+    '''
+    match = _CELL.match(ref.strip().upper())
+    if match is None:
+        raise ValueError('Invalid cell reference {0}'.format(ref))
+    column = 0
+    for c in match.group(1):
+        column = column * 26 + ord(c) - ord('A') + 1
+    return int(match.group(2)) - 1, column - 1
+
+
+def _is_empty(value):
+    return value is None or value != value or (isinstance(value, str) and not value.strip())  # NaN/NaT != itself
+
+
+def _native(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class Field(object):
+    '''
+    One result of a cell map: a cell or a column/row range with reduction, scaling, type and range check.
+    '''
+
+    def __init__(self, name, spec):
+        self.name = name
+        ref = spec.get('cells', spec.get('cell'))
+        first, _, last = ref.partition(':')
+        self.first = parse_cell(first)
+        self.last = parse_cell(last) if last else self.first
+        self.is_range = bool(last)
+        self.reduce = spec.get('reduce', 'list' if self.is_range else None)
+        self.scale = spec.get('scale')
+        self.digits = spec.get('round')
+        self.type = spec.get('type', 'float')
+        self.as_list = spec.get('as_list', False)
+        self.range = spec.get('range')
+        self.optional = spec.get('optional', False)
+        if self.reduce not in [None, 'list', 'mean', 'std', 'ptp', 'flags']:
+            raise ValueError('Unknown reduce {0} of {1}'.format(self.reduce, name))
+
+    def cells(self):
+        ''' Returns (rows, columns) slices of the referenced cells.
+        '''
+        return slice(self.first[0], self.last[0] + 1), slice(self.first[1], self.last[1] + 1)
+
+    def _error(self, message):
+        return ValueError('{0} ({1}): {2}'.format(self.name, self._ref(), message))
+
+    def _ref(self):
+        def a1(cell):
+            column, letters = cell[1] + 1, ''
+            while column:
+                column, rest = divmod(column - 1, 26)
+                letters = chr(ord('A') + rest) + letters
+            return '{0}{1}'.format(letters, cell[0] + 1)
+        return a1(self.first) + (':' + a1(self.last) if self.is_range else '')
+
+    def _value(self, value):
+        ''' Converts a single cell to str, bool or (unscaled) float, None for empty optional cells.
+        '''
+        if self.type == 'str':
+            return '' if _is_empty(value) else str(value)
+        if _is_empty(value):
+            if self.optional:
+                return None
+            raise self._error('empty cell')
+        if self.type == 'bool':
+            if isinstance(value, str):
+                if value.strip().lower() not in _TRUE + _FALSE:
+                    raise self._error('{0!r} is not bool'.format(value))
+                return value.strip().lower() in _TRUE
+            return bool(value)
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise self._error('{0!r} is not a number'.format(value))
+
+    def _number(self, value):
+        ''' Applies scale, rounding, type and range check to a (reduced) number.
+        '''
+        if value is None:
+            return None
+        value = float(value) * self.scale if self.scale is not None else float(value)
+        if self.digits is not None:
+            value = round(value, self.digits)
+        if self.type == 'int':
+            value = int(value)
+        if self.range is not None and not (self.range[0] <= value <= self.range[1]):
+            raise self._error('{0} outside plausible range {1}'.format(value, self.range))
+        return value
+
+    def extract(self, data):
+        ''' Returns value of the field in sheet matrix `data`.
+        '''
+        rows, columns = self.cells()
+        if rows.stop > data.shape[0] or columns.stop > data.shape[1]:
+            raise self._error('outside of sheet')
+        block = data[rows, columns]
+        if self.reduce == 'flags':
+            flags = [v == 1 or str(v).strip().lower() == 'yes' for v in block.ravel()]
+            return [i + 1 for i, flag in enumerate(flags) if flag]
+        if self.is_range:
+            try:
+                values = np.asarray(block.ravel(), dtype=float)
+            except (TypeError, ValueError):
+                raise self._error('non-numeric cells')
+            if np.isnan(values).any():
+                raise self._error('empty cells')
+            if self.reduce == 'list':
+                return [self._number(v) for v in values]
+            value = self._number({'mean': np.mean, 'std': np.std, 'ptp': np.ptp}[self.reduce](values))
+        else:
+            value = self._value(_native(block[0, 0]))
+            if self.type in ['float', 'int']:
+                value = self._number(value)
+        return [value] if self.as_list else value
+
+
+class CellMap(object):
+    '''
+    Compiled cell map of one spreadsheet template version.
+    '''
+
+    def __init__(self, template, spec):
+        self.template = template
+        self.version = spec['version']
+        self.sheet = spec.get('sheet', 0)
+        self.signature = Field('signature', dict(spec['signature'], type='str'))
+        self.signature_pattern = re.compile(spec['signature']['pattern'], re.IGNORECASE)
+        self.institution = spec['institution']
+        self.properties = spec.get('properties', {})
+        self.serial_number = Field('serial number', dict(spec['serial_number'], type='str'))
+        self.sn_prefix = spec['serial_number'].get('prefix', '')
+        self.date = Field('date', dict(spec['date'], type='str'))
+        self.date_format = spec['date'].get('format')
+        self._bounds = None
+        self.tests = {}
+        for name, test in spec['tests'].items():
+            fields = {code: Field(code, v) if isinstance(v, dict) else v for code, v in test['results'].items()}
+            self.tests[name] = (test['testType'], test.get('properties', self.properties), fields)
+
+    def fields(self):
+        yield self.signature
+        yield self.serial_number
+        yield self.date
+        for _, _, fields in self.tests.values():
+            for field in fields.values():
+                if isinstance(field, Field):
+                    yield field
+
+    def bounds(self):
+        ''' Returns (rows, columns) of the top left block of the sheet holding all referenced cells.
+        '''
+        if self._bounds is None:
+            self._bounds = (max(f.last[0] for f in self.fields()) + 1, max(f.last[1] for f in self.fields()) + 1)
+        return self._bounds
+
+    def matches(self, data):
+        ''' True if the signature cell of sheet matrix `data` holds the title of this template version.
+        '''
+        rows, columns = self.signature.cells()
+        if rows.stop > data.shape[0] or columns.stop > data.shape[1]:
+            return False
+        return self.signature_pattern.search(self.signature._value(_native(data[rows, columns][0, 0]))) is not None
+
+    def _component(self, data):
+        sn = self.serial_number.extract(data)
+        if not sn:
+            raise self.serial_number._error('empty cell')
+        return self.sn_prefix + sn.replace(' ', '').replace('-', '')
+
+    def _date(self, data):
+        rows, columns = self.date.cells()
+        value = _native(data[rows, columns][0, 0])
+        if isinstance(value, str):
+            if self.date_format is None:
+                raise self.date._error('{0!r} is no date'.format(value))
+            value = datetime.strptime(value.strip(), self.date_format)
+        if not hasattr(value, 'strftime'):
+            raise self.date._error('{0!r} is no date'.format(value))
+        return value.strftime("%Y-%m-%dT%H:%MZ")
+
+    def extract(self, data, tests=None):
+        ''' Returns {test name: uploadTestRunResults payload} of sheet matrix `data` for `tests` (default: all).
+        '''
+        rows, columns = self.bounds()
+        if data.shape[0] < rows or data.shape[1] < columns:  # empty cells at the end of the sheet
+            padded = np.full((max(rows, data.shape[0]), max(columns, data.shape[1])), np.nan, dtype=object)
+            padded[:data.shape[0], :data.shape[1]] = data
+            data = padded
+        component = self._component(data)
+        date = self._date(data)
+        payloads = {}
+        for name in tests or self.tests:
+            test_type, properties, fields = self.tests[name]
+            payloads[name] = {
+                "component": component,
+                "testType": test_type,
+                "institution": self.institution,
+                "runNumber": AUTO_RUN_NUMBER,  # next free run number is assigned at upload
+                "date": date,
+                "passed": True,
+                "problems": False,
+                "properties": dict(properties),
+                "results": {code: f.extract(data) if isinstance(f, Field) else f for code, f in fields.items()}}
+        return payloads
+
+
+_cell_maps = {}
+
+
+def load_schemas(filename=SCHEMA_FILE):
+    ''' Returns {template: {version: CellMap}} of the schema file.
+    '''
+    with open(filename) as f:
+        config = yaml.safe_load(f)
+    return {template: {spec['version']: CellMap(template, spec) for spec in versions}
+            for template, versions in config['templates'].items()}
+
+
+def _load():
+    if not _cell_maps:
+        _cell_maps.update(load_schemas())
+    return _cell_maps
+
+
+def get_cell_map(template, version=None):
+    ''' Returns compiled cell map of `template` (flex, bare_module, module) in `version` (default: latest).
+    '''
+    if template not in _load():
+        raise KeyError('Unknown spreadsheet template {0}'.format(template))
+    versions = _cell_maps[template]
+    return versions[max(versions) if version is None else version]
+
+
+def get_cell_map_versions(template):
+    ''' Returns versions of `template`.
+    '''
+    if template not in _load():
+        raise KeyError('Unknown spreadsheet template {0}'.format(template))
+    return list(_cell_maps[template])
+
+
+def identify(filename, templates=None):
+    ''' Returns the cell map whose signature matches spreadsheet `filename`, None if no template matches.
+        `templates` are tried in order (default: all), newer versions first.
+    '''
+    for template in templates or list(_load()):
+        for version in sorted(get_cell_map_versions(template), reverse=True):
+            cell_map = get_cell_map(template, version)
+            rows, columns = cell_map.signature.cells()
+            if cell_map.matches(read_sheet(filename, cell_map.sheet, limits=(rows.stop, columns.stop))):
+                return cell_map
+    return None
+
+
+def extract_payloads(filename, template, tests=None, version=None):
+    ''' Returns {test name: payload} of spreadsheet `filename` of `template`, for `tests` (default: all tests of the template).
+        Without `version`, the version is identified by the signature if the template has several.
+    '''
+    if version is None and len(get_cell_map_versions(template)) > 1:
+        cell_map = identify(filename, templates=[template])
+        if cell_map is None:
+            raise ValueError('{0} matches no version of the {1} template'.format(filename, template))
+    else:
+        cell_map = get_cell_map(template, version)
+    return cell_map.extract(read_sheet(filename, cell_map.sheet, limits=cell_map.bounds()), tests)
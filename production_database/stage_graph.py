@@ -0,0 +1,101 @@
+'''
+Declarative stage graphs of ITk components and shortest-path planning of stage transitions.
+'''
+from collections import deque
+
+# Allowed stage transitions per component type: {stage: [next stages]}
+_BARE_MODULE_STAGES = {
+    'sensor_manufacturer': ['WAFER_PROCESSING'],
+    'WAFER_PROCESSING': ['BAREMODULEASSEMBLY'],
+    'BAREMODULEASSEMBLY': ['BAREMODULERECEPTION'],
+}
+
+STAGE_GRAPHS = {
+    'SENSOR_TILE': _BARE_MODULE_STAGES,
+    'BARE_MODULE': _BARE_MODULE_STAGES,
+    'PCB': {
+        'QA_PRE_THERMAL_CYCLE': ['QA_POST_THERMAL_CYCLE'],
+        'QA_POST_THERMAL_CYCLE': ['PCB_QC'],
+        'PCB_QC': ['PCB_READY_FOR_MODULE'],
+        'PCB_READY_FOR_MODULE': ['PCB_RECEPTION_MODULE_SITE'],
+    },
+    'MODULE': {
+        'MODULE/ASSEMBLY': ['MODULE/WIREBONDING'],
+    },
+}
+
+# Stages which can be set directly from any stage of the component type (not only along the graph).
+# The module stage sequence is not modelled yet, so wire bonding data can be uploaded from any module stage.
+DIRECT_STAGES = {
+    'MODULE': ['MODULE/WIREBONDING'],
+}
+
+# Stage at which data is uploaded per component type
+UPLOAD_STAGES = {
+    'SENSOR_TILE': 'BAREMODULERECEPTION',
+    'BARE_MODULE': 'BAREMODULERECEPTION',
+    'PCB': 'PCB_RECEPTION_MODULE_SITE',
+}
+
+
+def plan_stage_path(component_type, current_stage, target_stage):
+    ''' Returns shortest list of stages to set to get from `current_stage` to `target_stage`.
+        Empty list if component is already at target stage, None if target stage is not reachable.
+        Targets in DIRECT_STAGES which are not reachable along the graph are set directly.
+    '''
+    if current_stage == target_stage:
+        return []
+    graph = STAGE_GRAPHS.get(component_type, {})
+    previous = {current_stage: None}
+    queue = deque([current_stage])
+    while queue:
+        stage = queue.popleft()
+        for next_stage in graph.get(stage, []):
+            if next_stage in previous:
+                continue
+            previous[next_stage] = stage
+            if next_stage == target_stage:
+                path = [next_stage]
+                while previous[path[-1]] != current_stage:
+                    path.append(previous[path[-1]])
+                return path[::-1]
+            queue.append(next_stage)
+    if target_stage in DIRECT_STAGES.get(component_type, []):
+        return [target_stage]
+    return None
+
+
+def plan_stage_change(component_type, component_code, current_stage, target_stage):
+    ''' Returns stages to set to move component from `current_stage` to `target_stage`, see plan_stage_path.
+        Raises RuntimeError if the target stage is not reachable.
+    '''
+    set_stages = plan_stage_path(component_type, current_stage, target_stage)
+    if set_stages is None:
+        raise RuntimeError('No stage path of {0} {1} from {2} to {3}'.format(component_type, component_code, current_stage, target_stage))
+    return set_stages
+
+
+def check_stage_changed(component_type, component_code, stage, current_stage):
+    ''' Raises RuntimeError if a stage change to `stage` was not applied.
+    '''
+    if current_stage != stage:
+        raise RuntimeError('Stage of {0} {1} did not change to {2}'.format(component_type, component_code, stage))
+
+
+def stage_of_response(response):
+    ''' Returns stage reported in a setComponentStage response, None if it has none.
+    '''
+    try:
+        return response['component']['currentStage']['code']
+    except (KeyError, TypeError):
+        return None
+
+
+def poll_delays(timeout, initial=0.1, maximum=2.0):
+    ''' Yields exponentially growing delays between polls of a stage change, in total at most `timeout` s.
+    '''
+    delay, total = initial, 0.0
+    while total + delay <= timeout:
+        yield delay
+        total += delay
+        delay = min(delay * 2.0, maximum)
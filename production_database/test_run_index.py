@@ -0,0 +1,64 @@
+'''
+Index of the test runs of one component by test type, stage and time.
+
+Built from a single getComponent response: the test run summaries give type and upload time
+(stateTs), the stage a run was uploaded at is taken from the summary if the PDB provides it
+and otherwise from the stage history of the component. Lookups such as "latest run of type X
+at stage Y" need no getTestRun requests.
+'''
+from bisect import bisect_right
+
+
+class TestRunIndex(object):
+    '''
+    Test run summaries of a component indexed by (test type, stage), ordered by upload time.
+    '''
+
+    def __init__(self, component):
+        self.component_sn = component.get('serialNumber')
+        stages = sorted((s.get('dateTime') or '', s['code']) for s in component.get('stages') or [])
+        self._stage_times = [t for t, _ in stages]
+        self._stage_codes = [code for _, code in stages]
+
+        self._by_id = {}
+        self._by_key = {}  # (test type, stage) -> runs ordered by stateTs
+        for test in component.get('tests') or []:
+            for run in test['testRuns']:
+                entry = dict(run, testType=test['code'], stage=self._stage_of(run))
+                self._by_id[run['id']] = entry
+                self._by_key.setdefault((test['code'], entry['stage']), []).append(entry)
+        for runs in self._by_key.values():
+            runs.sort(key=lambda run: run.get('stateTs') or '')
+
+    def _stage_of(self, run):
+        if run.get('testedAtStage'):
+            return run['testedAtStage']['code']
+        i = bisect_right(self._stage_times, run.get('stateTs') or '')
+        return self._stage_codes[i - 1] if i > 0 else None
+
+    def get(self, test_run_id):
+        ''' Returns summary of test run `test_run_id` (with testType and stage), None if it is not a run of the component.
+        '''
+        return self._by_id.get(test_run_id)
+
+    def test_types(self):
+        return sorted(set(test_type for test_type, _ in self._by_key))
+
+    def runs(self, test_type=None, stage=None):
+        ''' Returns runs of given test type and stage (default: any), oldest first.
+        '''
+        runs = [run for (t, s), runs in self._by_key.items() for run in runs
+                if (test_type is None or t == test_type) and (stage is None or s == stage)]
+        return sorted(runs, key=lambda run: run.get('stateTs') or '')
+
+    def latest(self, test_type, stage=None):
+        ''' Returns latest run of given test type (at `stage`, if given), None if there is none.
+        '''
+        if stage is not None:
+            runs = self._by_key.get((test_type, stage))
+            return runs[-1] if runs else None
+        runs = self.runs(test_type)
+        return runs[-1] if runs else None
+
+    def has(self, test_type, stage=None):
+        return self.latest(test_type, stage) is not None
@@ -2,23 +2,15 @@
 Script to upload IV curve data (.json file) to PDB.
 '''
 import json
-import time
 import logging
-import coloredlogs
 
 from itkprodDB_interface import ITkProdDB
+from pdb_logging import setup_logging, log_payload
+from run_fingerprint import AUTO_RUN_NUMBER
+from stage_graph import UPLOAD_STAGES
+from upload_outbox import UploadOutbox, OUTBOX_FILE
 
-# Logger
-logging.basicConfig()
-loglevel = logging.DEBUG  # logging.INFO
-fmt = '%(asctime)s - [%(name)-15s] - %(levelname)-7s %(message)s'
 log = logging.getLogger('IVDataUploader')
-log.setLevel(loglevel)
-coloredlogs.install(fmt=fmt, milliseconds=False, loglevel=loglevel)
-fh = logging.FileHandler(time.strftime("%Y%m%d_%H%M%S") + '_itkprodDB.log')
-fh.setLevel(loglevel)
-fh.setFormatter(logging.Formatter(fmt))
-log.addHandler(fh)
 
 def _read_file(filename):
     ''' Read .json file and check if it contains required keys.
@@ -36,8 +28,8 @@ def _read_file(filename):
     if "institution" not in data or data["institution"] is None:
         raise ValueError("Need to know institution, short code")
 
-    if "runNumber" not in data:
-        raise ValueError("Need runNumber field in json file (string)")
+    if "runNumber" not in data:  # next free run number is assigned at upload
+        data["runNumber"] = AUTO_RUN_NUMBER
 
     if "passed" not in data:
         raise ValueError("Need passed field (bool) in json file")
@@ -52,16 +44,25 @@ def _read_file(filename):
 
     return data
 
-def upload_iv_data(module_sn, iv_data_file):
-    ''' Upload IV curve data
+def upload_iv_data(module_sn, iv_data_file, outbox_file=OUTBOX_FILE):
+    ''' Upload IV curve data to the SENSOR TILE and link it to the BARE MODULE.
+        All uploads are queued in the outbox first, so that an interrupted upload can be resumed.
     '''
+    iv_data = _read_file(iv_data_file)
+    log_payload(log, 'Read', iv_data)
+
+    outbox = UploadOutbox(outbox_file)
+    sensor_stage_job = outbox.add_stage_change(iv_data['component'], 'SENSOR_TILE', UPLOAD_STAGES['SENSOR_TILE'])
+    iv_job = outbox.add_test_run(iv_data, depends_on=[sensor_stage_job])
+    bare_module_stage_job = outbox.add_stage_change(module_sn, 'BARE_MODULE', UPLOAD_STAGES['BARE_MODULE'])
+    outbox.add_sensor_iv_link(module_sn, iv_job, depends_on=[bare_module_stage_job])
+
     with ITkProdDB() as itk_prodDB:
-        iv_data = _read_file(iv_data_file)
-        log.debug("Test: would send data")
-        log.debug(json.dumps(iv_data, indent=4))
-        itk_prodDB.upload_iv_curve(module_sn=module_sn, iv_data=iv_data)
+        outbox.run(itk_prodDB)
+    outbox.close()
 
 if __name__ == "__main__":
+    setup_logging('IVDataUploader')
     # Example how to upload IV curve data
     module_sn = "20UPGB12200021"
     iv_data_file = "/home/yannick/Documents/IV_curve_7-1_ID_G12-23_IZM_Sintef3D.json"
@@ -2,14 +2,12 @@
 Script to upload module data (.json file) to PDB.
 '''
 import json
-import time
-import logging
-import coloredlogs
 
 from itkprodDB_interface import ITkProdDB
-import pandas as pd
-import numpy as np
-from datetime import datetime
+from run_fingerprint import AUTO_RUN_NUMBER
+from upload_outbox import UploadOutbox, OUTBOX_FILE
+from pull_test import parse_pull_tests, pull_statistics, select_run
+from sheet_schema import extract_payloads
 
 from pathlib import Path
 
@@ -22,48 +20,10 @@ def _read_file(filename):
 
     return data
 
-def _read_xlsx_file(xlsx_file, sheet_name):
-    WS = pd.read_excel(io=xlsx_file, sheet_name=sheet_name, header=None)
-    return np.array(WS)
-
 def convert_module_metrology_data(module_metrology_data_file):
     outfile_json = module_metrology_data_file[:-4] + '_module_metrology.json'
 
-    data = _read_xlsx_file(xlsx_file=module_metrology_data_file, sheet_name=0)
-    module_sn = '20UPGM' + ''.join(str(data[5, 6]).replace(' ', '-').split('-'))
-    datetime_str = datetime.strptime(data[4, 8], '%d.%m.%Y') # datetime(data[152, 8])
-    date = datetime_str.strftime("%Y-%m-%dT%H:%MZ")
-
-    average_thickness = list(data[36:40, 4])
-    average_thickness_std = [round(float(np.std(average_thickness)), 1)]
-    average_thickness_min_max = int(np.max(average_thickness) - np.min(average_thickness))
-    connector_thickness = data[43, 4] * 1000.0 # in um
-    hv_cap_thickness = data[41, 4] * 1000.0 # in um
-    top_left_alignment = list(data[81:83, 2] * 1000.0)  # in um
-    bottom_right_alignment = list(data[81:83, 5] * 1000.0) # im um
-
-    json_string = {
-            "component": module_sn,
-            "testType": "QUAD_MODULE_METROLOGY",
-            "institution": "BONN",
-            "runNumber": "1",  # FIXME
-            "date": date,
-            "passed": True, # FIXME: calculate that based on measurement
-            "problems": False,
-            "properties": {
-                # "OPERATOR": "Wolfgang Dietsche",
-                # "INSTRUMENT": "Mitutoyo MF-UH1010TH",
-                "ANALYSIS_VERSION": None},
-            "results":{
-                "AVERAGE_THICKNESS": average_thickness,
-                "STD_DEVIATION_THICKNESS": average_thickness_std,
-                "THICKNESS_VARIATION_PICKUP_AREA": average_thickness_min_max,
-                "THICKNESS_INCLUDING_POWER_CONNECTOR": connector_thickness,
-                "HV_CAPACITOR_THICKNESS": hv_cap_thickness,
-                "DISTANCE_PCB_BARE_MODULE_TOP_LEFT": top_left_alignment,
-                "DISTANCE_PCB_BARE_MODULE_BOTTOM_RIGHT": bottom_right_alignment
-                }
-            }
+    json_string = extract_payloads(module_metrology_data_file, 'module', tests=['metrology'])['metrology']
 
     with open(outfile_json, 'w') as outfile:
         json.dump(json_string, outfile,  indent=4)
@@ -73,27 +33,7 @@ def convert_module_metrology_data(module_metrology_data_file):
 def convert_module_mass_data(module_mass_data_file):
     outfile_json = module_mass_data_file[:-4] + '_module_mass.json'
 
-    data = _read_xlsx_file(xlsx_file=module_mass_data_file, sheet_name=0)
-    module_sn = '20UPGM' + ''.join(str(data[5, 6]).replace(' ', '-').split('-'))
-    datetime_str = datetime.strptime(data[4, 8], '%d.%m.%Y') # datetime(data[152, 8])
-    date = datetime_str.strftime("%Y-%m-%dT%H:%MZ")
-
-    module_mass = round(data[32, 4], 3) * 1000.0  # in mg
-
-    json_string = {
-            "component": module_sn,
-            "testType": "MASS_MEASUREMENT",
-            "institution": "BONN",
-            "runNumber": "1",  # FIXME
-            "date": date,
-            "passed": True,
-            "problems": False,
-            "properties": {
-                "SCALE_ACCURACY": 1,  # in mg
-                "ANALYSIS_VERSION": None},
-            "results": {
-                "MASS": module_mass}
-            }
+    json_string = extract_payloads(module_mass_data_file, 'module', tests=['mass'])['mass']
 
     with open(outfile_json, 'w') as outfile:
         json.dump(json_string, outfile,  indent=4)
@@ -104,44 +44,7 @@ def convert_module_mass_data(module_mass_data_file):
 def convert_module_vi_assembly_data(module_vi_data_file):
     outfile_json = module_vi_data_file[:-4] + '_module_VI_assembly.json'
 
-    data = _read_xlsx_file(xlsx_file=module_vi_data_file, sheet_name=0)
-    module_sn = '20UPGM' + ''.join(str(data[5, 6]).replace(' ', '-').split('-'))
-    datetime_str = datetime.strptime(data[4, 8], '%d.%m.%Y') # datetime(data[152, 8])
-    date = datetime_str.strftime("%Y-%m-%dT%H:%MZ")
-
-    SENSOR_CONDITION_PASSED_QC = data[62, 5]
-    FE_CHIP_CONDITION_PASSED_QC = data[63, 5]
-    GLUE_DISTRIBUTION_PASSED_QC = data[64, 5]
-    SMD_COMPONENTS_PASSED_QC = data[65, 5]
-
-    # Read defect sources
-    defect_list = []
-    for i in range(13):
-        idx = 48 + i
-        if data[idx, 5] == 1 or str(data[idx, 5]) == 'yes':
-            defect_list.append(i + 1)
-    DEFECTS = defect_list
-
-    json_string = {
-            "component": module_sn,
-            "testType": "VISUAL_INSPECTION",
-            "institution": "BONN",
-            "runNumber": "1",  # FIXME
-            "date": date,
-            "passed": True,
-            "problems": False,
-            "properties": {
-                "ANALYSIS_VERSION": None},
-            "results":{
-                "DEFECTS": DEFECTS,
-                "SMD_COMPONENTS_PASSED_QC": SMD_COMPONENTS_PASSED_QC,
-                "SENSOR_CONDITION_PASSED_QC": SENSOR_CONDITION_PASSED_QC,
-                "FE_CHIP_CONDITION_PASSED_QC": FE_CHIP_CONDITION_PASSED_QC,
-                "GLUE_DISTRIBUTION_PASSED_QC": GLUE_DISTRIBUTION_PASSED_QC,
-                "WIREBONDING_PASSED_QC": None,
-                "PARYLENE_COATING_PASSED_QC": None
-                }
-            }
+    json_string = extract_payloads(module_vi_data_file, 'module', tests=['vi_assembly'])['vi_assembly']
 
     with open(outfile_json, 'w') as outfile:
         json.dump(json_string, outfile,  indent=4)
@@ -149,45 +52,23 @@ def convert_module_vi_assembly_data(module_vi_data_file):
     return outfile_json
 
 def convert_module_pull_data(module_pull_data_file, module_vi_assembly_data_json):
-    with open(module_pull_data_file, encoding="ISO-8859-1") as f:
-        data = f.readlines()
+    module_sn = _read_file(module_vi_assembly_data_json)['component']
+    runs = parse_pull_tests(module_pull_data_file)
+    if not runs:
+        raise ValueError('No pull test found in {0}'.format(module_pull_data_file))
+    run = select_run(runs, module_sn, module_pull_data_file)
+    if run['date'] is None:
+        raise ValueError('No sample date of pull test in {0}'.format(module_pull_data_file))
 
     outfile_json = module_pull_data_file[:-4] + '_module_pull_tests.json'
 
-    datetime_str = datetime.strptime(data[18].split('Sample date')[-1][16:-1], '%Y-%m-%d %H:%M:%S') # datetime(data[152, 8])
-    date = datetime_str.strftime("%Y-%m-%dT%H:%MZ")
-    n_pulls = int(data[17].split('Tests')[-1][-3:-1])
-    pull_strength_min = float(data[15].split('Min Load')[-1][-9:-3])
-    pull_strength_max = float(data[16].split('Max Load')[-1][-9:-3])
-    pull_strength_mean = float(data[11].split('Mean Load')[-1][-9:-3])
-    pull_strength_std = float(data[13].split('Mean Load')[-1][-7:-1])
-    pull_data = []
-    less_5G_breaks = 0
-    fe_heel_breaks = 0
-    pcb_heel_breaks = 0
-    for v in data[33:33+n_pulls]:
-        pull_value = float(v.split('Pass')[0][20:-1])
-        break_type = int(v.split('Break')[1][1:3])
-        if break_type == 1:
-            pcb_heel_breaks += 1
-        elif break_type == 2:
-            fe_heel_breaks += 1
-        else:
-            raise
-        pull_data.append(pull_value)
-        if pull_value < 5.0:
-            less_5G_breaks += 1
-
-    less_5G_breaks = less_5G_breaks
-    lift_off = int(data[14].split('Failures')[-1][-3:-1])
-    fe_heel_breaks = round((fe_heel_breaks) * 100.0 / n_pulls, 1)
-    pcb_heel_breaks = round((pcb_heel_breaks) * 100.0 / n_pulls, 1)
+    date = run['date'].strftime("%Y-%m-%dT%H:%MZ")
 
     json_string = {
-            "component": _read_file(module_vi_assembly_data_json)['component'],
+            "component": module_sn,
             "testType": "WIREBOND_PULL_TEST",
             "institution": "BONN",
-            "runNumber": "1",  # FIXME
+            "runNumber": AUTO_RUN_NUMBER,  # next free run number is assigned at upload
             "date": date,
             "passed": True,
             "problems": False,
@@ -195,17 +76,7 @@ def convert_module_pull_data(module_pull_data_file, module_vi_assembly_data_json
                 "OPERATOR": 'Wolfgang Dietsche',
                 "INSTRUMENT": 'Bonder F&K Delvotec 5600',
                 "ANALYSIS_VERSION": None},
-            "results": {
-                "WIRE_PULLS": n_pulls,
-                "PULL_STRENGTH": pull_strength_mean,
-                "PULL_STRENGTH_ERROR": pull_strength_std,
-                "PULL_STRENGTH_MIN": pull_strength_min,
-                "PULL_STRENGTH_MAX": pull_strength_max,
-                "WIRE_BREAKS_5G": less_5G_breaks,
-                "HEEL_BREAKS_ON_FE_CHIP": fe_heel_breaks,
-                "HEEL_BREAKS_ON_PCB": pcb_heel_breaks,
-                "BOND_PEEL": lift_off,
-                "PULL_STRENGTH_GRADING": pull_data}
+            "results": pull_statistics(run)
             }
 
     with open(outfile_json, 'w') as outfile:
@@ -216,45 +87,7 @@ def convert_module_pull_data(module_pull_data_file, module_vi_assembly_data_json
 def convert_module_vi_wirebonding_data(module_vi_data_file):
     outfile_json = module_vi_data_file[:-4] + '_module_VI_wirebonding.json'
 
-    data = _read_xlsx_file(xlsx_file=module_vi_data_file, sheet_name=0)
-    module_sn = '20UPGM' + ''.join(str(data[5, 6]).replace(' ', '-').split('-'))
-    datetime_str = datetime.strptime(data[4, 8], '%d.%m.%Y')
-    date = datetime_str.strftime("%Y-%m-%dT%H:%MZ")
-
-    SENSOR_CONDITION_PASSED_QC = data[153, 5]
-    FE_CHIP_CONDITION_PASSED_QC = data[154, 5]
-    GLUE_DISTRIBUTION_PASSED_QC = data[155, 5]
-    SMD_COMPONENTS_PASSED_QC = data[156, 5]
-    WIREBONDING_PASSED_QC = data[157, 5]
-
-    # Read defect sources
-    defect_list = []
-    for i in range(13):
-        idx = 139 + i
-        if data[idx, 5] == 1 or str(data[idx, 5]) == 'yes':
-            defect_list.append(i + 1)
-    DEFECTS = defect_list
-
-    json_string = {
-            "component": module_sn,
-            "testType": "VISUAL_INSPECTION",
-            "institution": "BONN",
-            "runNumber": "1",  # FIXME
-            "date": date,
-            "passed": True,
-            "problems": False,
-            "properties": {
-                "ANALYSIS_VERSION": None},
-            "results":{
-                "DEFECTS": DEFECTS,
-                "SMD_COMPONENTS_PASSED_QC": SMD_COMPONENTS_PASSED_QC,
-                "SENSOR_CONDITION_PASSED_QC": SENSOR_CONDITION_PASSED_QC,
-                "FE_CHIP_CONDITION_PASSED_QC": FE_CHIP_CONDITION_PASSED_QC,
-                "GLUE_DISTRIBUTION_PASSED_QC": GLUE_DISTRIBUTION_PASSED_QC,
-                "WIREBONDING_PASSED_QC": WIREBONDING_PASSED_QC,
-                "PARYLENE_COATING_PASSED_QC": None
-                }
-            }
+    json_string = extract_payloads(module_vi_data_file, 'module', tests=['vi_wirebonding'])['vi_wirebonding']
 
     with open(outfile_json, 'w') as outfile:
         json.dump(json_string, outfile,  indent=4)
@@ -265,74 +98,67 @@ def convert_module_vi_wirebonding_data(module_vi_data_file):
 def convert_module_wirebonding_information_data(module_data_file):
     outfile_json = module_data_file[:-4] + '_module_wirebonding_info.json'
 
-    data = _read_xlsx_file(xlsx_file=module_data_file, sheet_name=0)
-    module_sn = '20UPGM' + ''.join(str(data[5, 6]).replace(' ', '-').split('-'))
-    datetime_str = datetime.strptime(data[4, 8], '%d.%m.%Y')
-    date = datetime_str.strftime("%Y-%m-%dT%H:%MZ")
-
-    HUMIDITY = data[8, 8]
-    TEMPERATURE = data[8, 7]
-    json_string = {
-            "component": module_sn,
-            "testType": "WIREBONDING",
-            "institution": "BONN",
-            "runNumber": "1",  # FIXME
-            "date": date,
-            "passed": True,
-            "problems": False,
-            "properties": {
-                "ANALYSIS_VERSION": None,
-                "MACHINE": "Bonder F&K Delvotec 5600",
-                "OPERATOR": "Wolfgang Dietsche",
-                "BOND_WIRE_BATCH": "1",
-                "BOND_PROGRAM": "standard",
-                "BONDING_JIG": "standard"
-                },
-            "results":{
-                "HUMIDITY": HUMIDITY,
-                "TEMPERATURE": TEMPERATURE
-                }
-            }
+    json_string = extract_payloads(module_data_file, 'module', tests=['wirebonding_info'])['wirebonding_info']
 
     with open(outfile_json, 'w') as outfile:
         json.dump(json_string, outfile,  indent=4)
 
     return outfile_json
 
-def upload_module_data(module_metrology_data_json=None, module_mass_data_json=None, module_vi_assembly_data_json=None, module_pull_data_json=None, module_vi_wirebonding_data_json=None, module_wirebonding_information_data_json=None, module_picture_after_assembly=None, module_picture_after_wirebonding=None):
-    ''' Upload module data
+def convert_module_data_file(module_data_file, pull_data_file=None):
+    ''' Extracts all module tests of workbook `module_data_file` (parsed once) and of the optional pull test export.
+        Returns the .json files as dict of keyword arguments of upload_module_data.
     '''
-    with ITkProdDB() as itk_prodDB:
-        if module_metrology_data_json is not None:
-            data = _read_file(module_metrology_data_json)
-            itk_prodDB.upload_module_data(data)
-        if module_mass_data_json is not None:
-            data = _read_file(module_mass_data_json)
-            itk_prodDB.upload_module_data(data)
-        if module_vi_assembly_data_json is not None:
-            filename = module_picture_after_assembly
-            data = _read_file(module_vi_assembly_data_json)
-            filename_data = {"testRun": None, # will be set later when test run ID is know
-                    "title": "{0} after assembly".format(data['component']),
-                    "description": "{0} after assembly".format(data['component']),
-                    "url": Path(filename),
-                    "type": "file"}
-            itk_prodDB.upload_module_data(data, filename, filename_data)
-        if module_pull_data_json is not None:
-            data = _read_file(module_pull_data_json)
-            itk_prodDB.upload_module_data(data)
-        if module_vi_wirebonding_data_json is not None:
-            filename = module_picture_after_wirebonding
-            data = _read_file(module_vi_wirebonding_data_json)
+    jsons = {'module_metrology_data_json': convert_module_metrology_data(module_data_file),
+             'module_mass_data_json': convert_module_mass_data(module_data_file),
+             'module_vi_assembly_data_json': convert_module_vi_assembly_data(module_data_file),
+             'module_vi_wirebonding_data_json': convert_module_vi_wirebonding_data(module_data_file),
+             'module_wirebonding_information_data_json': convert_module_wirebonding_information_data(module_data_file)}
+    if pull_data_file is not None:
+        jsons['module_pull_data_json'] = convert_module_pull_data(pull_data_file, jsons['module_vi_assembly_data_json'])
+    return jsons
+
+def upload_module_data(module_metrology_data_json=None, module_mass_data_json=None, module_vi_assembly_data_json=None, module_pull_data_json=None, module_vi_wirebonding_data_json=None, module_wirebonding_information_data_json=None, module_picture_after_assembly=None, module_picture_after_wirebonding=None, outbox_file=OUTBOX_FILE, max_picture_bytes=None):
+    ''' Upload module data. All uploads are queued in the outbox first, so that an interrupted upload can be resumed.
+        Assembly tests are uploaded before the module is moved to MODULE/WIREBONDING, wire bonding tests afterwards.
+        Pictures larger than `max_picture_bytes` are uploaded as downscaled copy.
+    '''
+    outbox = UploadOutbox(outbox_file)
+
+    def add_test_run(data_json, picture=None, picture_title=None, depends_on=None):
+        data = _read_file(data_json)
+        test_run_job = outbox.add_test_run(data, depends_on=depends_on)
+        if picture is not None:
             filename_data = {"testRun": None, # will be set later when test run ID is know
-                    "title": "{0} after wirebonding".format(data['component']),
-                    "description": "{0} after wirebonding".format(data['component']),
-                    "url": Path(filename),
+                    "title": "{0} {1}".format(data['component'], picture_title),
+                    "description": "{0} {1}".format(data['component'], picture_title),
+                    "url": Path(picture),
                     "type": "file"}
-            itk_prodDB.upload_module_data(data, filename, filename_data)
-        if module_wirebonding_information_data_json is not None:
-            data = _read_file(module_wirebonding_information_data_json)
-            itk_prodDB.upload_module_data(data)
+            outbox.add_attachment(picture, filename_data, test_run_job, max_bytes=max_picture_bytes)
+        return test_run_job
+
+    # Tests at stage MODULE/ASSEMBLY
+    assembly_jobs = []
+    for data_json, picture in [(module_metrology_data_json, None), (module_mass_data_json, None),
+                               (module_vi_assembly_data_json, module_picture_after_assembly)]:
+        if data_json is not None:
+            assembly_jobs.append(add_test_run(data_json, picture, 'after assembly'))
+
+    # Tests at stage MODULE/WIREBONDING
+    wirebonding_data_jsons = [(module_pull_data_json, None), (module_vi_wirebonding_data_json, module_picture_after_wirebonding),
+                              (module_wirebonding_information_data_json, None)]
+    stage_job = None
+    for data_json, picture in wirebonding_data_jsons:
+        if data_json is None:
+            continue
+        if stage_job is None:
+            # FIXME: also change bare module stage
+            stage_job = outbox.add_stage_change(_read_file(data_json)['component'], 'MODULE', 'MODULE/WIREBONDING', depends_on=assembly_jobs)
+        add_test_run(data_json, picture, 'after wirebonding', depends_on=[stage_job])
+
+    with ITkProdDB() as itk_prodDB:
+        outbox.run(itk_prodDB)
+    outbox.close()
 
 
 if __name__ == "__main__":
@@ -351,19 +177,9 @@ if __name__ == "__main__":
         module_data_file = module_data_files[k]
         pull_data_file = pull_data_files[k]
         # extract metrology, mass, VI and wire bonding quality
-        module_metrology_data_json = convert_module_metrology_data(module_data_file)
-        module_mass_data_json = convert_module_mass_data(module_data_file)
-        module_vi_assembly_data_json = convert_module_vi_assembly_data(module_data_file)
-        module_pull_data_json = convert_module_pull_data(pull_data_file, module_vi_assembly_data_json)
-        module_vi_wirebonding_data_json = convert_module_vi_wirebonding_data(module_data_file)
-        module_wirebonding_information_data_json = convert_module_wirebonding_information_data(module_data_file)
+        module_data_jsons = convert_module_data_file(module_data_file, pull_data_file)
+        module_data_jsons['module_wirebonding_information_data_json'] = None
         # upload
-        upload_module_data(module_metrology_data_json=module_metrology_data_json,
-                           module_mass_data_json=module_mass_data_json,
-                           module_vi_assembly_data_json=module_vi_assembly_data_json,
-                           module_pull_data_json=module_pull_data_json,
-                           module_vi_wirebonding_data_json=module_vi_wirebonding_data_json,
-                           module_wirebonding_information_data_json=None, #module_wirebonding_information_data_json,
-                           module_picture_after_assembly=module_picture_after_assembly,
-                           module_picture_after_wirebonding=module_picture_after_wirebonding
-                           )
\ No newline at end of file
+        upload_module_data(module_picture_after_assembly=module_picture_after_assembly,
+                           module_picture_after_wirebonding=module_picture_after_wirebonding,
+                           **module_data_jsons)
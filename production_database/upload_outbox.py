@@ -0,0 +1,292 @@
+'''
+Durable local outbox for PDB uploads.
+
+Upload jobs (test run results, stage changes, attachments, links of sensor IV test runs
+to bare modules) are stored in a SQLite file before anything is sent to the PDB. Jobs are
+processed by a pool of concurrent workers in dependency order and retried with backoff,
+so that a failed or interrupted upload can simply be resumed by running the outbox again.
+
+The outbox file can be shared by several processes (e.g. upload scripts and watch_folder.py).
+A job is claimed by one process at a time and leased to it; jobs of a process which died
+are picked up again once their lease expired.
+'''
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from attachment_uploader import AttachmentUploader
+from itkprodDB_interface import sensor_iv_link
+
+OUTBOX_FILE = 'upload_outbox.sqlite'
+
+
+def _idempotency_key(kind, payload):
+    return hashlib.sha256((kind + json.dumps(payload, sort_keys=True, default=str)).encode('utf-8')).hexdigest()
+
+
+class UploadOutbox(object):
+    '''
+    SQLite backed queue of PDB upload jobs.
+    '''
+
+    def __init__(self, filename=OUTBOX_FILE, max_workers=4, max_attempts=5, backoff=2.0, lease_time=600.0):
+        self.log = logging.getLogger('UploadOutbox')
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease_time = lease_time  # seconds a running job is reserved for this process, renewed while it runs
+        self.owner = '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), id(self))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(filename), check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                idempotency_key TEXT UNIQUE,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                owner TEXT,
+                lease REAL);
+            CREATE TABLE IF NOT EXISTS dependencies (
+                job INTEGER NOT NULL,
+                depends_on INTEGER NOT NULL,
+                PRIMARY KEY (job, depends_on));
+            ''')
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(jobs)')]
+        if 'owner' not in columns:  # outbox of an older version
+            self._db.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+            self._db.execute('ALTER TABLE jobs ADD COLUMN lease REAL')
+        self._db.commit()
+        self._recover_expired()
+
+    def _recover_expired(self):
+        ''' Puts running jobs whose lease expired (their process died) back into the queue. Returns number of jobs.
+        '''
+        with self._lock:
+            n = self._db.execute("UPDATE jobs SET status = 'pending', owner = NULL, lease = NULL "
+                                 "WHERE status = 'running' AND (lease IS NULL OR lease < ?)", (time.time(),)).rowcount
+            self._db.commit()
+        if n:
+            self.log.warning('{0} jobs of a stopped process are queued again'.format(n))
+        return n
+
+    def close(self):
+        self._db.close()
+
+    def _add(self, kind, payload, depends_on=None, key=None, rerun=False):
+        ''' Adds job to outbox and returns its ID. Adding a job with the same idempotency key (default: of `kind` and
+            `payload`) twice returns the ID of the existing job. A failed job added again is queued again (see _requeue),
+            a done one only if `rerun` is set.
+        '''
+        key = key or _idempotency_key(kind, payload)
+        with self._lock:
+            row = self._db.execute('SELECT id, status FROM jobs WHERE idempotency_key = ?', (key,)).fetchone()
+            if row is not None and row[1] == 'failed':
+                self._requeue(row[0], kind, depends_on)
+                self._db.commit()
+                return row[0]
+            if row is not None and row[1] == 'done' and rerun:
+                self._db.execute("UPDATE jobs SET status = 'pending', attempts = 0, next_attempt = 0 WHERE id = ? AND status = 'done'", (row[0],))
+                for dep in depends_on or []:
+                    self._db.execute('INSERT OR IGNORE INTO dependencies VALUES (?, ?)', (row[0], dep))
+                self._db.commit()
+                return row[0]
+            if row is not None:
+                self.log.debug('Job {0} ({1}) is already in outbox'.format(row[0], kind))
+                return row[0]
+            job_id = self._db.execute('INSERT INTO jobs (kind, payload, idempotency_key, created) VALUES (?, ?, ?, ?)',
+                                      (kind, json.dumps(payload, default=str), key, time.time())).lastrowid
+            for dep in depends_on or []:
+                self._db.execute('INSERT OR IGNORE INTO dependencies VALUES (?, ?)', (job_id, dep))
+            self._db.commit()
+        return job_id
+
+    def _requeue(self, job_id, kind, depends_on):
+        ''' Puts failed job `job_id` and the jobs it blocked back into the queue. Its dependencies on failed jobs
+            are replaced by `depends_on` (e.g. the new stage change job of the repeated upload).
+        '''
+        self.log.info('Job {0} ({1}) failed before, queued again'.format(job_id, kind))
+        self._db.execute('''DELETE FROM dependencies WHERE job = ? AND depends_on IN (SELECT id FROM jobs WHERE status = 'failed')''', (job_id,))
+        for dep in depends_on or []:
+            self._db.execute('INSERT OR IGNORE INTO dependencies VALUES (?, ?)', (job_id, dep))
+        self._db.execute('''
+            WITH RECURSIVE blocked(id) AS (
+                SELECT ? UNION
+                SELECT d.job FROM dependencies d JOIN blocked b ON d.depends_on = b.id)
+            UPDATE jobs SET status = 'pending', attempts = 0, next_attempt = 0
+            WHERE status = 'failed' AND (id = ? OR error = 'dependency failed') AND id IN (SELECT id FROM blocked)''', (job_id, job_id))
+
+    def add_test_run(self, data, depends_on=None):
+        ''' Queues uploadTestRunResults of `data`.
+        '''
+        return self._add('test_run', data, depends_on=depends_on)
+
+    def add_stage_change(self, component, component_type, stage, depends_on=None):
+        ''' Queues moving `component` to `stage` along its stage graph. There is one job per component and stage,
+            which is run again if it is added again after it was done (the component could have moved on since).
+        '''
+        return self._add('stage', {'component': component, 'component_type': component_type, 'stage': stage},
+                         depends_on=depends_on, key=_idempotency_key('stage', {'component': component, 'stage': stage}), rerun=True)
+
+    def add_attachment(self, filename, data, test_run_job, depends_on=None, max_bytes=None):
+        ''' Queues createTestRunAttachment of `filename` to the test run uploaded by job `test_run_job`.
+            Pictures larger than `max_bytes` are uploaded downscaled, see attachment_uploader.py.
+        '''
+        payload = {'filename': str(filename), 'data': data, 'test_run_job': test_run_job, 'max_bytes': max_bytes}
+        return self._add('attachment', payload, depends_on=[test_run_job] + list(depends_on or []))
+
+    def add_sensor_iv_link(self, bare_module_sn, sensor_iv_job, depends_on=None):
+        ''' Queues BARE_MODULE_SENSOR_IV test run of `bare_module_sn` linking the sensor IV uploaded by job `sensor_iv_job`.
+        '''
+        payload = {'component': bare_module_sn, 'test_run_job': sensor_iv_job}
+        return self._add('sensor_iv_link', payload, depends_on=[sensor_iv_job] + list(depends_on or []))
+
+    def status(self):
+        ''' Returns number of jobs per status.
+        '''
+        with self._lock:
+            return dict(self._db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def failed_jobs(self):
+        with self._lock:
+            return self._db.execute("SELECT id, kind, payload, error FROM jobs WHERE status = 'failed'").fetchall()
+
+    def retry_failed(self):
+        ''' Puts failed jobs back into the queue.
+        '''
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = 'pending', attempts = 0, next_attempt = 0 WHERE status = 'failed'")
+            self._db.commit()
+
+    def _ready_jobs(self, exclude):
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute('''
+                SELECT id, kind, payload, attempts FROM jobs j
+                WHERE status = 'pending' AND next_attempt <= ?
+                AND NOT EXISTS (SELECT 1 FROM dependencies d JOIN jobs p ON p.id = d.depends_on
+                                WHERE d.job = j.id AND p.status != 'done')
+                ORDER BY id''', (now,)).fetchall()
+        return [r for r in rows if r[0] not in exclude]
+
+    def _fail_blocked_jobs(self):
+        ''' Marks pending jobs depending on failed jobs as failed. Returns number of marked jobs.
+        '''
+        with self._lock:
+            n = self._db.execute('''
+                UPDATE jobs SET status = 'failed', error = 'dependency failed'
+                WHERE status = 'pending' AND id IN (
+                    SELECT d.job FROM dependencies d JOIN jobs p ON p.id = d.depends_on WHERE p.status = 'failed')''').rowcount
+            self._db.commit()
+        return n
+
+    def _result_of(self, job_id):
+        with self._lock:
+            row = self._db.execute('SELECT result FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row[0])
+
+    def _execute(self, itk_prodDB, job_id, kind, payload, attempts):
+        if kind == 'stage':
+            stage = itk_prodDB._change_component_stage(component_code=payload['component'], component_type=payload['component_type'],
+                                                       target_stage=payload['stage'])
+            if stage != payload['stage']:
+                raise RuntimeError('Could not change stage of {0} to {1}'.format(payload['component'], payload['stage']))
+            return {'stage': stage}
+        if attempts > 0 and kind in ['test_run', 'sensor_iv_link']:
+            # previous attempt could have reached the PDB, upload_test_run finds it instead of creating a duplicate
+            itk_prodDB.cache.invalidate(payload['component'])
+        if kind == 'test_run':
+            ret = itk_prodDB.upload_test_run(payload)
+            return {'testRun': str(ret['testRun']['id'])}
+        if kind == 'attachment':
+            data = dict(payload['data'])
+            data['testRun'] = self._result_of(payload['test_run_job'])['testRun']
+            # retried by the outbox, files attached by a previous attempt are skipped
+            uploader = AttachmentUploader(itk_prodDB, max_bytes=payload.get('max_bytes'), max_attempts=1)
+            uploaded = uploader.upload(payload['filename'], data)
+            return {'testRun': data['testRun'], 'uploaded': uploaded}
+        if kind == 'sensor_iv_link':
+            test_run_id = self._result_of(payload['test_run_job'])['testRun']
+            test_run = itk_prodDB._get("getTestRun", json={"testRun": test_run_id})
+            ret = itk_prodDB.upload_test_run(sensor_iv_link(payload['component'], test_run))
+            return {'testRun': str(ret['testRun']['id'])}
+        raise ValueError('Unknown job type {0}'.format(kind))
+
+    def _claim(self, job_id):
+        ''' Marks pending job as running in this process. Returns False if another process claimed it first.
+        '''
+        with self._lock:
+            n = self._db.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, owner = ?, lease = ? "
+                                 "WHERE id = ? AND status = 'pending'", (self.owner, time.time() + self.lease_time, job_id)).rowcount
+            self._db.commit()
+        return n == 1
+
+    def _renew_leases(self):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET lease = ? WHERE status = 'running' AND owner = ?", (time.time() + self.lease_time, self.owner))
+            self._db.commit()
+
+    def _finish(self, job_id, kind, attempts, future):
+        with self._lock:
+            try:
+                result = future.result()
+            except Exception as e:  # failed jobs are kept in the outbox and retried
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    self.log.error('Job {0} ({1}) failed after {2} attempts: {3}'.format(job_id, kind, attempts, e))
+                    self._db.execute("UPDATE jobs SET status = 'failed', error = ?, owner = NULL, lease = NULL WHERE id = ?", (str(e), job_id))
+                else:
+                    delay = self.backoff ** attempts
+                    self.log.warning('Job {0} ({1}) failed, retrying in {2:.0f} s: {3}'.format(job_id, kind, delay, e))
+                    self._db.execute("UPDATE jobs SET status = 'pending', error = ?, next_attempt = ?, owner = NULL, lease = NULL WHERE id = ?",
+                                     (str(e), time.time() + delay, job_id))
+            else:
+                self.log.info('Job {0} ({1}) done'.format(job_id, kind))
+                self._db.execute("UPDATE jobs SET status = 'done', error = NULL, result = ?, owner = NULL, lease = NULL WHERE id = ?",
+                                 (json.dumps(result), job_id))
+            self._db.commit()
+
+    def run(self, itk_prodDB):
+        ''' Processes all pending jobs using `itk_prodDB`. Returns number of jobs per status.
+        '''
+        running = {}
+        renewed = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                for job_id, kind, payload, attempts in self._ready_jobs(exclude=[job[0] for job in running.values()]):
+                    if len(running) >= self.max_workers:
+                        break
+                    if not self._claim(job_id):
+                        continue
+                    future = executor.submit(self._execute, itk_prodDB, job_id, kind, json.loads(payload), attempts)
+                    running[future] = (job_id, kind, attempts)
+                if running:
+                    done, _ = wait(list(running), timeout=1.0, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self._finish(*running.pop(future), future=future)
+                    if time.time() - renewed > self.lease_time / 4:
+                        self._renew_leases()
+                        renewed = time.time()
+                    continue
+                if self._fail_blocked_jobs() or self._recover_expired():
+                    continue
+                with self._lock:
+                    next_attempt = self._db.execute("SELECT MIN(next_attempt) FROM jobs WHERE status = 'pending'").fetchone()[0]
+                if next_attempt is None:
+                    break
+                # pending jobs can also wait for jobs running in another process
+                time.sleep(min(max(next_attempt - time.time(), 1.0), 10.0))
+
+        status = self.status()
+        self.log.info('Outbox processed: {0}'.format(status))
+        return status
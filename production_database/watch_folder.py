@@ -0,0 +1,134 @@
+'''
+Watch-folder daemon: converts QC files copied to a shared folder and queues their upload.
+
+New or changed workbooks, VI photos and pull test exports are detected with inotify
+(watchdog) or, if watchdog is not installed, by polling. Files are only processed once
+their folder has not changed for `settle` seconds, so partially copied files are not
+picked up. Conversion and upload are done by BatchIngest (see batch_ingest.py), and the
+status of every component is written to <status dir>/<serial number>.json:
+
+    python watch_folder.py /mnt/shared/module_qc --settle 30
+'''
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from batch_ingest import BatchIngest
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+STATUS_DIR = 'status'
+
+
+class _WakeOnChange(FileSystemEventHandler):
+    def __init__(self, wake, ignored):
+        self.wake = wake
+        self.ignored = ignored
+
+    def on_any_event(self, event):
+        path = Path(event.src_path)
+        if not any(part in self.ignored for part in path.parts) and path.suffix.lower() not in ['.json', '.tmp']:
+            self.wake.set()
+
+
+class FolderWatcher(object):
+    '''
+    Runs BatchIngest on a folder whenever files in it changed and have settled.
+    '''
+
+    def __init__(self, folder, status_dir=None, settle=30.0, interval=60.0, upload=True, max_workers=None, max_picture_bytes=None):
+        '''
+            settle: seconds a folder has to be unchanged before its files are processed
+            interval: seconds between scans if no file system event arrives (polling mode, or as safety net with inotify)
+        '''
+        self.folder = Path(folder)
+        self.status_dir = Path(status_dir) if status_dir is not None else self.folder / STATUS_DIR
+        self.settle = settle
+        self.interval = interval
+        self.upload = upload
+        self.log = logging.getLogger('FolderWatcher')
+        self.ingest = BatchIngest(folder, max_workers=max_workers, max_picture_bytes=max_picture_bytes)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def _write_status(self, workbook, entry):
+        if not entry.get('component'):
+            return
+        self.status_dir.mkdir(parents=True, exist_ok=True)
+        status = {'component': entry['component'], 'template': entry['template'], 'status': entry['status'],
+                  'workbook': workbook, 'tests': sorted(k for k, v in entry.get('jsons', {}).items() if v),
+                  'pictures': entry.get('pictures', []), 'pull_tests': entry.get('pull_tests', []),
+                  'error': entry.get('error'), 'updated': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        filename = self.status_dir / '{0}.json'.format(entry['component'])
+        tmp = filename.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(status, f, indent=4)
+        os.replace(tmp, filename)
+
+    def scan(self):
+        ''' Processes all settled new or changed files once. Returns {workbook: manifest entry} of the processed workbooks.
+        '''
+        processed = self.ingest.run(upload=self.upload, min_age=self.settle)
+        for workbook, entry in processed.items():
+            self._write_status(workbook, entry)
+        return processed
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def run(self):
+        ''' Watches the folder until stop() is called or the process is interrupted.
+        '''
+        observer = None
+        if Observer is not None:
+            observer = Observer()
+            observer.schedule(_WakeOnChange(self._wake, [self.status_dir.name]), str(self.folder), recursive=True)
+            observer.start()
+            self.log.info('Watching {0} (inotify)'.format(self.folder))
+        else:
+            self.log.info('Watching {0} (polling every {1:g} s, watchdog not installed)'.format(self.folder, self.interval))
+        try:
+            while not self._stop.is_set():
+                self._wake.clear()
+                try:
+                    self.scan()
+                except Exception as e:  # keep watching, e.g. if the share is temporarily unavailable
+                    self.log.error('Scan of {0} failed: {1}'.format(self.folder, e))
+                # Come back when deferred (still changing) files have settled
+                timeout = min(self.interval, self.settle) if self.ingest.deferred else self.interval
+                if self._wake.wait(timeout) and not self._stop.is_set():
+                    self._stop.wait(self.settle)  # debounce a burst of events
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+
+
+if __name__ == '__main__':
+    from pdb_logging import setup_logging
+
+    parser = argparse.ArgumentParser(description='Watch a folder and convert and upload new QC workbooks, VI photos and pull tests')
+    parser.add_argument('folder', help='Shared folder with the QC files')
+    parser.add_argument('--status-dir', default=None, help='Folder of the per component status files (default: {0} in the folder)'.format(STATUS_DIR))
+    parser.add_argument('--settle', type=float, default=30.0, help='Seconds a folder has to be unchanged before it is processed')
+    parser.add_argument('--interval', type=float, default=60.0, help='Seconds between scans without file system events')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--no-upload', action='store_true', help='Only convert, do not upload')
+    parser.add_argument('--max-picture-bytes', type=int, default=None, help='Upload larger pictures as downscaled copy')
+    args = parser.parse_args()
+
+    setup_logging('FolderWatcher')
+    FolderWatcher(args.folder, status_dir=args.status_dir, settle=args.settle, interval=args.interval, upload=not args.no_upload,
+                  max_workers=args.jobs, max_picture_bytes=args.max_picture_bytes).run()
@@ -0,0 +1,97 @@
+'''
+Cached reading of QC spreadsheets (.xls/.xlsx).
+
+Each sheet is parsed once into a NumPy object matrix (row, column as in the sheet, 0-based)
+and kept in memory, so that all tests extracted from the same workbook (metrology, mass,
+visual inspection, ...) share one parse. A changed file (modification time or size) is
+parsed again.
+
+If the caller only needs the top left block of a sheet (e.g. the cells of a cell map),
+.xlsx files are streamed in read-only mode and only that block is materialized. Legacy
+.xls files (and .xlsx without openpyxl) are read with pandas.
+'''
+from collections import OrderedDict
+from pathlib import Path
+import threading
+
+import numpy as np
+import pandas as pd
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# Maximum number of parsed sheets kept in memory
+MAX_CACHED_SHEETS = 16
+
+_sheets = OrderedDict()  # key -> (limits the sheet was read with, matrix)
+_lock = threading.Lock()
+
+
+def _key(filename, sheet_name):
+    path = Path(filename).resolve()
+    stat = path.stat()
+    return str(path), stat.st_mtime_ns, stat.st_size, sheet_name
+
+
+def _covers(limits, wanted):
+    if limits is None:
+        return True
+    if wanted is None:
+        return False
+    return limits[0] >= wanted[0] and limits[1] >= wanted[1]
+
+
+def _read_streaming(filename, sheet_name, limits):
+    wb = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[sheet_name] if isinstance(sheet_name, int) else wb[sheet_name]
+        max_row, max_col = limits if limits is not None else (None, None)
+        rows = [row for row in ws.iter_rows(min_row=1, max_row=max_row, min_col=1, max_col=max_col, values_only=True)]
+    finally:
+        wb.close()
+    n_columns = max([len(row) for row in rows], default=0)
+    if limits is not None:
+        n_columns = min(n_columns, limits[1])
+    data = np.full((len(rows), n_columns), np.nan, dtype=object)
+    for i, row in enumerate(rows):
+        for j, value in enumerate(row[:n_columns]):
+            if value is not None:
+                data[i, j] = value
+    return data
+
+
+def _read_pandas(filename, sheet_name, limits):
+    nrows = limits[0] if limits is not None else None
+    data = np.array(pd.read_excel(io=filename, sheet_name=sheet_name, header=None, nrows=nrows), dtype=object)
+    return data[:, :limits[1]] if limits is not None else data
+
+
+def read_sheet(filename, sheet_name=0, limits=None):
+    ''' Returns cell matrix of sheet `sheet_name` (index or name) of workbook `filename`. Empty cells are NaN.
+        With `limits` = (rows, columns) only the top left block of this size is read (smaller if the sheet is smaller).
+        The matrix is shared between callers and must not be modified.
+    '''
+    key = _key(filename, sheet_name)
+    with _lock:
+        if key in _sheets and _covers(_sheets[key][0], limits):
+            _sheets.move_to_end(key)
+            data = _sheets[key][1]
+            return data[:limits[0], :limits[1]] if limits is not None else data
+    if openpyxl is not None and str(filename).lower().endswith(('.xlsx', '.xlsm')):
+        data = _read_streaming(filename, sheet_name, limits)
+    else:
+        data = _read_pandas(filename, sheet_name, limits)
+    data.setflags(write=False)
+    with _lock:
+        _sheets[key] = (limits, data)
+        _sheets.move_to_end(key)
+        while len(_sheets) > MAX_CACHED_SHEETS:
+            _sheets.popitem(last=False)
+    return data
+
+
+def clear_cache():
+    with _lock:
+        _sheets.clear()